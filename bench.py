@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+
+import contextlib
+import datetime
+import io
+import json
+import platform
+import resource
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+import compass
+import dcf
+import rentregress
+import synthetic
+
+# Benchmarks each pipeline stage on deterministic synthetic listings and
+# reports throughput, latency percentiles and peak traced memory as JSON, so
+# results from two versions can be compared with --baseline.
+
+STAGES = ("extract", "features", "train", "regress", "dcf_scalar", "dcf_batch", "dcf_reprice")
+DEFAULT_SIZES = (1000, 10000, 100000)
+LATENCY_PERCENTILES = (50, 90, 99)
+
+def get_git_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+            cwd=sys.path[0] or None,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def measure(stage, rows, run, repeats):
+    # run() performs the stage once and returns the per-call latencies in
+    # seconds (one per page or listing for per-item stages, otherwise just
+    # its own duration). Peak memory comes from one extra run under
+    # tracemalloc, kept out of the timed runs because tracing slows them
+    # down; it counts Python and numpy allocations but not native libraries
+    # that use their own allocators (e.g. XGBoost).
+    latencies = []
+    durations = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        latencies.extend(run())
+        durations.append(time.perf_counter() - start)
+    tracemalloc.start()
+    try:
+        run()
+        peak_traced_bytes = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return {
+        "stage": stage,
+        "rows": rows,
+        "repeats": repeats,
+        "calls": len(latencies),
+        "seconds": float(np.median(durations)),
+        "rows_per_second": rows / float(np.median(durations)),
+        "latency_seconds": dict(zip(
+            ("p{}".format(p) for p in LATENCY_PERCENTILES),
+            np.percentile(latencies, LATENCY_PERCENTILES).tolist(),
+        ), max=max(latencies)),
+        "peak_traced_bytes": peak_traced_bytes,
+    }
+
+def timed(fn, *args, **kwargs):
+    start = time.perf_counter()
+    fn(*args, **kwargs)
+    return [time.perf_counter() - start]
+
+def quietly(fn, *args, **kwargs):
+    # train and friends print their metrics.
+    with contextlib.redirect_stdout(io.StringIO()):
+        return fn(*args, **kwargs)
+
+def bench_extract(pages):
+    latencies = []
+    for page in pages:
+        start = time.perf_counter()
+        list(compass.extract_listings_from_response(page))
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+def bench_dcf_scalar(kwargs, count):
+    latencies = []
+    for i in range(count):
+        listing_kwargs = {name: value[i] if np.ndim(value) else value for name, value in kwargs.items()}
+        start = time.perf_counter()
+        dcf.get_unlevered_returns(**listing_kwargs)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+def run_benchmarks(size, stages=STAGES, repeats=3, scalar_calls=1000, seed=0):
+    results = []
+    rentals_df = synthetic.make_listings_df(compass.LISTING_TYPE_RENTAL, size, seed=seed)
+    sales_df = synthetic.make_listings_df(compass.LISTING_TYPE_SALE, size, seed=seed)
+
+    if "extract" in stages:
+        rental_pages = list(synthetic.iter_search_pages(compass.LISTING_TYPE_RENTAL, size, seed=seed))
+        results.append(measure("extract", size, lambda: bench_extract(rental_pages), repeats))
+    if "features" in stages:
+        results.append(measure("features", size, lambda: timed(rentals_df.pipe, rentregress.clean_features), repeats))
+    if "train" in stages:
+        results.append(measure("train", size, lambda: timed(quietly, rentregress.train, rentals_df), repeats))
+    if {"regress", "dcf_scalar", "dcf_batch", "dcf_reprice"} & set(stages):
+        results.extend(run_scoring_benchmarks(rentals_df, sales_df, stages, repeats, scalar_calls))
+    for result in results:
+        result["size"] = size
+    return results
+
+def run_scoring_benchmarks(rentals_df, sales_df, stages, repeats, scalar_calls):
+    results = []
+    size = len(sales_df)
+
+    reg = quietly(rentregress.train, rentals_df)
+    if "regress" in stages:
+        results.append(measure("regress", size, lambda: timed(rentregress.regress, sales_df.copy(), reg), repeats))
+    scored_df = sales_df.copy()
+    rentregress.regress(scored_df, reg)
+    dcf_kwargs = rentregress.get_dcf_kwargs(scored_df)
+    if "dcf_scalar" in stages:
+        count = min(size, scalar_calls)
+        results.append(measure("dcf_scalar", count, lambda: bench_dcf_scalar(dcf_kwargs, count), repeats))
+    if "dcf_batch" in stages:
+        results.append(measure(
+            "dcf_batch", size, lambda: timed(dcf.get_unlevered_returns_batch, **dcf_kwargs), repeats,
+        ))
+    if "dcf_reprice" in stages:
+        # Every listing 5% cheaper, from a decomposition built beforehand.
+        decomposition = dcf.decompose_cash_flows_batch(**dcf_kwargs)
+        cut_prices = decomposition.purchase_price_dollars * 0.95
+        results.append(measure(
+            "dcf_reprice", size, lambda: timed(dcf.reprice_batch, decomposition, purchase_price_dollars=cut_prices), repeats,
+        ))
+    return results
+
+def find_regressions(report, baseline, max_slowdown):
+    # Stages whose throughput dropped by more than max_slowdown (a fraction)
+    # relative to the same stage and dataset size in baseline.
+    baseline_results = {(r["stage"], r["size"]): r for r in baseline["results"]}
+    regressions = []
+    for result in report["results"]:
+        before = baseline_results.get((result["stage"], result["size"]))
+        if before is None:
+            continue
+        slowdown = 1.0 - result["rows_per_second"] / before["rows_per_second"]
+        if slowdown > max_slowdown:
+            regressions.append((result["stage"], result["size"], slowdown))
+    return regressions
+
+def parse_ints(s):
+    return [int(x) for x in s.split(",")]
+
+def main(argv):
+    import argparse
+    parser = argparse.ArgumentParser(description="Benchmark pipeline stages on synthetic listings")
+    parser.add_argument("--sizes", type=parse_ints, default=DEFAULT_SIZES,
+                        help="Comma-separated listing counts")
+    parser.add_argument("--stages", type=lambda s: s.split(","), default=STAGES,
+                        help="Comma-separated subset of " + ",".join(STAGES))
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--scalar-calls", type=int, default=1000,
+                        help="Listings to time one at a time in the dcf_scalar stage")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Write the JSON report here instead of stdout")
+    parser.add_argument("--baseline", help="Earlier JSON report to compare throughput against")
+    parser.add_argument("--max-slowdown", type=float, default=0.2,
+                        help="Fail when a stage's throughput drops by more than this fraction of the baseline")
+
+    parsed = parser.parse_args(argv[1:])
+    unknown_stages = set(parsed.stages) - set(STAGES)
+    if unknown_stages:
+        parser.error("Unknown stages: {}".format(", ".join(sorted(unknown_stages))))
+    results = []
+    for size in parsed.sizes:
+        results.extend(run_benchmarks(size, parsed.stages, parsed.repeats, parsed.scalar_calls, parsed.seed))
+        print("Benchmarked {} listings".format(size), file=sys.stderr)
+    report = {
+        "git_revision": get_git_revision(),
+        "run_at": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "seed": parsed.seed,
+        # ru_maxrss is in kilobytes on Linux.
+        "max_rss_bytes": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+        "results": results,
+    }
+    if parsed.output:
+        with open(parsed.output, "w") as outfile:
+            json.dump(report, outfile, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+    if parsed.baseline:
+        with open(parsed.baseline) as infile:
+            regressions = find_regressions(report, json.load(infile), parsed.max_slowdown)
+        for stage, size, slowdown in regressions:
+            print("Regression: {} on {} listings is {:.0%} slower".format(stage, size, slowdown), file=sys.stderr)
+        if regressions:
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -1,12 +1,28 @@
 #!/usr/bin/env python
 
+import array
 import collections
+import concurrent.futures
 import csv
 import datetime
+import email.utils
+import glob
+import gzip
+import hashlib
+import itertools
 import json
+import math
+import os
+import random
 import re
 import requests
+import requests.adapters
+
+import metrics
 import sys
+import threading
+import time
+import urllib.parse
 
 LISTING_TYPE_RENTAL = "rental"
 LISTING_TYPE_SALE = "sale"
@@ -168,18 +184,35 @@ BK_LOCATIONS = [
      "seoId": "park-slope-brooklyn-ny",},
 ]
 
-def query_compass(listing_type, locations):
-    # locs = [
-    #     {"id": 21462,
-    #      "name": "Lower East Side",
-    #      "seoId": "lower-east-side-manhattan-ny",},
-    # ]   
-    for bkl in locations:
-    # for bkl in locs:
-        for result in query_bk_location(bkl, listing_type):
-            yield result
-
-def query_bk_location(bk_location, listing_type):
+# Locations of each market a multi-market run can scrape, by name.
+MARKETS = {
+    "bk": BK_LOCATIONS,
+    "long-island": LONG_ISLAND_LOCATIONS,
+    "austin": AUSTIN_LOCATIONS,
+}
+
+SEARCH_PAGE_SIZE = 20
+
+class HostRateLimiter(object):
+    # Spaces out requests to each host so that no host sees more than
+    # requests_per_second, no matter how many threads are fetching.
+    def __init__(self, requests_per_second):
+        self.interval_seconds = 1.0 / requests_per_second
+        self.lock = threading.Lock()
+        self.next_request_times = {}
+
+    def wait(self, url):
+        host = urllib.parse.urlsplit(url).netloc
+        with self.lock:
+            now = time.monotonic()
+            request_time = max(now, self.next_request_times.get(host, now))
+            self.next_request_times[host] = request_time + self.interval_seconds
+        if request_time > now:
+            time.sleep(request_time - now)
+
+COMPASS_BASE_URL = "https://www.compass.com"
+
+def get_search_page_request(bk_location, listing_type, start, stride, base_url=COMPASS_BASE_URL):
     # curl invocation:
     # curl -s 'https://www.compass.com/for-rent/brooklyn-heights-brooklyn-ny/' -H 'content-type: application/json'    --data-binary '{"rawLolSearchQuery":{"listingTypes":[0],"rentalStatuses":[7,5],"num":20,"sortOrder":115,"start":290,"locationIds":[21452],"schoolNames":[],"facetFieldNames":["contributingDatasetList","compassListingTypes","comingSoon"]}, "purpose":"search"}'
 
@@ -195,43 +228,419 @@ def query_bk_location(bk_location, listing_type):
     )
     if listing_params is None:
         raise ValueError("Invalid listing type: {}".format(listing_type))
-    
-    start = 0
-    stride = 20
-    totalItems = -1
-    while totalItems < 0 or start < totalItems:
-        resp = requests.post(
-            "https://www.compass.com/{}/{}{}".format(
-                url_slug,
-                bk_location["seoId"],
-                "/start={}/".format(start) if start > 0 else "",
-            ),
-            json={
-                "rawLolSearchQuery": {
-                    #"listingTypes": [0],
-                    #"rentalStatuses": [7,5],
-                    "num": stride,
-                    "sortOrder": 115,
-                    "start": start,
-                    "locationIds": [bk_location["id"]],
-                    "schoolNames": [],
-                    "facetFieldNames": ["contributingDatasetList","compassListingTypes","comingSoon"],
-                    **listing_params
-                },
-                "purpose": "search",
-            },               
-        )
 
-        response_json = resp.json()
-        if not response_json["lolResults"]["data"]:
-            break
+    url = "{}/{}/{}{}".format(
+        base_url.rstrip("/"),
+        url_slug,
+        bk_location["seoId"],
+        "/start={}/".format(start) if start > 0 else "",
+    )
+    body = {
+        "rawLolSearchQuery": {
+            #"listingTypes": [0],
+            #"rentalStatuses": [7,5],
+            "num": stride,
+            "sortOrder": 115,
+            "start": start,
+            "locationIds": [bk_location["id"]],
+            "schoolNames": [],
+            "facetFieldNames": ["contributingDatasetList","compassListingTypes","comingSoon"],
+            **listing_params
+        },
+        "purpose": "search",
+    }
+    return url, body
+
+class ResponseCache(object):
+    # Content-addressed on-disk cache of raw search page responses, keyed by
+    # listing type, location id, start offset and stride. Entries older than
+    # ttl_seconds are treated as misses (except when replaying), and the
+    # least recently used entries are evicted once the cache grows past
+    # max_bytes. Use order is kept in memory, starting from file mtimes.
+    def __init__(self, cache_dir, ttl_seconds=None, max_bytes=None):
+        self.cache_dir = cache_dir
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+        entries = []
+        for path in glob.glob(os.path.join(cache_dir, "*", "*.json.gz")):
+            stat = os.stat(path)
+            entries.append((stat.st_mtime, path, stat.st_size))
+        # Path -> size, least recently used first.
+        self.entry_sizes = collections.OrderedDict((path, size) for _, path, size in sorted(entries))
+        self.total_bytes = sum(self.entry_sizes.values())
+
+    def get_path(self, listing_type, location_id, start, stride):
+        key = json.dumps([listing_type, location_id, start, stride])
+        digest = hashlib.sha256(key.encode("utf-8")).hexdigest()
+        return os.path.join(self.cache_dir, digest[:2], digest + ".json.gz")
+
+    def get(self, listing_type, location_id, start, stride, ignore_ttl=False):
+        path = self.get_path(listing_type, location_id, start, stride)
+        try:
+            if not ignore_ttl and self.ttl_seconds is not None:
+                if time.time() - os.path.getmtime(path) > self.ttl_seconds:
+                    return None
+            with gzip.open(path, "rt") as infile:
+                response_json = json.load(infile)
+        except (OSError, ValueError):
+            return None
+        with self.lock:
+            if path in self.entry_sizes:
+                self.entry_sizes.move_to_end(path)
+        return response_json
+
+    def put(self, listing_type, location_id, start, stride, response_json):
+        path = self.get_path(listing_type, location_id, start, stride)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = "{}.{}.tmp".format(path, threading.get_ident())
+        with gzip.open(tmp_path, "wt") as outfile:
+            json.dump(response_json, outfile)
+        os.replace(tmp_path, path)
+        with self.lock:
+            self.total_bytes -= self.entry_sizes.pop(path, 0)
+            self.entry_sizes[path] = os.path.getsize(path)
+            self.total_bytes += self.entry_sizes[path]
+            if self.max_bytes is not None and self.total_bytes > self.max_bytes:
+                self.evict()
+
+    def evict(self):
+        while self.total_bytes > self.max_bytes and self.entry_sizes:
+            path, size = self.entry_sizes.popitem(last=False)
+            self.total_bytes -= size
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+class SeenSet(object):
+    # Set of listing keys, held as 64-bit hashes rather than strings to keep
+    # memory down (a collision among a million keys has odds of about one in
+    # 40 million). With a path, keys saved by an earlier part of the same run
+    # are loaded and save() writes them back along with this part's. The file
+    # starts with a hash of run_id, and keys saved under another run are
+    # ignored, since skipping every listing seen on an earlier day would keep
+    # its later changes out of the output and the store.
+    def __init__(self, path=None, run_id=""):
+        self.path = path
+        self.hashes = set()
+        self.lock = threading.Lock()
+        self.run_hash = self.get_hash(run_id)
+        if path is not None and os.path.exists(path):
+            hashes = array.array("Q")
+            with open(path, "rb") as infile:
+                hashes.frombytes(infile.read())
+            if hashes and hashes[0] == self.run_hash:
+                self.hashes.update(hashes[1:])
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def get_hash(self, key):
+        return int.from_bytes(hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest(), "little")
+
+    def add_all(self, keys):
+        # Adds keys and returns True, unless any of them was already seen.
+        hashes = [self.get_hash(key) for key in keys]
+        with self.lock:
+            if any(h in self.hashes for h in hashes):
+                return False
+            self.hashes.update(hashes)
+            return True
+
+    def save(self):
+        tmp_path = "{}.tmp.{}".format(self.path, os.getpid())
+        with self.lock, open(tmp_path, "wb") as outfile:
+            array.array("Q", [self.run_hash] + sorted(self.hashes)).tofile(outfile)
+        os.replace(tmp_path, self.path)
+
+def normalize_address(address):
+    return " ".join(address.lower().replace(",", " ").split())
+
+def get_listing_keys(listing_type, listing):
+    # A listing is a duplicate of an earlier one with the same permalink, or
+    # with the same building and (unit) address under another permalink.
+    keys = ["{}|permalink|{}".format(listing_type, listing.permalink)]
+    if listing.building_id is not None and listing.address:
+        keys.append("{}|unit|{}|{}".format(listing_type, listing.building_id, normalize_address(listing.address)))
+    return keys
+
+def skip_duplicate_listings(listing_type, listings, seen=None):
+    # listings without the duplicates query_compass would skip. Incremental
+    # scrapes record whole pages in a store, so listings read back from it
+    # need this too.
+    seen = SeenSet() if seen is None else seen
+    for listing in listings:
+        if seen.add_all(get_listing_keys(listing_type, listing)):
+            yield listing
+
+RETRY_STATUS_CODES = frozenset((429, 500, 502, 503, 504))
+
+class CompassClient(object):
+    # Owns a pooled HTTP session for talking to Compass. Every search page
+    # request has connect/read timeouts and is retried with exponential
+    # backoff and full jitter (or the server's Retry-After) on connection
+    # errors, timeouts, throttling, 5xx responses and truncated bodies, so
+    # pagination always resumes from the last page that came back intact.
+    # With a ResponseCache, fresh cached pages are served without touching
+    # the network; with replay=True pages come only from the cache.
+    # stop_paging is called with the listings extracted from each page
+    # before they are yielded; if it returns True no further pages of that
+    # location are fetched. base_url can point the client at a stand-in such
+    # as mockcompass.
+    # query_compass skips listings already yielded for an earlier location
+    # (see get_listing_keys), or recorded in seen, a SeenSet shared across
+    # calls or runs; skips are counted per location in duplicate_counts.
+    def __init__(
+            self,
+            concurrency=1,
+            rate_limiter=None,
+            cache=None,
+            replay=False,
+            stop_paging=None,
+            connect_timeout_seconds=5.0,
+            read_timeout_seconds=30.0,
+            max_retries=5,
+            backoff_seconds=1.0,
+            max_backoff_seconds=60.0,
+            base_url=COMPASS_BASE_URL,
+            seen=None):
+        self.concurrency = concurrency
+        self.rate_limiter = rate_limiter
+        self.cache = cache
+        self.replay = replay
+        self.stop_paging = stop_paging
+        if replay and cache is None:
+            raise ValueError("Replaying requires a response cache")
+        self.timeout = (connect_timeout_seconds, read_timeout_seconds)
+        self.max_retries = max_retries
+        self.backoff_seconds = backoff_seconds
+        self.max_backoff_seconds = max_backoff_seconds
+        self.base_url = base_url
+        self.seen = seen
+        self.duplicate_counts = collections.Counter()
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=max(concurrency, 1))
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def close(self):
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def get_retry_delay_seconds(self, attempt, retry_after=None):
+        # Retry-After is either seconds or an HTTP date; anything else falls
+        # back to the usual backoff.
+        if retry_after:
+            try:
+                return min(max(float(retry_after), 0.0), self.max_backoff_seconds)
+            except ValueError:
+                pass
+            try:
+                retry_at = email.utils.parsedate_to_datetime(retry_after)
+            except (TypeError, ValueError):
+                retry_at = None
+            if retry_at is not None:
+                if retry_at.tzinfo is None:
+                    retry_at = retry_at.replace(tzinfo=datetime.timezone.utc)
+                delay = (retry_at - datetime.datetime.now(datetime.timezone.utc)).total_seconds()
+                return min(max(delay, 0.0), self.max_backoff_seconds)
+        return random.uniform(0, min(self.max_backoff_seconds, self.backoff_seconds * 2 ** attempt))
+
+    def fetch_search_page(self, bk_location, listing_type, start, stride):
+        if self.cache is not None:
+            response_json = self.cache.get(listing_type, bk_location["id"], start, stride, ignore_ttl=self.replay)
+            if response_json is not None:
+                metrics.registry.increment("compass_cache_hits_total", location=bk_location["name"])
+                return response_json
+            if self.replay:
+                raise LookupError("No cached {} page for {} at start={}".format(
+                    listing_type, bk_location["name"], start))
+        response_json = self.fetch_search_page_from_network(bk_location, listing_type, start, stride)
+        if self.cache is not None:
+            self.cache.put(listing_type, bk_location["id"], start, stride, response_json)
+        return response_json
+
+    def fetch_search_page_from_network(self, bk_location, listing_type, start, stride):
+        url, body = get_search_page_request(bk_location, listing_type, start, stride, self.base_url)
+        location = bk_location["name"]
+        for attempt in range(self.max_retries + 1):
+            retry_after = None
+            if self.rate_limiter is not None:
+                self.rate_limiter.wait(url)
+            request_start = time.perf_counter()
+            status = "error"
+            try:
+                resp = self.session.post(url, json=body, timeout=self.timeout)
+                status = resp.status_code
+                if resp.status_code not in RETRY_STATUS_CODES:
+                    resp.raise_for_status()
+                    return resp.json()
+                retry_after = resp.headers.get("Retry-After")
+                error = requests.HTTPError("{} response from {}".format(resp.status_code, url), response=resp)
+            except (
+                    requests.ConnectionError,
+                    requests.Timeout,
+                    requests.exceptions.ChunkedEncodingError,
+                    requests.exceptions.ContentDecodingError,
+                    ValueError) as request_error:
+                # A connection dropped mid-body raises ChunkedEncodingError,
+                # and a body that arrives whole but cut short fails to parse
+                # as JSON, which requests 2.26 raises as a plain ValueError.
+                # Its invalid URL errors are ValueErrors too, but would fail
+                # the same way every time.
+                if isinstance(request_error, (requests.exceptions.InvalidURL, requests.exceptions.InvalidSchema, requests.exceptions.MissingSchema)):
+                    raise
+                error = request_error
+                status = type(request_error).__name__
+            finally:
+                metrics.registry.increment("compass_requests_total", location=location, status=status)
+                metrics.registry.observe(
+                    "compass_request_seconds", time.perf_counter() - request_start, location=location)
+            if attempt == self.max_retries:
+                raise error
+            metrics.registry.increment("compass_retries_total", location=location)
+            time.sleep(self.get_retry_delay_seconds(attempt, retry_after))
+
+    def query_compass(self, listing_type, locations):
+        # locs = [
+        #     {"id": 21462,
+        #      "name": "Lower East Side",
+        #      "seoId": "lower-east-side-manhattan-ny",},
+        # ]   
+        seen = self.seen if self.seen is not None else SeenSet()
+        if self.concurrency > 1 and self.stop_paging is None:
+            yield from self.query_compass_concurrently(listing_type, locations, seen)
+            return
+        if self.concurrency > 1:
+            yield from self.query_locations_concurrently(listing_type, locations, seen)
+            return
+        for bkl in locations:
+        # for bkl in locs:
+            for result in self.skip_duplicates(bkl, listing_type, self.query_bk_location(bkl, listing_type), seen):
+                yield result
+
+    def skip_duplicates(self, bk_location, listing_type, results, seen):
+        # Always run on the consuming thread, so which copy of a listing is
+        # kept (the first in location order) does not depend on concurrency.
+        location = bk_location["name"]
+        for result in results:
+            if seen.add_all(get_listing_keys(listing_type, result)):
+                yield result
+            else:
+                self.duplicate_counts[location] += 1
+                metrics.registry.increment(
+                    "compass_listings_duplicate_total", location=location, listing_type=listing_type)
+
+    def query_compass_concurrently(self, listing_type, locations, seen):
+        # Fetch the first page of every location in parallel, and fan out the
+        # remaining pages of each location as soon as its first page arrives.
+        # Listings are yielded in location order, then page order, as each
+        # page completes, and pages are followed with the same stride and
+        # stop rules as query_bk_location, so the output matches query_compass
+        # run sequentially.
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.concurrency)
+        try:
+            first_pages = [
+                executor.submit(self.fetch_first_page, executor, bkl, listing_type)
+                for bkl in locations
+            ]
+            for bkl, first_page in zip(locations, first_pages):
+                results = self.iter_prefetched_pages(executor, bkl, listing_type, first_page)
+                for result in self.skip_duplicates(bkl, listing_type, results, seen):
+                    yield result
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+    def fetch_first_page(self, executor, bk_location, listing_type):
+        # The first page and the futures of the pages after it.
+        response_json = self.fetch_search_page(bk_location, listing_type, 0, SEARCH_PAGE_SIZE)
+        results = response_json["lolResults"]
+        stride = len(results["data"])
+        if not stride:
+            return response_json, {}
+        return response_json, self.prefetch_pages(executor, bk_location, listing_type, stride, stride, results["totalItems"])
+
+    def prefetch_pages(self, executor, bk_location, listing_type, start, stride, total_items):
+        # {(start, stride): future} of the pages from start on.
+        return {
+            (page_start, stride): executor.submit(self.fetch_search_page, bk_location, listing_type, page_start, stride)
+            for page_start in range(start, total_items, stride)
+        }
+
+    def iter_prefetched_pages(self, executor, bk_location, listing_type, first_page):
+        # query_bk_location over prefetched pages. A page shorter than the
+        # ones before it, or a changed totalItems, moves the pages that follow
+        # off the prefetched offsets, in which case the rest are requested
+        # again from where the sequential pager would go next.
+        response_json, pages = first_page.result()
+        start = 0
+        try:
+            while response_json["lolResults"]["data"]:
+                total_items = response_json["lolResults"]["totalItems"]
+                stride = len(response_json["lolResults"]["data"])
+                start += stride
+
+                yield from extract_listings_from_response(response_json)
+                if start >= total_items:
+                    break
+                if (start, stride) not in pages:
+                    for page in pages.values():
+                        page.cancel()
+                    pages = self.prefetch_pages(executor, bk_location, listing_type, start, stride, total_items)
+                response_json = pages.pop((start, stride)).result()
+        finally:
+            for page in pages.values():
+                page.cancel()
+
+    def query_locations_concurrently(self, listing_type, locations, seen):
+        # Paging can stop early, so pages within a location are fetched in
+        # sequence and only locations are fetched in parallel.
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.concurrency)
+        try:
+            location_results = [
+                executor.submit(lambda bkl: list(self.query_bk_location(bkl, listing_type)), bkl)
+                for bkl in locations
+            ]
+            for bkl, results in zip(locations, location_results):
+                for result in self.skip_duplicates(bkl, listing_type, results.result(), seen):
+                    yield result
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+    def query_bk_location(self, bk_location, listing_type):
+        start = 0
+        stride = SEARCH_PAGE_SIZE
+        totalItems = -1
+        while totalItems < 0 or start < totalItems:
+            response_json = self.fetch_search_page(bk_location, listing_type, start, stride)
+            if not response_json["lolResults"]["data"]:
+                break
+
+            totalItems = response_json["lolResults"]["totalItems"]
+            stride = len(response_json["lolResults"]["data"])
+            start += stride
+
+            results = list(extract_listings_from_response(response_json))
+            stop = self.stop_paging is not None and self.stop_paging(results)
+            for result in results:
+                yield result
+            if stop:
+                break
 
-        totalItems = response_json["lolResults"]["totalItems"]
-        stride = len(response_json["lolResults"]["data"])
-        start += stride
+def query_compass(listing_type, locations, concurrency=1, rate_limiter=None):
+    with CompassClient(concurrency=concurrency, rate_limiter=rate_limiter) as client:
+        yield from client.query_compass(listing_type, locations)
 
-        for result in extract_listings_from_response(response_json):
-            yield result
+def query_bk_location(bk_location, listing_type, rate_limiter=None):
+    with CompassClient(rate_limiter=rate_limiter) as client:
+        yield from client.query_bk_location(bk_location, listing_type)
 
 def extract_unit_type(raw_type):
     # {'Condo', 'Multi Family', 'Other', 'Co-op', 'Single Family', 'Townhouse', 'Condop', 'Non-Residential', 'Land', 'Mixed Use'}
@@ -247,7 +656,11 @@ def extract_unit_type(raw_type):
         return "other"
 
 def extract_listings_from_response(response_json):
+    # Listings missing a required field are dropped, and counted in
+    # compass_listings_dropped_total.
+    extract_start = time.perf_counter()
     listing_dicts = [e["listing"] for e in response_json["lolResults"]["data"]]
+    listings = []
     for ld in listing_dicts:
         try:
             price = ld["price"]
@@ -255,7 +668,7 @@ def extract_listings_from_response(response_json):
             location = ld["location"]
             building = ld["buildingInfo"]
             details = ld["detailedInfo"]
-            yield CompassListing(
+            listings.append(CompassListing(
                 permalink=ld["canonicalPageLink"],
                 address=location["prettyAddress"],
                 neighborhood=location["neighborhood"],
@@ -281,9 +694,314 @@ def extract_listings_from_response(response_json):
                 ),
                 parking_spaces=details.get("totalParkingSpaces"),
                 amenities=json.dumps(details.get("amenities")),
-            )
-        except KeyError:
+            ))
+        except KeyError as e:
+            metrics.registry.increment("compass_listings_dropped_total", missing_field=e.args[0])
             continue
+    metrics.registry.increment("compass_listings_extracted_total", len(listings))
+    metrics.registry.increment("compass_extract_seconds_total", time.perf_counter() - extract_start)
+    yield from listings
+
+LISTING_FORMATS = ("csv", "parquet", "arrow")
+LISTING_BATCH_SIZE = 10000
+
+def get_listing_schema():
+    import pyarrow as pa
+    category = pa.dictionary(pa.int32(), pa.string())
+    return pa.schema([
+        ("permalink", pa.string()),
+        ("address", pa.string()),
+        ("neighborhood", category),
+        ("latitude", pa.float64()),
+        ("longitude", pa.float64()),
+        ("price_dollars", pa.float64()),
+        ("original_price_dollars", pa.float64()),
+        ("sq_ft", pa.float64()),
+        ("beds", pa.float64()),
+        ("baths", pa.float64()),
+        ("year_opened", pa.int32()),
+        ("building_id", pa.string()),
+        ("building_units", pa.int32()),
+        ("monthly_sales_charges", pa.float64()),
+        ("monthly_sales_charges_incl_taxes", pa.float64()),
+        ("unit_type", category),
+        ("first_listed", pa.string()),
+        ("parking_spaces", pa.int32()),
+        ("amenities", pa.list_(pa.string())),
+    ])
+
+# Missing values may arrive as None, "" or (from a DataFrame) nan.
+def to_optional_int(value):
+    value = to_float(value)
+    return None if math.isnan(value) else int(value)
+
+def to_optional_str(value):
+    return None if value is None or (isinstance(value, float) and math.isnan(value)) else str(value)
+
+def listings_to_record_batch(listings, schema):
+    import pyarrow as pa
+    columns = list(zip(*listings)) if listings else [()] * len(CompassListing._fields)
+    converters = {
+        "year_opened": to_optional_int,
+        "building_units": to_optional_int,
+        "parking_spaces": to_optional_int,
+        "building_id": to_optional_str,
+        "amenities": lambda amenities: json.loads(amenities) if isinstance(amenities, str) else amenities,
+    }
+    return pa.RecordBatch.from_arrays(
+        [
+            pa.array(
+                [converters[field.name](v) for v in column] if field.name in converters else column,
+                type=field.type,
+            )
+            for field, column in zip(schema, columns)
+        ],
+        schema=schema,
+    )
+
+def write_listings(listings, outfile, fmt="csv"):
+    # Writes CompassListings as CSV text, or as Parquet / Arrow IPC with the
+    # explicit schema from get_listing_schema (outfile must then be binary).
+    # Columnar formats are written in batches of LISTING_BATCH_SIZE rows.
+    if fmt == "csv":
+        writer = csv.writer(outfile)
+        writer.writerow(CompassListing._fields)
+        writer.writerows(listings)
+        return
+    if fmt not in LISTING_FORMATS:
+        raise ValueError("Invalid listing format: {}".format(fmt))
+
+    import pyarrow.ipc
+    import pyarrow.parquet
+    schema = get_listing_schema()
+    writer = (
+        pyarrow.parquet.ParquetWriter(outfile, schema) if fmt == "parquet" else
+        pyarrow.ipc.new_file(outfile, schema, options=pyarrow.ipc.IpcWriteOptions(compression="zstd"))
+    )
+    with writer:
+        listings = iter(listings)
+        while True:
+            batch = list(itertools.islice(listings, LISTING_BATCH_SIZE))
+            if not batch:
+                break
+            writer.write_batch(listings_to_record_batch(batch, schema))
+
+def get_listing_format(path, default="csv"):
+    ext = os.path.splitext(path)[1].lower()
+    return (
+        "parquet" if ext in (".parquet", ".pq") else
+        "arrow" if ext in (".arrow", ".feather", ".ipc") else
+        default
+    )
+
+NUMERIC_LISTING_FIELDS = (
+    "latitude",
+    "longitude",
+    "price_dollars",
+    "original_price_dollars",
+    "sq_ft",
+    "beds",
+    "baths",
+    "year_opened",
+    "building_units",
+    "monthly_sales_charges",
+    "monthly_sales_charges_incl_taxes",
+    "parking_spaces",
+)
+
+def listings_to_df(listings):
+    # CompassListings as a DataFrame typed like read_listings_df on a CSV,
+    # so that numeric fields are float even when every value is missing.
+    import pandas as pd
+    df = pd.DataFrame(list(listings), columns=CompassListing._fields)
+    for field in NUMERIC_LISTING_FIELDS:
+        df[field] = pd.to_numeric(df[field], errors="coerce").astype("float64")
+    return df
+
+def to_float(value):
+    return float("nan") if value is None or value == "" else float(value)
+
+class ListingBatch(object):
+    # Columnar accumulator of CompassListings, a fraction of the size of the
+    # namedtuples themselves: numeric fields are packed float arrays (nan
+    # where missing), repeated strings are dictionary-encoded, and amenities
+    # are parsed once into per-listing amenity codes (a flat code array with
+    # row offsets, since the amenity vocabulary is open-ended). Appended
+    # listings are buffered and packed LISTING_BATCH_SIZE at a time.
+    CATEGORICAL_FIELDS = ("neighborhood", "unit_type", "building_id", "first_listed")
+
+    def __init__(self, listings=()):
+        self.numeric = {field: array.array("d") for field in NUMERIC_LISTING_FIELDS}
+        self.codes = {field: array.array("i") for field in self.CATEGORICAL_FIELDS}
+        # Value -> code, with codes in insertion order.
+        self.categories = {field: {} for field in self.CATEGORICAL_FIELDS}
+        self.permalinks = []
+        self.addresses = []
+        self.amenity_codes = array.array("H")
+        self.amenity_offsets = array.array("I", [0])
+        self.amenities = {}
+        self.pending = []
+        self.extend(listings)
+
+    def __len__(self):
+        return len(self.permalinks) + len(self.pending)
+
+    def append(self, listing):
+        self.pending.append(listing)
+        if len(self.pending) >= LISTING_BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        pending, self.pending = self.pending, []
+        self.pack(pending)
+
+    def extend(self, listings):
+        self.flush()
+        listings = iter(listings)
+        while True:
+            chunk = list(itertools.islice(listings, LISTING_BATCH_SIZE))
+            if not chunk:
+                break
+            self.pack(chunk)
+
+    def pack(self, listings):
+        # Filled a column at a time, which is several times faster than
+        # listing by listing.
+        import numpy as np
+        columns = dict(zip(CompassListing._fields, zip(*listings)))
+        if not columns:
+            return
+        for field, values in self.numeric.items():
+            try:
+                # Converts None to nan.
+                converted = np.array(columns[field], dtype=np.float64)
+            except (TypeError, ValueError):
+                converted = np.array([to_float(value) for value in columns[field]], dtype=np.float64)
+            values.frombytes(converted.tobytes())
+        for field, codes in self.codes.items():
+            categories = self.categories[field]
+            codes.extend([
+                -1 if value is None else categories.setdefault(value, len(categories))
+                for value in columns[field]
+            ])
+        self.permalinks.extend(columns["permalink"])
+        self.addresses.extend(columns["address"])
+        amenity_codes = []
+        amenity_offsets = []
+        for amenities in columns["amenities"]:
+            if isinstance(amenities, str):
+                amenities = json.loads(amenities)
+            # Duplicates are dropped but the listing's order is kept.
+            for amenity in dict.fromkeys(amenities or ()):
+                code = self.amenities.get(amenity)
+                if code is None:
+                    code = self.amenities[amenity] = len(self.amenities)
+                amenity_codes.append(code)
+            amenity_offsets.append(len(self.amenity_codes) + len(amenity_codes))
+        self.amenity_codes.extend(amenity_codes)
+        self.amenity_offsets.extend(amenity_offsets)
+
+    def get_numeric_column(self, field):
+        # A copy, so that the batch can keep growing.
+        import numpy as np
+        self.flush()
+        return np.frombuffer(self.numeric[field], dtype=np.float64).copy()
+
+    def get_categorical_column(self, field):
+        import numpy as np
+        import pandas as pd
+        self.flush()
+        return pd.Categorical.from_codes(
+            np.frombuffer(self.codes[field], dtype=np.int32).copy(),
+            categories=list(self.categories[field]),
+        )
+
+    def iter_amenity_json(self):
+        # Matches json.dumps of each list, without encoding every name again.
+        self.flush()
+        names = [json.dumps(amenity) for amenity in self.amenities]
+        for start, stop in zip(self.amenity_offsets, self.amenity_offsets[1:]):
+            yield "[" + ", ".join([names[code] for code in self.amenity_codes[start:stop]]) + "]"
+
+    def get_amenity_counts(self):
+        # {amenity: number of listings with it}.
+        import numpy as np
+        self.flush()
+        counts = np.bincount(np.frombuffer(self.amenity_codes, dtype=np.uint16), minlength=len(self.amenities))
+        return dict(zip(self.amenities, counts.tolist()))
+
+    def get_amenity_matrix(self, vocabulary):
+        # Multi-hot CSR matrix of listings x vocabulary, as
+        # rentregress.encode_amenities builds from JSON.
+        import numpy as np
+        import scipy.sparse
+        self.flush()
+        positions = {amenity: i for i, amenity in enumerate(vocabulary)}
+        columns = np.array([positions.get(amenity, -1) for amenity in self.amenities] + [-1], dtype=np.int64)
+        columns = columns[np.frombuffer(self.amenity_codes, dtype=np.uint16).astype(np.int64)]
+        offsets = np.frombuffer(self.amenity_offsets, dtype=np.uint32).astype(np.int64)
+        rows = np.repeat(np.arange(len(self)), np.diff(offsets))
+        kept = columns >= 0
+        matrix = scipy.sparse.csr_matrix(
+            (np.ones(int(np.sum(kept)), dtype=np.uint8), (rows[kept], columns[kept])),
+            shape=(len(self), len(vocabulary)),
+        )
+        matrix.sort_indices()
+        return matrix
+
+    def iter_listings(self):
+        # The batch as CompassListings again, with amenities as JSON.
+        import numpy as np
+        self.flush()
+        numeric = {field: self.get_numeric_column(field).tolist() for field in NUMERIC_LISTING_FIELDS}
+        categorical = {}
+        for field in self.CATEGORICAL_FIELDS:
+            values = list(self.categories[field]) + [None]
+            categorical[field] = [values[code] for code in self.codes[field]]
+        for i, amenities in enumerate(self.iter_amenity_json()):
+            fields = {field: values[i] for field, values in categorical.items()}
+            fields.update((field, None if np.isnan(values[i]) else values[i]) for field, values in numeric.items())
+            yield CompassListing(
+                permalink=self.permalinks[i],
+                address=self.addresses[i],
+                amenities=amenities,
+                **fields
+            )
+
+    def to_df(self, amenities=True):
+        # Numeric columns are float64 as in listings_to_df and repeated
+        # strings are pandas categoricals. amenities=False leaves out the
+        # amenities column, which is the one part that has to be rebuilt per
+        # listing; featurize with get_amenity_matrix instead.
+        import pandas as pd
+        self.flush()
+        columns = {}
+        for field in CompassListing._fields:
+            if field == "permalink":
+                columns[field] = self.permalinks
+            elif field == "address":
+                columns[field] = self.addresses
+            elif field in self.numeric:
+                columns[field] = self.get_numeric_column(field)
+            elif field in self.codes:
+                columns[field] = self.get_categorical_column(field)
+            elif amenities:
+                columns[field] = list(self.iter_amenity_json())
+        return pd.DataFrame(columns)
+
+    def write_csv(self, outfile):
+        write_listings(self.iter_listings(), outfile, "csv")
+
+def read_listings_df(path):
+    # Reads listings written by write_listings (or a directory of Parquet
+    # files) into a DataFrame, picking the reader from the file extension.
+    import pandas as pd
+    fmt = "parquet" if os.path.isdir(path) else get_listing_format(path)
+    if fmt == "parquet":
+        return pd.read_parquet(path)
+    if fmt == "arrow":
+        return pd.read_feather(path)
+    return pd.read_csv(path)
 
 def main(argv):
     import argparse
@@ -291,20 +1009,114 @@ def main(argv):
     parser.add_argument("--sales", action="store_true")
     parser.add_argument("--long-island", action="store_true")
     parser.add_argument("--austin", action="store_true")
+    parser.add_argument("--concurrency", type=int, default=1,
+                        help="Number of search pages to fetch at once")
+    parser.add_argument("--requests-per-second", type=float, default=0.0,
+                        help="Per-host request rate limit (0 for none)")
+    parser.add_argument("--connect-timeout", type=float, default=5.0)
+    parser.add_argument("--read-timeout", type=float, default=30.0)
+    parser.add_argument("--max-retries", type=int, default=5)
+    parser.add_argument("--base-url", default=COMPASS_BASE_URL,
+                        help="Compass site to scrape, e.g. a local mockcompass server")
+    parser.add_argument("--cache-dir", help="Directory for cached raw search page responses")
+    parser.add_argument("--cache-ttl-hours", type=float, default=6.0)
+    parser.add_argument("--cache-max-mb", type=float, default=1024.0)
+    parser.add_argument("--replay", action="store_true",
+                        help="Rebuild the CSV entirely from --cache-dir without network access")
+    parser.add_argument("--store", help="SQLite listing store recording every scraped listing")
+    parser.add_argument("--incremental", action="store_true",
+                        help="Stop paging a location at the first page with no new or changed listings "
+                             "and write every listing in --store seen in the last --active-days")
+    parser.add_argument("--active-days", type=int, default=14)
+    parser.add_argument("--full-crawl-days", type=int, default=7,
+                        help="With --incremental, page through every location anyway when the last full "
+                             "crawl is this many days old, so listings past the first unchanged page stay "
+                             "active (must be less than --active-days)")
+    parser.add_argument("--seen-set",
+                        help="File of listing keys already scraped; listings in it are skipped and this "
+                             "run's are added, so split or resumed runs don't repeat listings")
+    parser.add_argument("--run-id", default=datetime.date.today().isoformat(),
+                        help="Only listings --seen-set recorded under this run are skipped (default: today)")
+    parser.add_argument("--format", choices=LISTING_FORMATS,
+                        help="Output format (default: from --output extension, else csv)")
+    parser.add_argument("--output", help="Output file (default: stdout)")
+    parser.add_argument("--metrics", help="Write run metrics to this file (.prom for Prometheus, else JSON)")
+    parser.add_argument("--profile-dir", help="Write cProfile stats for each stage to this directory")
 
     parsed = parser.parse_args(argv[1:])
+    if parsed.profile_dir:
+        metrics.registry.enable_profiling(parsed.profile_dir)
+    if parsed.replay and not parsed.cache_dir:
+        parser.error("--replay requires --cache-dir")
+    if parsed.incremental and not parsed.store:
+        parser.error("--incremental requires --store")
+    if parsed.incremental and parsed.full_crawl_days >= parsed.active_days:
+        parser.error("--full-crawl-days must be less than --active-days")
     listing_type = LISTING_TYPE_SALE if parsed.sales else LISTING_TYPE_RENTAL
     locations = LONG_ISLAND_LOCATIONS if parsed.long_island else AUSTIN_LOCATIONS if parsed.austin else BK_LOCATIONS
 
-    writer = csv.writer(sys.stdout)    
-    writer.writerow(CompassListing._fields)
-    for result in query_compass(listing_type, locations):
-        writer.writerow(result)
-    return 0
+    rate_limiter = HostRateLimiter(parsed.requests_per_second) if parsed.requests_per_second > 0 else None
 
+    cache = ResponseCache(
+        parsed.cache_dir,
+        ttl_seconds=parsed.cache_ttl_hours * 3600,
+        max_bytes=int(parsed.cache_max_mb * 1024 * 1024),
+    ) if parsed.cache_dir else None
 
-    with open("/home/jhoon/compass.json") as infile:
-        writer.writerows(extract_listings_from_response(json.load(infile)))
+    store = None
+    if parsed.store:
+        import listingstore
+        store = listingstore.ListingStore(parsed.store)
+    full_crawl = parsed.incremental and store.is_full_crawl_due(listing_type, parsed.full_crawl_days)
+
+    client = CompassClient(
+        concurrency=parsed.concurrency,
+        rate_limiter=rate_limiter,
+        cache=cache,
+        replay=parsed.replay,
+        stop_paging=(
+            (lambda listings: store.record_listings(listing_type, listings) == 0 and not full_crawl)
+            if parsed.incremental else None
+        ),
+        connect_timeout_seconds=parsed.connect_timeout,
+        read_timeout_seconds=parsed.read_timeout,
+        max_retries=parsed.max_retries,
+        base_url=parsed.base_url,
+        seen=SeenSet(parsed.seen_set, parsed.run_id) if parsed.seen_set else None,
+    )
+
+    fmt = parsed.format or (get_listing_format(parsed.output) if parsed.output else "csv")
+    outfile = (
+        open(parsed.output, "w" if fmt == "csv" else "wb") if parsed.output else
+        sys.stdout if fmt == "csv" else
+        sys.stdout.buffer
+    )
+    scraped = []
+    with client, metrics.registry.stage("scrape"):
+        results = client.query_compass(listing_type, locations)
+        if parsed.incremental:
+            for _ in results:
+                pass
+            if full_crawl:
+                store.record_full_crawl(listing_type)
+            seen_since = datetime.date.today() - datetime.timedelta(days=parsed.active_days)
+            results = skip_duplicate_listings(listing_type, store.iter_listings(listing_type, seen_since.isoformat()))
+        elif store is not None:
+            results = (scraped.append(result) or result for result in results)
+        write_listings(results, outfile, fmt)
+    if parsed.output:
+        outfile.close()
+    if client.seen is not None:
+        client.seen.save()
+    for location, count in client.duplicate_counts.most_common():
+        print("Skipped {} duplicate listings in {}".format(count, location), file=sys.stderr)
+    if store is not None:
+        with metrics.registry.stage("record"):
+            store.record_listings(listing_type, scraped)
+        store.close()
+    if parsed.metrics:
+        metrics.registry.write(parsed.metrics)
+    return 0
 
 if __name__ == "__main__":
     sys.exit(main(sys.argv))
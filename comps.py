@@ -0,0 +1,156 @@
+import warnings
+
+import numpy as np
+import scipy.spatial
+
+# Nearest-rental comps. Rentals are indexed in a KD-tree over a local
+# equirectangular projection of latitude/longitude, which is accurate to well
+# under 1% over the few miles that separate comps within a market.
+
+EARTH_RADIUS_MILES = 3958.8
+DEFAULT_COMP_COUNT = 10
+# Bedroom counts at or above this are pooled when finding same-size comps.
+MAX_COMP_BEDS = 4
+
+def to_radians(degrees):
+    return np.radians(np.asarray(degrees, dtype=np.float64))
+
+class RentalIndex(object):
+    # Spatial index over rental listings with a known location, rent and
+    # square footage, supporting radius and k-nearest queries and comp
+    # features for any frame of listings with latitude/longitude.
+    def __init__(self, latitudes, longitudes, rents, sq_fts, beds, permalinks, comp_count=DEFAULT_COMP_COUNT):
+        latitudes = np.asarray(latitudes, dtype=np.float64)
+        longitudes = np.asarray(longitudes, dtype=np.float64)
+        rents = np.asarray(rents, dtype=np.float64)
+        sq_fts = np.asarray(sq_fts, dtype=np.float64)
+        beds = np.asarray(beds, dtype=np.float64)
+        usable = np.isfinite(latitudes) & np.isfinite(longitudes) & np.isfinite(rents) & (sq_fts > 0)
+        self.latitudes = latitudes[usable]
+        self.longitudes = longitudes[usable]
+        self.rents = rents[usable]
+        self.sq_fts = sq_fts[usable]
+        self.beds = beds[usable]
+        self.permalinks = np.asarray(permalinks, dtype=object)[usable]
+        self.comp_count = comp_count
+        # Projection is centered on the rentals so distances are in miles.
+        self.origin_latitude = float(np.mean(self.latitudes)) if len(self.latitudes) else 0.0
+        self.tree = scipy.spatial.cKDTree(self.project(self.latitudes, self.longitudes))
+        bed_buckets = self.get_bed_buckets(self.beds)
+        self.bed_trees = {}
+        for bucket in np.unique(bed_buckets[bed_buckets >= 0]):
+            rows = np.flatnonzero(bed_buckets == bucket)
+            self.bed_trees[bucket] = (rows, scipy.spatial.cKDTree(self.tree.data[rows]))
+
+    @classmethod
+    def from_listings_df(cls, df, comp_count=DEFAULT_COMP_COUNT):
+        return cls(
+            df["latitude"],
+            df["longitude"],
+            df["price_dollars"],
+            df["sq_ft"],
+            df["beds"],
+            df["permalink"],
+            comp_count,
+        )
+
+    def __len__(self):
+        return len(self.rents)
+
+    def project(self, latitudes, longitudes):
+        return np.column_stack((
+            to_radians(longitudes) * np.cos(np.radians(self.origin_latitude)) * EARTH_RADIUS_MILES,
+            to_radians(latitudes) * EARTH_RADIUS_MILES,
+        ))
+
+    def get_bed_buckets(self, beds):
+        beds = np.asarray(beds, dtype=np.float64)
+        return np.where(np.isfinite(beds), np.minimum(np.nan_to_num(beds), MAX_COMP_BEDS), -1).astype(np.int64)
+
+    def query_radius(self, latitudes, longitudes, radius_miles):
+        # For each point, the index rows within radius_miles.
+        return self.tree.query_ball_point(self.project(latitudes, longitudes), radius_miles)
+
+    def query_nearest(self, latitudes, longitudes, k, tree=None):
+        # (distances in miles, index rows) of each point's k nearest rentals,
+        # padded with inf / len(index) when there are fewer than k.
+        tree = self.tree if tree is None else tree
+        points = self.project(latitudes, longitudes)
+        distances = np.full((len(points), k), np.inf)
+        rows = np.full((len(points), k), tree.n)
+        located = np.all(np.isfinite(points), axis=1)
+        if tree.n and located.any():
+            found_distances, found_rows = tree.query(points[located], k=k)
+            distances[located] = np.reshape(found_distances, (-1, k))
+            rows[located] = np.reshape(found_rows, (-1, k))
+        return distances, rows
+
+    def get_nearest_comps(self, latitudes, longitudes, permalinks, tree_rows=None, tree=None):
+        # The comp_count nearest rentals to each point, skipping a rental with
+        # the point's own permalink so that rentals are not their own comps.
+        distances, rows = self.query_nearest(latitudes, longitudes, self.comp_count + 1, tree)
+        found = rows < (tree.n if tree is not None else len(self))
+        rows = np.where(found, rows, 0)
+        if tree_rows is not None:
+            rows = tree_rows[rows]
+        is_self = found & (self.permalinks[rows] == np.asarray(permalinks, dtype=object)[:, np.newaxis])
+        # Stable sort moves each row's own listing (if any) past its comps.
+        order = np.argsort(is_self, axis=1, kind="stable")[:, :self.comp_count]
+        take = lambda values: np.take_along_axis(values, order, axis=1)
+        return take(distances), take(rows), take(found & ~is_self)
+
+    def get_comp_features(self, df):
+        # comp_rent_per_sq_ft: median rent per square foot of the nearest
+        # comp_count rentals; comp_same_beds_rent: median rent of the nearest
+        # comp_count rentals with the same bedroom count; comp_distance_miles:
+        # distance to the farthest of the former. df may be any mapping of
+        # column name to array.
+        latitudes = np.asarray(df["latitude"], dtype=np.float64)
+        longitudes = np.asarray(df["longitude"], dtype=np.float64)
+        permalinks = np.asarray(df["permalink"], dtype=object)
+        distances, rows, found = self.get_nearest_comps(latitudes, longitudes, permalinks)
+        with np.errstate(invalid="ignore"):
+            rent_per_sq_ft = np.where(found, self.rents[rows] / self.sq_fts[rows], np.nan)
+        comp_distance = np.where(found, distances, np.nan)
+
+        same_beds_rent = np.full((len(latitudes), self.comp_count), np.nan)
+        bed_buckets = self.get_bed_buckets(df["beds"])
+        for bucket, (tree_rows, tree) in self.bed_trees.items():
+            matching = np.flatnonzero(bed_buckets == bucket)
+            if not len(matching):
+                continue
+            _, bucket_rows, bucket_found = self.get_nearest_comps(
+                latitudes[matching], longitudes[matching], permalinks[matching], tree_rows, tree)
+            same_beds_rent[matching] = np.where(bucket_found, self.rents[bucket_rows], np.nan)
+
+        with warnings.catch_warnings():
+            # Rows without any comps stay nan.
+            warnings.simplefilter("ignore", category=RuntimeWarning)
+            return {
+                "comp_rent_per_sq_ft": np.nanmedian(rent_per_sq_ft, axis=1),
+                "comp_same_beds_rent": np.nanmedian(same_beds_rent, axis=1),
+                "comp_distance_miles": np.nanmax(comp_distance, axis=1),
+            }
+
+    def to_arrays(self):
+        return {
+            "latitudes": self.latitudes,
+            "longitudes": self.longitudes,
+            "rents": self.rents,
+            "sq_fts": self.sq_fts,
+            "beds": self.beds,
+            "permalinks": self.permalinks.astype(str),
+            "comp_count": np.array(self.comp_count),
+        }
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        return cls(
+            arrays["latitudes"],
+            arrays["longitudes"],
+            arrays["rents"],
+            arrays["sq_fts"],
+            arrays["beds"],
+            arrays["permalinks"],
+            int(arrays["comp_count"]),
+        )
@@ -3,17 +3,8 @@
 set -e
 
 TODAY="`date '+%Y-%m-%d'`"
+STORE="listings.db"
+METRICS_DIR="metrics"
+mkdir -p "$METRICS_DIR"
 
-python compass.py > "compass-rentals-$TODAY.csv" &
-RENTALS_PID=$!
-python compass.py --sales > "compass-sales-$TODAY.csv" &
-SALES_PID=$!
-
-wait $RENTALS_PID
-wait $SALES_PID
-
-python rentregress.py "compass-rentals-$TODAY.csv" "compass-sales-$TODAY.csv" "compass-sales-with-rents-$TODAY.csv"
-
-echo "Daily pull complete. Data available in compass-sales-with-rents-$TODAY.csv. Generated `wc -l compass-sales-with-rents-$TODAY.csv | cut -f1 -d' '` records."
-
-
+python pipeline.py --date "$TODAY" --concurrency 8 --requests-per-second 8 --store "$STORE" --incremental --model-dir rent-models --comp-count 10 --metrics "$METRICS_DIR/pipeline.prom"
@@ -1,17 +1,33 @@
 #!/usr/bin/env python
 
 import collections
+import concurrent.futures
 import csv
+import functools
+import itertools
 import numpy as np
-import numpy_financial as npf
 import pandas as pd
+
+import metrics
 import pdb
 import re
 import sys
+import time
+import warnings
 
 UnleveredReturn = collections.namedtuple(
     "UnleveredReturn",
-    ('irr_pct', 'gross_sale_price_dollars', 'moic_pct', 'equity_dollars', 'profit_dollars', 'gross_sale_price_sq_ft_dollars'),
+    (
+        'irr_pct',
+        'gross_sale_price_dollars',
+        'moic_pct',
+        'equity_dollars',
+        'profit_dollars',
+        'gross_sale_price_sq_ft_dollars',
+        # How many IRRs the cash flows have: irr_pct is nan with none, and the
+        # one closest to zero with several.
+        'irr_root_count',
+    ),
 )
 
 Listing = collections.namedtuple(
@@ -58,109 +74,863 @@ def get_unlevered_returns(
         hold_period_months,
         exit_cap_pct,
         exit_sq_ft_price_ceiling_dollars,
-        exit_costs_pct):
-
-
-    modeled_month_count = hold_period_months * 2
-    columns = (
-        "rent",
-        "vacancy",
-        "utilities",
-        "monthly_taxes",
-        "common_charges",
-        "homeowners_insurance",
-        "noi",
-        "capital_reserve",
-        "free_cash_flow",
-        "total_purchase_price",
-        "net_sales_proceeds",
-        "unlevered_cash_flow",
+        exit_costs_pct,
+        # Also limits the gross sales price, as a multiple of purchase price
+        exit_purchase_price_ceiling_multiple=np.inf,
+        # The capital reserve is multiplied by this at or above this price
+        capital_reserve_price_threshold_dollars=np.inf,
+        capital_reserve_price_multiple=1.0,
+        return_cash_flows=False):
+    # Single-listing view of get_unlevered_returns_batch. Pass
+    # return_cash_flows=True to also get the monthly cash-flow schedule as a
+    # DataFrame for debugging.
+    start = time.perf_counter()
+    lines, gross_sales_price, hold_period_months = get_unlevered_cash_flows_batch(
+        purchase_price_dollars=purchase_price_dollars,
+        sq_ft=sq_ft,
+        closing_costs_pct=closing_costs_pct,
+        initial_downtime_months=initial_downtime_months,
+        interim_downtime_months=interim_downtime_months,
+        lease_length_months=lease_length_months,
+        annual_rent_growth_pct=annual_rent_growth_pct,
+        annual_expense_growth_pct=annual_expense_growth_pct,
+        monthly_rent_dollars=monthly_rent_dollars,
+        monthly_utilities_rent_pct=monthly_utilities_rent_pct,
+        monthly_tax_dollars=monthly_tax_dollars,
+        monthly_common_charges_dollars=monthly_common_charges_dollars,
+        monthly_homeowners_insurance_dollars=monthly_homeowners_insurance_dollars,
+        monthly_capital_reserve_dollars=monthly_capital_reserve_dollars,
+        hold_period_months=hold_period_months,
+        exit_cap_pct=exit_cap_pct,
+        exit_sq_ft_price_ceiling_dollars=exit_sq_ft_price_ceiling_dollars,
+        exit_costs_pct=exit_costs_pct,
+        exit_purchase_price_ceiling_multiple=exit_purchase_price_ceiling_multiple,
+        capital_reserve_price_threshold_dollars=capital_reserve_price_threshold_dollars,
+        capital_reserve_price_multiple=capital_reserve_price_multiple,
+    )
+    held_cash_flows = lines["unlevered_cash_flow"][:, :hold_period_months[0] + 1]
+    irr = irr_batch(held_cash_flows)
+
+    equity = -np.sum(held_cash_flows[held_cash_flows < 0])
+    profit = np.sum(held_cash_flows)
+    ret = UnleveredReturn(
+        irr_pct=(1.0 + irr.rate[0])**12 - 1,
+        gross_sale_price_dollars=gross_sales_price[0],
+        equity_dollars=equity,
+        profit_dollars=profit,
+        moic_pct=1 + profit/float(equity),
+        gross_sale_price_sq_ft_dollars=gross_sales_price[0]/float(sq_ft),
+        irr_root_count=irr.root_count[0],
     )
+    record_dcf_calls(1, time.perf_counter() - start)
+    if not return_cash_flows:
+        return ret
+
     start_date_str = "2021-01-01"
-    months = np.arange(0, modeled_month_count, 1, dtype=np.int64)
-    index = pd.period_range(start_date_str, freq='M', periods=modeled_month_count)
     df = pd.DataFrame(
-        columns=columns,
-        index=index,
-        dtype=np.float64,        
+        {col: lines[col][0] for col in CASH_FLOW_COLUMNS},
+        index=pd.period_range(start_date_str, freq='M', periods=lines["rent"].shape[1]),
     )
-    expense_growth = np.power(1.0 + annual_expense_growth_pct, months // 12)
-    df.loc[:, "rent"] = (
-        monthly_rent_dollars *
-        np.power(1.0 + annual_rent_growth_pct, months // 12)
+    return ret, df
+
+IrrSolution = collections.namedtuple("IrrSolution", ("rate", "root_count"))
+
+# Periodic rates scanned for NPV sign changes before polishing each root;
+# evenly spaced in log(1 + rate) from -90% to +1000% per period.
+IRR_SCAN_RATES = np.expm1(np.linspace(np.log(0.1), np.log(11.0), 129))
+
+@functools.lru_cache(maxsize=None)
+def get_irr_scan_discounts(period_count):
+    discounts = np.power(1.0 + IRR_SCAN_RATES[:, np.newaxis], -np.arange(period_count, dtype=np.float64)).T
+    discounts.flags.writeable = False
+    return discounts
+
+def irr_batch(cash_flows, tol=1e-12, max_iter=50):
+    # Solve the periodic IRR of every row of a 2-D array of cash flows at once.
+    # Roots are bracketed by scanning NPV over IRR_SCAN_RATES, then polished
+    # with Halley steps that fall back to bisection whenever a step leaves the
+    # bracket. Like npf.irr, the root closest to zero is returned when there
+    # is more than one. root_count is the number of sign changes found by the
+    # scan: 0 means no IRR (rate is nan), > 1 means the IRR is ambiguous.
+    cash_flows = np.atleast_2d(np.asarray(cash_flows, dtype=np.float64))
+    periods = np.arange(cash_flows.shape[1], dtype=np.float64)
+    row_count = cash_flows.shape[0]
+    rows = np.arange(row_count)
+
+    npv_scan = cash_flows @ get_irr_scan_discounts(cash_flows.shape[1])
+    positive = npv_scan >= 0
+    crossings = positive[:, 1:] != positive[:, :-1]
+    root_count = np.sum(crossings, axis=1)
+
+    scan_midpoints = np.abs(np.log1p(IRR_SCAN_RATES[:-1]) + np.log1p(IRR_SCAN_RATES[1:]))
+    bracket = np.argmin(np.where(crossings, scan_midpoints, np.inf), axis=1)
+    lo = IRR_SCAN_RATES[bracket]
+    hi = IRR_SCAN_RATES[bracket + 1]
+    npv_lo = npv_scan[rows, bracket]
+    npv_hi = npv_scan[rows, bracket + 1]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        rate = np.where(npv_hi != npv_lo, lo - npv_lo * (hi - lo) / (npv_hi - npv_lo), lo)
+
+    # Only rows that have not converged are re-evaluated on each iteration.
+    # Discount factors are built by cumulative product rather than np.power,
+    # and the derivative sums are matrix-vector products.
+    first_derivative_weights = periods
+    second_derivative_weights = periods * (periods + 1)
+    active_rows = np.flatnonzero(root_count > 0)
+    for _ in range(max_iter):
+        if not len(active_rows):
+            break
+        r = rate[active_rows]
+        lo_a = lo[active_rows]
+        hi_a = hi[active_rows]
+        npv_lo_a = npv_lo[active_rows]
+        discount = 1.0 / (1.0 + r)
+        discounts = np.empty((len(active_rows), len(periods)))
+        discounts[:, 0] = 1.0
+        np.cumprod(np.broadcast_to(discount[:, np.newaxis], (len(active_rows), len(periods) - 1)), axis=1, out=discounts[:, 1:])
+        discounted = cash_flows[active_rows] * discounts
+        npv = np.sum(discounted, axis=1)
+        d_npv = -(discounted @ first_derivative_weights) * discount
+        d2_npv = (discounted @ second_derivative_weights) * discount**2
+
+        same_sign_as_lo = (npv >= 0) == (npv_lo_a >= 0)
+        lo_a = np.where(same_sign_as_lo, r, lo_a)
+        npv_lo_a = np.where(same_sign_as_lo, npv, npv_lo_a)
+        hi_a = np.where(same_sign_as_lo, hi_a, r)
+
+        with np.errstate(divide="ignore", invalid="ignore", over="ignore"):
+            step = -2.0 * npv * d_npv / (2.0 * d_npv**2 - npv * d2_npv)
+        next_rate = r + step
+        in_bracket = np.isfinite(next_rate) & (next_rate >= np.minimum(lo_a, hi_a)) & (next_rate <= np.maximum(lo_a, hi_a))
+        converged = (in_bracket & (np.abs(step) <= tol * (1.0 + np.abs(r)))) | (npv == 0)
+
+        rate[active_rows] = np.where(in_bracket, next_rate, (lo_a + hi_a) / 2.0)
+        lo[active_rows] = lo_a
+        hi[active_rows] = hi_a
+        npv_lo[active_rows] = npv_lo_a
+        active_rows = active_rows[~converged]
+
+    return IrrSolution(
+        rate=np.where(root_count > 0, rate, np.nan),
+        root_count=root_count,
     )
-    # TODO: add interim vacancy
-    df.loc[:, "vacancy"] = (
-        -monthly_rent_dollars *
-        np.logical_or(months // initial_downtime_months == 0, False)
+
+CASH_FLOW_COLUMNS = (
+    "rent",
+    "vacancy",
+    "utilities",
+    "monthly_taxes",
+    "common_charges",
+    "homeowners_insurance",
+    "noi",
+    "capital_reserve",
+    "free_cash_flow",
+    "total_purchase_price",
+    "net_sales_proceeds",
+    "unlevered_cash_flow",
+)
+
+def as_listing_columns(*arrays):
+    # Broadcast scalars/arrays of per-listing inputs to float column vectors.
+    return [
+        a[:, np.newaxis] for a in np.broadcast_arrays(
+            *(np.atleast_1d(np.asarray(a, dtype=np.float64)) for a in arrays)
+        )
+    ]
+
+def get_vacant_months(months, initial_downtime_months, interim_downtime_months, lease_length_months):
+    # 1 in the months with no tenant: the initial downtime, then
+    # interim_downtime_months between each lease of lease_length_months.
+    lease_cycle_months = np.maximum(lease_length_months + interim_downtime_months, 1)
+    return (
+        (months < initial_downtime_months) |
+        ((months - initial_downtime_months) % lease_cycle_months >= lease_length_months)
     )
-    df.loc[:, "utilities"] = (
-        -monthly_utilities_rent_pct * monthly_rent_dollars *
-        expense_growth
+
+def get_growth_factors(annual_growth_pct, month_count):
+    # Growth is compounded once per year, then spread over that year's months.
+    years = np.arange(0, (month_count + 11) // 12, 1, dtype=np.int64)
+    return np.power(1.0 + annual_growth_pct, years)[:, np.arange(month_count) // 12]
+
+def get_exit_price_ceiling(
+        sq_ft,
+        exit_sq_ft_price_ceiling_dollars,
+        purchase_price_dollars,
+        exit_purchase_price_ceiling_multiple):
+    # The most a listing can sell for: the price-per-square-foot ceiling
+    # (unless sq_ft is unknown) and the multiple of purchase price, whichever
+    # is lower. Either ceiling is ignored where it is inf.
+    with np.errstate(invalid="ignore"):
+        sq_ft_price_ceiling = exit_sq_ft_price_ceiling_dollars * sq_ft
+        purchase_price_ceiling = exit_purchase_price_ceiling_multiple * purchase_price_dollars
+    return np.minimum(
+        np.where(
+            np.isnan(sq_ft) | np.isinf(exit_sq_ft_price_ceiling_dollars),
+            np.finfo(float).max,
+            sq_ft_price_ceiling,
+        ),
+        np.where(
+            np.isinf(exit_purchase_price_ceiling_multiple),
+            np.finfo(float).max,
+            purchase_price_ceiling,
+        ),
     )
-    df.loc[:, "monthly_taxes"] = -monthly_tax_dollars * expense_growth
-    df.loc[:, "common_charges"] = (
-        -monthly_common_charges_dollars *
-        expense_growth
+
+def get_capital_reserve(
+        monthly_capital_reserve_dollars,
+        purchase_price_dollars,
+        capital_reserve_price_threshold_dollars,
+        capital_reserve_price_multiple):
+    # Pricier units set aside more: the reserve is scaled by
+    # capital_reserve_price_multiple at or above the threshold price.
+    return monthly_capital_reserve_dollars * np.where(
+        purchase_price_dollars >= capital_reserve_price_threshold_dollars, capital_reserve_price_multiple, 1.0)
+
+def get_gross_sales_price(noi, months, hold_period_months, exit_price_ceiling, exit_cap_pct):
+    # Forward 12 months of NOI after exit capped at exit_cap_pct, truncated to
+    # each listing's own modeled window of 2 * hold_period_months and limited
+    # by the exit price ceiling.
+    forward_noi_window = (
+        (months > hold_period_months) &
+        (months <= hold_period_months + 12) &
+        (months < hold_period_months * 2)
     )
-    df.loc[:, "homeowners_insurance"] = (
-        -monthly_homeowners_insurance_dollars *
-        expense_growth
+    forward_noi = np.sum(noi * forward_noi_window, axis=1, keepdims=True)
+    return np.minimum(exit_price_ceiling, forward_noi / exit_cap_pct)
+
+def get_unlevered_cash_flows_batch(
+        purchase_price_dollars,
+        sq_ft,
+        closing_costs_pct,
+        initial_downtime_months,
+        interim_downtime_months,
+        lease_length_months,
+        annual_rent_growth_pct,
+        annual_expense_growth_pct,
+        monthly_rent_dollars,
+        monthly_utilities_rent_pct,
+        monthly_tax_dollars,
+        monthly_common_charges_dollars,
+        monthly_homeowners_insurance_dollars,
+        monthly_capital_reserve_dollars,
+        hold_period_months,
+        exit_cap_pct,
+        exit_sq_ft_price_ceiling_dollars,
+        exit_costs_pct,
+        exit_purchase_price_ceiling_multiple=np.inf,
+        capital_reserve_price_threshold_dollars=np.inf,
+        capital_reserve_price_multiple=1.0):
+    # Same model as get_unlevered_returns, but every argument may be an array
+    # (or scalar broadcast) over listings. Returns a dict mapping each of
+    # CASH_FLOW_COLUMNS to a listings x months matrix, the gross sale price per
+    # listing and the hold period (exit month index) per listing.
+    (
+        purchase_price_dollars,
+        sq_ft,
+        closing_costs_pct,
+        initial_downtime_months,
+        interim_downtime_months,
+        lease_length_months,
+        annual_rent_growth_pct,
+        annual_expense_growth_pct,
+        monthly_rent_dollars,
+        monthly_utilities_rent_pct,
+        monthly_tax_dollars,
+        monthly_common_charges_dollars,
+        monthly_homeowners_insurance_dollars,
+        monthly_capital_reserve_dollars,
+        hold_period_months,
+        exit_cap_pct,
+        exit_sq_ft_price_ceiling_dollars,
+        exit_costs_pct,
+        exit_purchase_price_ceiling_multiple,
+        capital_reserve_price_threshold_dollars,
+        capital_reserve_price_multiple,
+    ) = as_listing_columns(
+        purchase_price_dollars,
+        sq_ft,
+        closing_costs_pct,
+        initial_downtime_months,
+        interim_downtime_months,
+        lease_length_months,
+        annual_rent_growth_pct,
+        annual_expense_growth_pct,
+        monthly_rent_dollars,
+        monthly_utilities_rent_pct,
+        monthly_tax_dollars,
+        monthly_common_charges_dollars,
+        monthly_homeowners_insurance_dollars,
+        monthly_capital_reserve_dollars,
+        hold_period_months,
+        exit_cap_pct,
+        exit_sq_ft_price_ceiling_dollars,
+        exit_costs_pct,
+        exit_purchase_price_ceiling_multiple,
+        capital_reserve_price_threshold_dollars,
+        capital_reserve_price_multiple,
     )
-    df.loc[:, "noi"] = np.sum(
-        [
-            df.loc[:, col]  for col in
-            (
-                "rent",
-                "vacancy",
-                "utilities",
-                "monthly_taxes",
-                "common_charges",
-                "homeowners_insurance",
-            )
-        ],
-        axis=0,
-        dtype=np.float64
+    hold_period_months = hold_period_months.astype(np.int64)
+
+    modeled_month_count = int(np.max(hold_period_months)) * 2
+    months = np.arange(0, modeled_month_count, 1, dtype=np.int64)[np.newaxis, :]
+    expense_growth = get_growth_factors(annual_expense_growth_pct, modeled_month_count)
+
+    lines = {}
+    lines["rent"] = monthly_rent_dollars * get_growth_factors(annual_rent_growth_pct, modeled_month_count)
+    lines["vacancy"] = -monthly_rent_dollars * get_vacant_months(
+        months, initial_downtime_months, interim_downtime_months, lease_length_months)
+    lines["utilities"] = -monthly_utilities_rent_pct * monthly_rent_dollars * expense_growth
+    lines["monthly_taxes"] = -monthly_tax_dollars * expense_growth
+    lines["common_charges"] = -monthly_common_charges_dollars * expense_growth
+    lines["homeowners_insurance"] = -monthly_homeowners_insurance_dollars * expense_growth
+    lines["noi"] = (
+        lines["rent"] +
+        lines["vacancy"] +
+        lines["utilities"] +
+        lines["monthly_taxes"] +
+        lines["common_charges"] +
+        lines["homeowners_insurance"]
     )
-    df.loc[:, "capital_reserve"] = (
-        -monthly_capital_reserve_dollars *
-        expense_growth
+    lines["capital_reserve"] = -get_capital_reserve(
+        monthly_capital_reserve_dollars,
+        purchase_price_dollars,
+        capital_reserve_price_threshold_dollars,
+        capital_reserve_price_multiple,
+    ) * expense_growth
+    lines["free_cash_flow"] = lines["noi"] + lines["capital_reserve"]
+    lines["total_purchase_price"] = np.where(
+        months == 0,
+        -purchase_price_dollars * (1.0 + closing_costs_pct),
+        0.0,
     )
-    df.loc[:, "free_cash_flow"] = np.sum(
-        [df.loc[:, "noi"], df.loc[:, "capital_reserve"]],
-        axis=0,
+
+    gross_sales_price = get_gross_sales_price(
+        lines["noi"],
+        months,
+        hold_period_months,
+        get_exit_price_ceiling(
+            sq_ft,
+            exit_sq_ft_price_ceiling_dollars,
+            purchase_price_dollars,
+            exit_purchase_price_ceiling_multiple,
+        ),
+        exit_cap_pct,
     )
-    df.loc[:, "total_purchase_price"] = np.zeros(months.shape, dtype=np.float64)
-    df.loc[pd.Period(start_date_str, freq='M'), "total_purchase_price"] = (
-        -purchase_price_dollars * (1.0 + closing_costs_pct)
+    net_sales_proceeds = gross_sales_price * (1.0 - exit_costs_pct)
+    assert not np.any(np.isnan(net_sales_proceeds)), "Failed to compute net sales proceeds"
+    lines["net_sales_proceeds"] = np.where(months == hold_period_months, net_sales_proceeds, 0.0)
+
+    lines["unlevered_cash_flow"] = (
+        lines["free_cash_flow"] +
+        lines["total_purchase_price"] +
+        lines["net_sales_proceeds"]
     )
-    df.loc[:, "net_sales_proceeds"] = np.zeros(months.shape, dtype=np.float64)
+    return lines, gross_sales_price[:, 0], hold_period_months[:, 0]
 
-    end_date = pd.Period(start_date_str, freq='M') + pd.offsets.MonthEnd(hold_period_months)
-    gross_sales_price = np.min((
-        np.finfo(float).max if np.isnan(sq_ft) else float(exit_sq_ft_price_ceiling_dollars * sq_ft),
-        np.sum(df.loc[end_date + pd.offsets.MonthEnd(1) : end_date + pd.offsets.MonthEnd(12), "noi"]) / exit_cap_pct,
+CashFlowDecomposition = collections.namedtuple(
+    "CashFlowDecomposition",
+    (
+        # Per schedule (downtime, growth, utilities and hold period): the
+        # multipliers of monthly rent and of monthly expenses in each held
+        # month's cash flow, and the same summed over the forward NOI window.
+        # There is either one schedule shared by every listing or one each,
+        # so these broadcast against the per-listing fields.
+        "rent_basis",
+        "expense_basis",
+        "forward_rent_basis",
+        "forward_expense_basis",
+        # Per listing: the inputs the cash flows are linear in (or, through
+        # the exit price, piecewise linear in).
+        "hold_period_months",
+        "purchase_price_dollars",
+        "closing_costs_pct",
+        "monthly_rent_dollars",
+        "monthly_tax_dollars",
+        "monthly_common_charges_dollars",
+        "monthly_homeowners_insurance_dollars",
+        "monthly_capital_reserve_dollars",
+        "sq_ft",
+        "exit_sq_ft_price_ceiling_dollars",
+        "exit_cap_pct",
+        "exit_costs_pct",
+        "exit_purchase_price_ceiling_multiple",
+        "capital_reserve_price_threshold_dollars",
+        "capital_reserve_price_multiple",
+    ),
+)
+
+# Inputs that reprice_decomposition can change without rebuilding schedules.
+REPRICE_FIELDS = CashFlowDecomposition._fields[CashFlowDecomposition._fields.index("purchase_price_dollars"):]
+
+def decompose_cash_flows_batch(
+        purchase_price_dollars,
+        sq_ft,
+        closing_costs_pct,
+        initial_downtime_months,
+        interim_downtime_months,
+        lease_length_months,
+        annual_rent_growth_pct,
+        annual_expense_growth_pct,
+        monthly_rent_dollars,
+        monthly_utilities_rent_pct,
+        monthly_tax_dollars,
+        monthly_common_charges_dollars,
+        monthly_homeowners_insurance_dollars,
+        monthly_capital_reserve_dollars,
+        hold_period_months,
+        exit_cap_pct,
+        exit_sq_ft_price_ceiling_dollars,
+        exit_costs_pct,
+        exit_purchase_price_ceiling_multiple=np.inf,
+        capital_reserve_price_threshold_dollars=np.inf,
+        capital_reserve_price_multiple=1.0):
+    # Splits the held cash flows of get_unlevered_returns_batch into monthly
+    # schedules that depend only on the growth, downtime, utilities and hold
+    # assumptions, and per-listing dollar amounts that scale them. Each
+    # held month's cash flow is
+    #
+    #   rent * rent_basis - (taxes + charges + insurance + reserve) * expense_basis
+    #
+    # less the purchase price and closing costs in month 0, plus the net sale
+    # proceeds in the exit month, which are linear in rent and expenses up to
+    # the exit price ceiling.
+    (
+        purchase_price_dollars,
+        sq_ft,
+        closing_costs_pct,
+        initial_downtime_months,
+        interim_downtime_months,
+        lease_length_months,
+        annual_rent_growth_pct,
+        annual_expense_growth_pct,
+        monthly_rent_dollars,
+        monthly_utilities_rent_pct,
+        monthly_tax_dollars,
+        monthly_common_charges_dollars,
+        monthly_homeowners_insurance_dollars,
+        monthly_capital_reserve_dollars,
+        hold_period_months,
+        exit_cap_pct,
+        exit_sq_ft_price_ceiling_dollars,
+        exit_costs_pct,
+        exit_purchase_price_ceiling_multiple,
+        capital_reserve_price_threshold_dollars,
+        capital_reserve_price_multiple,
+    ) = (column[:, 0] for column in as_listing_columns(
+        purchase_price_dollars,
+        sq_ft,
+        closing_costs_pct,
+        initial_downtime_months,
+        interim_downtime_months,
+        lease_length_months,
+        annual_rent_growth_pct,
+        annual_expense_growth_pct,
+        monthly_rent_dollars,
+        monthly_utilities_rent_pct,
+        monthly_tax_dollars,
+        monthly_common_charges_dollars,
+        monthly_homeowners_insurance_dollars,
+        monthly_capital_reserve_dollars,
+        hold_period_months,
+        exit_cap_pct,
+        exit_sq_ft_price_ceiling_dollars,
+        exit_costs_pct,
+        exit_purchase_price_ceiling_multiple,
+        capital_reserve_price_threshold_dollars,
+        capital_reserve_price_multiple,
     ))
-    net_sales_proceeds = gross_sales_price * (1.0 - exit_costs_pct)
-    assert not np.isnan(net_sales_proceeds), "Failed to compute net sales proceeds"
-    df.loc[end_date, "net_sales_proceeds"] = net_sales_proceeds
+    hold_period_months = hold_period_months.astype(np.int64)
+    schedules = np.column_stack((
+        initial_downtime_months,
+        interim_downtime_months,
+        lease_length_months,
+        annual_rent_growth_pct,
+        annual_expense_growth_pct,
+        monthly_utilities_rent_pct,
+        hold_period_months,
+    ))
+    # Scored listings share one schedule, which is then built only once.
+    # Otherwise (as for sensitivity and simulation runs) every listing gets
+    # its own, as sorting out the distinct ones costs more than it saves.
+    if np.all(schedules == schedules[:1]):
+        schedules = schedules[:1]
+    (
+        downtime_months,
+        interim_months,
+        lease_months,
+        rent_growth_pct,
+        expense_growth_pct,
+        utilities_rent_pct,
+        schedule_hold_months,
+    ) = (
+        schedules[:, i, np.newaxis] for i in range(schedules.shape[1])
+    )
+    max_hold_period_months = int(np.max(hold_period_months))
 
-    df.loc[:, "unlevered_cash_flow"] = np.sum(
-        [df.loc[:, c] for c in ("free_cash_flow", "total_purchase_price", "net_sales_proceeds")],
-        axis=0,
+    month_count = max_hold_period_months + 13
+    months = np.arange(0, month_count, 1, dtype=np.int64)[np.newaxis, :]
+    expense_growth = get_growth_factors(expense_growth_pct, month_count)
+    rent_noi = (
+        get_growth_factors(rent_growth_pct, month_count) -
+        get_vacant_months(months, downtime_months, interim_months, lease_months) -
+        utilities_rent_pct * expense_growth
     )
-    irr = (1.0 + npf.irr(df.loc[:end_date, "unlevered_cash_flow"]))**12 - 1
-        
-    equity = -np.sum(df.loc[:end_date, "unlevered_cash_flow"][df.loc[:end_date, "unlevered_cash_flow"] < 0])
-    profit = np.sum(df.loc[:end_date, "unlevered_cash_flow"])
-    return UnleveredReturn(
-        irr_pct=irr,
-        gross_sale_price_dollars=gross_sales_price,
-        equity_dollars=equity,
-        profit_dollars=profit,
-        moic_pct=1 + profit/float(equity),
-        gross_sale_price_sq_ft_dollars=gross_sales_price/float(sq_ft),
+    # Forward 12 months of NOI after exit, truncated to each schedule's own
+    # modeled window of 2 * hold_period_months.
+    forward_noi_window = (
+        (months > schedule_hold_months) &
+        (months <= schedule_hold_months + 12) &
+        (months < schedule_hold_months * 2)
+    )
+    held = months[:, :max_hold_period_months + 1] <= schedule_hold_months
+    return CashFlowDecomposition(
+        rent_basis=np.where(held, rent_noi[:, :max_hold_period_months + 1], 0.0),
+        expense_basis=np.where(held, expense_growth[:, :max_hold_period_months + 1], 0.0),
+        forward_rent_basis=np.sum(rent_noi * forward_noi_window, axis=1),
+        forward_expense_basis=np.sum(expense_growth * forward_noi_window, axis=1),
+        hold_period_months=hold_period_months,
+        purchase_price_dollars=purchase_price_dollars,
+        closing_costs_pct=closing_costs_pct,
+        monthly_rent_dollars=monthly_rent_dollars,
+        monthly_tax_dollars=monthly_tax_dollars,
+        monthly_common_charges_dollars=monthly_common_charges_dollars,
+        monthly_homeowners_insurance_dollars=monthly_homeowners_insurance_dollars,
+        monthly_capital_reserve_dollars=monthly_capital_reserve_dollars,
+        sq_ft=sq_ft,
+        exit_sq_ft_price_ceiling_dollars=exit_sq_ft_price_ceiling_dollars,
+        exit_cap_pct=exit_cap_pct,
+        exit_costs_pct=exit_costs_pct,
+        exit_purchase_price_ceiling_multiple=exit_purchase_price_ceiling_multiple,
+        capital_reserve_price_threshold_dollars=capital_reserve_price_threshold_dollars,
+        capital_reserve_price_multiple=capital_reserve_price_multiple,
+    )
+
+def reprice_decomposition(decomposition, **changes):
+    # The decomposition with new values (scalars or arrays over its listings)
+    # for any of REPRICE_FIELDS, such as a cut price or a re-predicted rent.
+    # The exit ceiling and capital reserve follow a new purchase price
+    # through their price-dependent terms. Other inputs move the monthly
+    # schedules, so changing them means calling decompose_cash_flows_batch
+    # again.
+    unknown = set(changes) - set(REPRICE_FIELDS)
+    if unknown:
+        raise ValueError("Can't reprice {}; decompose the cash flows again".format(", ".join(sorted(unknown))))
+    shape = decomposition.hold_period_months.shape
+    return decomposition._replace(**{
+        name: np.array(np.broadcast_to(np.asarray(value, dtype=np.float64), shape))
+        for name, value in changes.items()
+    })
+
+def take_decomposition(decomposition, listings):
+    # The decomposition of just the listings at the given positions.
+    listing_count = len(decomposition.hold_period_months)
+    return decomposition._replace(**{
+        name: value[listings] if len(value) == listing_count else value
+        for name, value in decomposition._asdict().items()
+    })
+
+def get_decomposed_cash_flows(decomposition):
+    # (held cash flows, gross sale price) of every listing, recomposed from
+    # schedules and inputs: the cash flows from purchase through each
+    # listing's exit month, zero afterwards.
+    d = decomposition
+    operating_expenses = d.monthly_tax_dollars + d.monthly_common_charges_dollars + d.monthly_homeowners_insurance_dollars
+    forward_noi = (
+        d.monthly_rent_dollars * d.forward_rent_basis -
+        operating_expenses * d.forward_expense_basis
+    )
+    # Forward NOI capped at exit_cap_pct, limited by the exit price ceiling.
+    gross_sales_price = np.minimum(
+        get_exit_price_ceiling(
+            d.sq_ft,
+            d.exit_sq_ft_price_ceiling_dollars,
+            d.purchase_price_dollars,
+            d.exit_purchase_price_ceiling_multiple,
+        ),
+        forward_noi / d.exit_cap_pct,
+    )
+    net_sales_proceeds = gross_sales_price * (1.0 - d.exit_costs_pct)
+    assert not np.any(np.isnan(net_sales_proceeds)), "Failed to compute net sales proceeds"
+
+    capital_reserve = get_capital_reserve(
+        d.monthly_capital_reserve_dollars,
+        d.purchase_price_dollars,
+        d.capital_reserve_price_threshold_dollars,
+        d.capital_reserve_price_multiple,
+    )
+    held_cash_flows = (
+        d.monthly_rent_dollars[:, np.newaxis] * d.rent_basis -
+        (operating_expenses + capital_reserve)[:, np.newaxis] * d.expense_basis
+    )
+    held_cash_flows[:, 0] -= d.purchase_price_dollars * (1.0 + d.closing_costs_pct)
+    held_cash_flows[np.arange(len(held_cash_flows)), d.hold_period_months] += net_sales_proceeds
+    return held_cash_flows, gross_sales_price
+
+def get_held_cash_flows_batch(**kwargs):
+    # The unlevered cash flows from purchase through each listing's exit month
+    # (zero afterwards), the gross sale price and the hold period of each
+    # listing, which is all get_unlevered_returns_batch needs. Unlike
+    # get_unlevered_cash_flows_batch this only models the months up to the end
+    # of the forward NOI window and never materializes individual line items.
+    decomposition = decompose_cash_flows_batch(**kwargs)
+    held_cash_flows, gross_sales_price = get_decomposed_cash_flows(decomposition)
+    return held_cash_flows, gross_sales_price, decomposition.hold_period_months
+
+def get_irrs_by_hold_period(held_cash_flows, hold_period_months):
+    # IrrSolution of annualized IRRs, solving each distinct hold period
+    # separately so that short holds are not padded out to the longest one.
+    irr = np.empty(len(held_cash_flows))
+    root_count = np.empty(len(held_cash_flows), dtype=np.int64)
+    for hold in np.unique(hold_period_months):
+        rows = hold_period_months == hold
+        irr[rows], root_count[rows] = irr_batch(held_cash_flows[rows, :hold + 1])
+    return IrrSolution(rate=(1.0 + irr)**12 - 1, root_count=root_count)
+
+def record_dcf_calls(listing_count, seconds):
+    metrics.registry.increment("dcf_listings_total", listing_count)
+    metrics.registry.increment("dcf_seconds_total", seconds)
+    metrics.registry.set_gauge(
+        "dcf_listings_per_second",
+        metrics.registry.get("dcf_listings_total") / max(metrics.registry.get("dcf_seconds_total"), 1e-9),
+    )
+
+def get_decomposed_returns_batch(decomposition, start=None):
+    # UnleveredReturn of every listing in a decomposition. start is when the
+    # caller began building it, if that should count towards the dcf metrics.
+    start = time.perf_counter() if start is None else start
+    held_cash_flows, gross_sales_price = get_decomposed_cash_flows(decomposition)
+    irr = get_irrs_by_hold_period(held_cash_flows, decomposition.hold_period_months)
+
+    equity = -np.sum(np.minimum(held_cash_flows, 0.0), axis=1)
+    profit = np.sum(held_cash_flows, axis=1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        ret = UnleveredReturn(
+            irr_pct=irr.rate,
+            gross_sale_price_dollars=gross_sales_price,
+            equity_dollars=equity,
+            profit_dollars=profit,
+            moic_pct=1 + profit/equity,
+            gross_sale_price_sq_ft_dollars=gross_sales_price/decomposition.sq_ft,
+            irr_root_count=irr.root_count,
+        )
+    record_dcf_calls(len(held_cash_flows), time.perf_counter() - start)
+    return ret
+
+def get_unlevered_returns_batch(**kwargs):
+    # Batched get_unlevered_returns: takes the same keyword arguments as arrays
+    # over listings and returns an UnleveredReturn whose fields are arrays.
+    start = time.perf_counter()
+    return get_decomposed_returns_batch(decompose_cash_flows_batch(**kwargs), start)
+
+def reprice_batch(decomposition, **changes):
+    # UnleveredReturn of every listing in a decomposition after changing some
+    # of REPRICE_FIELDS, without rebuilding the monthly schedules; only the
+    # IRRs are solved again.
+    return get_decomposed_returns_batch(reprice_decomposition(decomposition, **changes))
+
+def get_decomposed_npvs(decomposition, monthly_rate):
+    # NPV of every listing's held cash flows at its periodic rate.
+    held_cash_flows, _ = get_decomposed_cash_flows(decomposition)
+    discounts = (1.0 + monthly_rate[:, np.newaxis])**-np.arange(held_cash_flows.shape[1], dtype=np.float64)
+    return np.sum(held_cash_flows * discounts, axis=1)
+
+MAX_PURCHASE_PRICE_BRACKETS = 32
+MAX_PURCHASE_PRICE_TOLERANCE_DOLLARS = 1.0
+
+def get_decomposed_max_purchase_prices_batch(target_irr_pct, decomposition):
+    # The highest purchase price at which each listing's annualized unlevered
+    # IRR is still target_irr_pct; the decomposition's purchase prices are
+    # ignored. nan where no positive price reaches the target.
+    #
+    # Unless the exit ceiling or capital reserve depends on purchase price,
+    # price only enters the cash flows as the month 0 outlay, so NPV at the
+    # target rate is linear in price and the root is the present value of
+    # the remaining cash flows net of closing costs. Taking the exit as
+    # unlimited and the reserve at its lowest, that root also bounds the
+    # price from above when they do depend on it, so those listings scan
+    # NPV over fractions of it for the last sign change and bisect within it.
+    # A reserve whose threshold is not finite does not depend on price and
+    # keeps its own multiple.
+    monthly_rate = np.broadcast_to(
+        (1.0 + np.asarray(target_irr_pct, dtype=np.float64))**(1.0 / 12) - 1.0,
+        decomposition.hold_period_months.shape,
+    )
+    reserve_threshold_finite = np.isfinite(decomposition.capital_reserve_price_threshold_dollars)
+    unlimited = reprice_decomposition(
+        decomposition,
+        purchase_price_dollars=0.0,
+        exit_purchase_price_ceiling_multiple=np.inf,
+        capital_reserve_price_threshold_dollars=np.where(
+            reserve_threshold_finite, 0.0, decomposition.capital_reserve_price_threshold_dollars),
+        capital_reserve_price_multiple=np.where(
+            reserve_threshold_finite,
+            np.minimum(decomposition.capital_reserve_price_multiple, 1.0),
+            decomposition.capital_reserve_price_multiple,
+        ),
+    )
+    max_purchase_price = get_decomposed_npvs(unlimited, monthly_rate) / (1.0 + decomposition.closing_costs_pct)
+    max_purchase_price = np.where(max_purchase_price > 0, max_purchase_price, np.nan)
+
+    price_dependent = (
+        np.isfinite(decomposition.exit_purchase_price_ceiling_multiple) |
+        (reserve_threshold_finite & (decomposition.capital_reserve_price_multiple != 1.0))
+    )
+    rows = np.flatnonzero(price_dependent & ~np.isnan(max_purchase_price))
+    if not len(rows):
+        return max_purchase_price
+    limited = take_decomposition(decomposition, rows)
+    upper = max_purchase_price[rows]
+    rate = monthly_rate[rows]
+    def npv_at(price):
+        return get_decomposed_npvs(reprice_decomposition(limited, purchase_price_dollars=price), rate)
+
+    fractions = np.linspace(0.0, 1.0, MAX_PURCHASE_PRICE_BRACKETS + 1)
+    reaches_target = np.column_stack([npv_at(fraction * upper) >= 0 for fraction in fractions])
+    last = np.where(
+        np.any(reaches_target, axis=1),
+        len(fractions) - 1 - np.argmax(reaches_target[:, ::-1], axis=1),
+        -1,
     )
+    lo = fractions[np.maximum(last, 0)] * upper
+    hi = fractions[np.minimum(last + 1, len(fractions) - 1)] * upper
+    bisecting = np.flatnonzero((last >= 0) & (hi - lo > MAX_PURCHASE_PRICE_TOLERANCE_DOLLARS))
+    while len(bisecting):
+        mid = (lo[bisecting] + hi[bisecting]) / 2.0
+        npv = get_decomposed_npvs(
+            reprice_decomposition(take_decomposition(limited, bisecting), purchase_price_dollars=mid),
+            rate[bisecting],
+        )
+        lo[bisecting] = np.where(npv >= 0, mid, lo[bisecting])
+        hi[bisecting] = np.where(npv >= 0, hi[bisecting], mid)
+        bisecting = bisecting[hi[bisecting] - lo[bisecting] > MAX_PURCHASE_PRICE_TOLERANCE_DOLLARS]
+    max_purchase_price[rows] = np.where((last >= 0) & (lo > 0), lo, np.nan)
+    return max_purchase_price
+
+def get_max_purchase_prices_batch(target_irr_pct, **kwargs):
+    # get_decomposed_max_purchase_prices_batch for get_unlevered_returns
+    # keyword arguments; any purchase_price_dollars in kwargs is ignored.
+    return get_decomposed_max_purchase_prices_batch(
+        target_irr_pct, decompose_cash_flows_batch(**dict(kwargs, purchase_price_dollars=0.0)))
+
+SENSITIVITY_GRID = {
+    "exit_cap_pct": [0.03, 0.035, 0.04, 0.045, 0.05],
+    "annual_rent_growth_pct": [0.0, 0.01, 0.02, 0.03, 0.04],
+    "hold_period_months": [36, 60, 84, 120],
+}
+SENSITIVITY_CHUNK_ROWS = 20000
+
+def get_listing_count(listing_kwargs):
+    return int(np.prod(np.broadcast_shapes(*(np.shape(v) for v in listing_kwargs.values())) or (1,)))
+
+def take_listings(listing_kwargs, listings):
+    # Per-listing arguments for the listings at the given positions (which may
+    # repeat); scalar arguments are shared by every listing.
+    return {
+        name: np.asarray(value)[listings] if np.ndim(value) else value
+        for name, value in listing_kwargs.items()
+    }
+
+def get_sensitivity_returns(listing_kwargs, scenario_grid=SENSITIVITY_GRID, chunk_size=SENSITIVITY_CHUNK_ROWS):
+    # Evaluates every listing under every combination of scenario_grid, whose
+    # keys are get_unlevered_returns arguments overriding listing_kwargs.
+    # The listings x scenarios product is flattened and run through
+    # get_unlevered_returns_batch chunk_size rows at a time to bound memory.
+    # Returns a tidy DataFrame with one row per (listing, scenario).
+    names = list(scenario_grid)
+    scenarios = np.array(list(itertools.product(*(scenario_grid[name] for name in names))), dtype=np.float64)
+    listing_count = get_listing_count(listing_kwargs)
+    row_count = listing_count * len(scenarios)
+
+    chunks = []
+    for chunk_start in range(0, row_count, chunk_size):
+        rows = np.arange(chunk_start, min(chunk_start + chunk_size, row_count))
+        listings = rows // len(scenarios)
+        scenario_values = scenarios[rows % len(scenarios)]
+        kwargs = take_listings(listing_kwargs, listings)
+        kwargs.update((name, scenario_values[:, i]) for i, name in enumerate(names))
+        ret = get_unlevered_returns_batch(**kwargs)
+        chunks.append(pd.DataFrame({
+            "listing": listings,
+            **{name: scenario_values[:, i] for i, name in enumerate(names)},
+            **ret._asdict(),
+        }))
+    return pd.concat(chunks, ignore_index=True)
+
+# get_unlevered_returns arguments drawn per simulated path, as the name of a
+# numpy.random.Generator method and its parameters.
+SIMULATION_DISTRIBUTIONS = {
+    "annual_rent_growth_pct": ("normal", (0.02, 0.015)),
+    "initial_downtime_months": ("poisson", (3,)),
+    "interim_downtime_months": ("poisson", (1,)),
+    "exit_cap_pct": ("triangular", (0.03, 0.035, 0.05)),
+}
+SIMULATION_PERCENTILES = (10, 50, 90)
+SIMULATION_CHUNK_ROWS = 50000
+
+def simulate_listing_returns(listing_kwargs, start, stop, path_count, distributions, seed, chunk_size):
+    # Simulates listings [start, stop), whose arguments are listing_kwargs
+    # indexed from start. Each listing draws its paths from its own generator
+    # seeded by (seed, listing), so results do not depend on how listings are
+    # split across chunks or processes.
+    listings_per_chunk = max(1, chunk_size // path_count)
+    summaries = []
+    for chunk_start in range(start, stop, listings_per_chunk):
+        listings = np.arange(chunk_start, min(chunk_start + listings_per_chunk, stop))
+        draws = collections.defaultdict(list)
+        for listing in listings:
+            rng = np.random.default_rng([seed, listing])
+            for name, (method, params) in distributions.items():
+                draws[name].append(getattr(rng, method)(*params, size=path_count))
+        kwargs = take_listings(listing_kwargs, np.repeat(listings - start, path_count))
+        kwargs.update((name, np.concatenate(values)) for name, values in draws.items())
+        ret = get_unlevered_returns_batch(**kwargs)
+
+        irr = ret.irr_pct.reshape(len(listings), path_count)
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", category=RuntimeWarning)
+            irr_percentiles = np.nanpercentile(irr, SIMULATION_PERCENTILES, axis=1)
+        summaries.append(pd.DataFrame({
+            "listing": listings,
+            **{"irr_p{}".format(p): irr_percentiles[i] for i, p in enumerate(SIMULATION_PERCENTILES)},
+            "loss_probability": np.mean(ret.profit_dollars.reshape(len(listings), path_count) < 0, axis=1),
+            "no_irr_probability": np.mean(np.isnan(irr), axis=1),
+        }))
+    return pd.concat(summaries, ignore_index=True)
+
+def simulate_returns(
+        listing_kwargs,
+        path_count=1000,
+        distributions=SIMULATION_DISTRIBUTIONS,
+        seed=0,
+        workers=1,
+        chunk_size=SIMULATION_CHUNK_ROWS):
+    # Monte Carlo over the uncertain inputs in distributions: every listing
+    # is evaluated on path_count draws and summarized as IRR percentiles and
+    # the probability of losing money. Paths are evaluated chunk_size at a
+    # time through get_unlevered_returns_batch; with workers > 1, listings are
+    # split across a process pool.
+    listing_count = get_listing_count(listing_kwargs)
+    if workers <= 1:
+        return simulate_listing_returns(
+            listing_kwargs, 0, listing_count, path_count, distributions, seed, chunk_size)
+
+    bounds = np.linspace(0, listing_count, min(workers * 4, listing_count) + 1).astype(int)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        parts = [
+            executor.submit(
+                simulate_listing_returns,
+                take_listings(listing_kwargs, np.arange(start, stop)),
+                start,
+                stop,
+                path_count,
+                distributions,
+                seed,
+                chunk_size,
+            )
+            for start, stop in zip(bounds[:-1], bounds[1:])
+            if stop > start
+        ]
+        return pd.concat([part.result() for part in parts], ignore_index=True)
 
 def compute_returns_for_scrapes(infile):
     reader = csv.reader(infile)
@@ -191,8 +961,9 @@ def compute_returns_for_scrapes(infile):
             monthly_capital_reserve_dollars=500,
             hold_period_months=60,
             exit_cap_pct=0.03,
-            exit_sq_ft_price_ceiling_dollars=(to_i(l.price) * 1.5 / to_i(l.sq_ft)),
+            exit_sq_ft_price_ceiling_dollars=np.inf,
             exit_costs_pct=0.08,
+            exit_purchase_price_ceiling_multiple=1.5,
         )
         writer.writerow((
             l.permalink,
@@ -234,8 +1005,9 @@ def compute_irr_for_shortlist(infile):
             monthly_capital_reserve_dollars=500,
             hold_period_months=60,
             exit_cap_pct=0.03,
-            exit_sq_ft_price_ceiling_dollars=(to_i(price) * 1.5 / to_i(sq_ft)) if to_i(sq_ft) else to_i(price),
+            exit_sq_ft_price_ceiling_dollars=np.inf,
             exit_costs_pct=0.08,
+            exit_purchase_price_ceiling_multiple=1.5,
         )
         writer.writerow(line + [ret.irr_pct, ret.gross_sale_price_dollars, ret.moic_pct, ret.equity_dollars, ret.profit_dollars, ret.gross_sale_price_sq_ft_dollars])
         
@@ -0,0 +1,250 @@
+#!/usr/bin/env python
+
+import datetime
+import json
+import sqlite3
+import sys
+import threading
+
+import compass
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS listings (
+    permalink TEXT PRIMARY KEY,
+    listing_type TEXT NOT NULL,
+    record TEXT NOT NULL,
+    price_dollars REAL,
+    version INTEGER NOT NULL,
+    first_seen TEXT NOT NULL,
+    last_seen TEXT NOT NULL,
+    last_changed TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS listings_by_type_last_seen ON listings (listing_type, last_seen);
+CREATE TABLE IF NOT EXISTS price_history (
+    permalink TEXT NOT NULL,
+    seen_date TEXT NOT NULL,
+    price_dollars REAL,
+    PRIMARY KEY (permalink, seen_date)
+);
+CREATE TABLE IF NOT EXISTS scores (
+    permalink TEXT PRIMARY KEY,
+    listing_version INTEGER NOT NULL,
+    rent_record TEXT NOT NULL,
+    predicted_rent REAL,
+    irr REAL,
+    irr_root_count INTEGER,
+    scored_at TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS metadata (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+SCORE_COLUMNS = ["permalink", "listing_version", "rent_record", "predicted_rent", "irr", "irr_root_count", "scored_at"]
+
+# The rent model never sees these, so a listing whose only change is to one
+# of them keeps its predicted rent and just needs its DCF run again.
+PRICE_FIELDS = ("price_dollars", "original_price_dollars")
+# A listings row's record with PRICE_FIELDS nulled, as SQL.
+RENT_RECORD_SQL = "json_set(l.record, {})".format(", ".join(
+    "'$[{}]', NULL".format(compass.CompassListing._fields.index(field)) for field in PRICE_FIELDS
+))
+
+# The smallest per-statement parameter limit across SQLite versions.
+SQLITE_MAX_PARAMETERS = 999
+
+def today():
+    return datetime.date.today().isoformat()
+
+class ListingStore(object):
+    # Persistent SQLite store of every CompassListing we have scraped, keyed by
+    # permalink. Each listing carries first/last seen dates, a version that is
+    # bumped whenever any field changes, and a price history. DCF scores are
+    # stored against the listing version they were computed for, so only new
+    # or changed listings need to be re-scored.
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        # Scores are only cached model output, so a store from before a
+        # scores column was added just drops them to be computed again.
+        score_columns = [row[1] for row in self.conn.execute("PRAGMA table_info(scores)")]
+        if score_columns and score_columns != SCORE_COLUMNS:
+            with self.conn:
+                self.conn.execute("DROP TABLE scores")
+        self.conn.executescript(SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def record_listings(self, listing_type, listings, seen_date=None):
+        # Returns how many of listings were new or changed since the last run.
+        seen_date = seen_date or today()
+        changed_count = 0
+        with self.lock, self.conn:
+            for listing in listings:
+                record = json.dumps(list(listing))
+                existing = self.conn.execute(
+                    "SELECT record, price_dollars, version FROM listings WHERE permalink = ?",
+                    (listing.permalink,),
+                ).fetchone()
+                if existing is None:
+                    self.conn.execute(
+                        "INSERT INTO listings VALUES (?, ?, ?, ?, 1, ?, ?, ?)",
+                        (listing.permalink, listing_type, record, listing.price_dollars, seen_date, seen_date, seen_date),
+                    )
+                elif existing[0] != record:
+                    self.conn.execute(
+                        "UPDATE listings SET record = ?, price_dollars = ?, version = ?, last_seen = ?, last_changed = ? "
+                        "WHERE permalink = ?",
+                        (record, listing.price_dollars, existing[2] + 1, seen_date, seen_date, listing.permalink),
+                    )
+                else:
+                    self.conn.execute(
+                        "UPDATE listings SET last_seen = ? WHERE permalink = ?",
+                        (seen_date, listing.permalink),
+                    )
+                    continue
+                changed_count += 1
+                if existing is None or existing[1] != listing.price_dollars:
+                    self.conn.execute(
+                        "INSERT OR REPLACE INTO price_history VALUES (?, ?, ?)",
+                        (listing.permalink, seen_date, listing.price_dollars),
+                    )
+        return changed_count
+
+    def get_metadata(self, key):
+        with self.lock:
+            row = self.conn.execute("SELECT value FROM metadata WHERE key = ?", (key,)).fetchone()
+        return row[0] if row is not None else None
+
+    def set_metadata(self, key, value):
+        with self.lock, self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO metadata VALUES (?, ?)", (key, value))
+
+    def is_full_crawl_due(self, listing_type, full_crawl_days, crawl_date=None):
+        # Incremental scrapes stop paging at the first unchanged page, so
+        # listings deeper in the results are only seen again (and so kept
+        # active) by a full crawl at least every full_crawl_days.
+        last_full_crawl = self.get_metadata("last_full_crawl:" + listing_type)
+        if last_full_crawl is None:
+            return True
+        crawl_date = datetime.date.fromisoformat(crawl_date or today())
+        return (crawl_date - datetime.date.fromisoformat(last_full_crawl)).days >= full_crawl_days
+
+    def record_full_crawl(self, listing_type, crawl_date=None):
+        self.set_metadata("last_full_crawl:" + listing_type, crawl_date or today())
+
+    def set_score_fingerprint(self, fingerprint):
+        # Scores are only valid for the model and assumptions that computed
+        # them, so stored scores are dropped whenever fingerprint changes.
+        with self.lock, self.conn:
+            row = self.conn.execute("SELECT value FROM metadata WHERE key = 'score_fingerprint'").fetchone()
+            if row is not None and row[0] == fingerprint:
+                return
+            self.conn.execute("DELETE FROM scores")
+            self.conn.execute("INSERT OR REPLACE INTO metadata VALUES ('score_fingerprint', ?)", (fingerprint,))
+
+    def iter_listings(self, listing_type, seen_since=None):
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT record FROM listings WHERE listing_type = ? AND last_seen >= ? ORDER BY rowid",
+                (listing_type, seen_since or ""),
+            ).fetchall()
+        for (record,) in rows:
+            yield compass.CompassListing(*json.loads(record))
+
+    def get_listings(self, permalinks):
+        # {permalink: CompassListing} for those of permalinks in the store.
+        permalinks = list(permalinks)
+        rows = []
+        with self.lock:
+            for start in range(0, len(permalinks), SQLITE_MAX_PARAMETERS):
+                chunk = permalinks[start:start + SQLITE_MAX_PARAMETERS]
+                rows.extend(self.conn.execute(
+                    "SELECT record FROM listings WHERE permalink IN ({})".format(",".join("?" * len(chunk))),
+                    chunk,
+                ).fetchall())
+        listings = (compass.CompassListing(*json.loads(record)) for (record,) in rows)
+        return {listing.permalink: listing for listing in listings}
+
+    def get_price_history(self, permalink):
+        with self.lock:
+            return self.conn.execute(
+                "SELECT seen_date, price_dollars FROM price_history WHERE permalink = ? ORDER BY seen_date",
+                (permalink,),
+            ).fetchall()
+
+    def select_scores(self, query, permalinks):
+        # Rows of query, a SELECT on scores s joined to listings l, optionally
+        # only for the given permalinks.
+        with self.lock:
+            if permalinks is None:
+                return self.conn.execute(query).fetchall()
+            permalinks = list(permalinks)
+            rows = []
+            for start in range(0, len(permalinks), SQLITE_MAX_PARAMETERS):
+                chunk = permalinks[start:start + SQLITE_MAX_PARAMETERS]
+                rows.extend(self.conn.execute(
+                    query + " WHERE s.permalink IN ({})".format(",".join("?" * len(chunk))),
+                    chunk,
+                ).fetchall())
+            return rows
+
+    def get_current_scores(self, permalinks=None):
+        # {permalink: (predicted_rent, irr, irr_root_count)} for scores still
+        # valid for the listing's current version, optionally only for the
+        # given permalinks.
+        rows = self.select_scores(
+            "SELECT s.permalink, s.predicted_rent, s.irr, s.irr_root_count FROM scores s "
+            "JOIN listings l ON l.permalink = s.permalink AND l.version = s.listing_version",
+            permalinks,
+        )
+        return {permalink: (predicted_rent, irr, irr_root_count) for permalink, predicted_rent, irr, irr_root_count in rows}
+
+    def get_repriced_rents(self, permalinks=None):
+        # {permalink: predicted_rent} for listings whose score is out of date
+        # only because of a change to PRICE_FIELDS.
+        return dict(self.select_scores(
+            "SELECT s.permalink, s.predicted_rent FROM scores s "
+            "JOIN listings l ON l.permalink = s.permalink AND l.version != s.listing_version "
+            "AND s.rent_record = " + RENT_RECORD_SQL,
+            permalinks,
+        ))
+
+    def put_scores(self, permalinks, predicted_rents, irrs, irr_root_counts, scored_date=None):
+        scored_date = scored_date or today()
+        with self.lock, self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO scores "
+                "SELECT l.permalink, l.version, " + RENT_RECORD_SQL + ", ?, ?, ?, ? FROM listings l WHERE l.permalink = ?",
+                (
+                    (float(predicted_rent), float(irr), int(irr_root_count), scored_date, permalink)
+                    for permalink, predicted_rent, irr, irr_root_count in zip(permalinks, predicted_rents, irrs, irr_root_counts)
+                ),
+            )
+
+def main(argv):
+    import argparse
+    import csv
+    parser = argparse.ArgumentParser(description="Dump listings from a local listing store")
+    parser.add_argument("store")
+    parser.add_argument("--sales", action="store_true")
+    parser.add_argument("--seen-since", help="Only listings seen on or after this YYYY-MM-DD date")
+
+    parsed = parser.parse_args(argv[1:])
+    listing_type = compass.LISTING_TYPE_SALE if parsed.sales else compass.LISTING_TYPE_RENTAL
+    writer = csv.writer(sys.stdout)
+    writer.writerow(compass.CompassListing._fields)
+    with ListingStore(parsed.store) as store:
+        writer.writerows(store.iter_listings(listing_type, parsed.seen_since))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
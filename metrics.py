@@ -0,0 +1,202 @@
+import bisect
+import collections
+import contextlib
+import cProfile
+import json
+import math
+import os
+import threading
+import time
+
+# Process-wide pipeline instrumentation: counters, gauges, histograms and
+# per-stage wall times, written as JSON or as a Prometheus textfile (by
+# extension, .prom) at the end of a run. Metrics recorded in worker
+# processes are only collected if the worker returns to_json() for the
+# parent to merge_json. Profiling is off unless enable_profiling is
+# called, after which every profile(name) block is run under cProfile and
+# dumped to <profile_dir>/<name>.prof.
+
+LATENCY_BUCKETS_SECONDS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, math.inf)
+
+class Histogram(object):
+    def __init__(self, bounds):
+        self.bounds = tuple(bounds)
+        self.bucket_counts = [0] * len(self.bounds)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        # Buckets are upper bounds, as in Prometheus.
+        self.bucket_counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+def get_series_key(name, labels):
+    return (name, tuple(sorted((label, str(value)) for label, value in labels.items())))
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(
+        '{}="{}"'.format(name, value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for name, value in labels
+    ) + "}"
+
+def format_bound(bound):
+    return "+Inf" if bound == math.inf else repr(float(bound))
+
+class Metrics(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = collections.defaultdict(float)
+        self.gauges = {}
+        self.histograms = {}
+        self.profile_dir = None
+        self.profiles = {}
+        self.profiling_thread = None
+
+    def increment(self, name, value=1, **labels):
+        key = get_series_key(name, labels)
+        with self.lock:
+            self.counters[key] += value
+
+    def get(self, name, **labels):
+        key = get_series_key(name, labels)
+        with self.lock:
+            return self.counters.get(key, self.gauges.get(key, 0.0))
+
+    def set_gauge(self, name, value, **labels):
+        with self.lock:
+            self.gauges[get_series_key(name, labels)] = value
+
+    def reset(self):
+        with self.lock:
+            self.counters.clear()
+            self.gauges.clear()
+            self.histograms.clear()
+
+    def merge_json(self, snapshot, **labels):
+        # Adds the metrics in another registry's to_json(), such as one
+        # returned from a worker process, with labels added to every series.
+        with self.lock:
+            for series in snapshot["counters"]:
+                self.counters[get_series_key(series["name"], dict(series["labels"], **labels))] += series["value"]
+            for series in snapshot["gauges"]:
+                self.gauges[get_series_key(series["name"], dict(series["labels"], **labels))] = series["value"]
+            for series in snapshot["histograms"]:
+                key = get_series_key(series["name"], dict(series["labels"], **labels))
+                if key not in self.histograms:
+                    self.histograms[key] = Histogram(float(bound) for bound in series["buckets"])
+                histogram = self.histograms[key]
+                for i, count in enumerate(series["buckets"].values()):
+                    histogram.bucket_counts[i] += count
+                histogram.sum += series["sum"]
+                histogram.count += series["count"]
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS_SECONDS, **labels):
+        key = get_series_key(name, labels)
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram(buckets)
+            self.histograms[key].observe(value)
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        # Adds the block's wall time to pipeline_stage_seconds{stage=name}
+        # and profiles it when profiling is enabled.
+        start = time.perf_counter()
+        try:
+            with self.profile(name):
+                yield
+        finally:
+            key = get_series_key("pipeline_stage_seconds", {"stage": name})
+            with self.lock:
+                self.gauges[key] = self.gauges.get(key, 0.0) + time.perf_counter() - start
+
+    def enable_profiling(self, profile_dir):
+        os.makedirs(profile_dir, exist_ok=True)
+        self.profile_dir = profile_dir
+
+    @contextlib.contextmanager
+    def profile(self, name):
+        # cProfile only sees the thread that enables it and only one profile
+        # can be active at a time, so nested blocks and other threads run
+        # unprofiled inside the outermost one.
+        with self.lock:
+            profiling = self.profile_dir is not None and self.profiling_thread is None
+            if profiling:
+                self.profiling_thread = threading.get_ident()
+                profiler = self.profiles.setdefault(name, cProfile.Profile())
+        if not profiling:
+            yield
+            return
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            profiler.dump_stats(os.path.join(self.profile_dir, "{}.prof".format(name)))
+            with self.lock:
+                self.profiling_thread = None
+
+    def to_json(self):
+        with self.lock:
+            return {
+                "counters": [
+                    {"name": name, "labels": dict(labels), "value": value}
+                    for (name, labels), value in sorted(self.counters.items())
+                ],
+                "gauges": [
+                    {"name": name, "labels": dict(labels), "value": value}
+                    for (name, labels), value in sorted(self.gauges.items())
+                ],
+                "histograms": [
+                    {
+                        "name": name,
+                        "labels": dict(labels),
+                        "buckets": {
+                            format_bound(bound): count for bound, count in zip(histogram.bounds, histogram.bucket_counts)
+                        },
+                        "sum": histogram.sum,
+                        "count": histogram.count,
+                    }
+                    for (name, labels), histogram in sorted(self.histograms.items())
+                ],
+            }
+
+    def to_prometheus(self):
+        lines = []
+        with self.lock:
+            for metric_type, series in (("counter", self.counters), ("gauge", self.gauges)):
+                last_name = None
+                for (name, labels), value in sorted(series.items()):
+                    if name != last_name:
+                        lines.append("# TYPE {} {}".format(name, metric_type))
+                        last_name = name
+                    lines.append("{}{} {}".format(name, format_labels(labels), repr(float(value))))
+            last_name = None
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                if name != last_name:
+                    lines.append("# TYPE {} histogram".format(name))
+                    last_name = name
+                cumulative_count = 0
+                for bound, count in zip(histogram.bounds, histogram.bucket_counts):
+                    cumulative_count += count
+                    lines.append("{}_bucket{} {}".format(
+                        name, format_labels(labels + (("le", format_bound(bound)),)), cumulative_count))
+                lines.append("{}_sum{} {}".format(name, format_labels(labels), repr(histogram.sum)))
+                lines.append("{}_count{} {}".format(name, format_labels(labels), histogram.count))
+        return "\n".join(lines) + "\n"
+
+    def write(self, path):
+        # Written to a temporary file and renamed so that a textfile
+        # collector never reads a partial file.
+        tmp_path = "{}.tmp.{}".format(path, os.getpid())
+        with open(tmp_path, "w") as outfile:
+            if os.path.splitext(path)[1] == ".prom":
+                outfile.write(self.to_prometheus())
+            else:
+                json.dump(self.to_json(), outfile, indent=2)
+        os.replace(tmp_path, path)
+
+registry = Metrics()
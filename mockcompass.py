@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+
+import collections
+import http.server
+import json
+import random
+import socket
+import sys
+import threading
+import time
+
+import compass
+import synthetic
+
+# Local stand-in for the Compass search endpoint, for load-testing the
+# scraper offline. Any POST with a rawLolSearchQuery body gets a page of
+# synthetic listings honoring start/num, with totalItems listings per
+# location. Latency, server errors, truncated responses and throttling are
+# all configurable. GET /stats returns request counters as JSON.
+#
+#   ./mockcompass.py --port 8000 --latency-ms 50 --error-rate 0.02 &
+#   ./compass.py --base-url http://localhost:8000 --concurrency 8 > /dev/null
+
+MockConfig = collections.namedtuple(
+    "MockConfig",
+    (
+        "listings_per_location",
+        "latency_ms",
+        "latency_jitter_ms",
+        "error_rate",
+        "truncate_rate",
+        "max_requests_per_second",
+        "retry_after_seconds",
+        "seed",
+    ),
+)
+
+DEFAULT_CONFIG = MockConfig(
+    listings_per_location=500,
+    latency_ms=0.0,
+    latency_jitter_ms=0.0,
+    error_rate=0.0,
+    truncate_rate=0.0,
+    max_requests_per_second=0.0,
+    retry_after_seconds=1,
+    seed=0,
+)
+
+class MockCompassServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, config=DEFAULT_CONFIG):
+        super().__init__(address, MockCompassHandler)
+        self.config = config
+        self.lock = threading.Lock()
+        self.rng = random.Random(config.seed)
+        self.stats = collections.Counter()
+        self.window_start = time.monotonic()
+        self.window_count = 0
+
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return "http://{}:{}".format(host, port)
+
+    def is_throttled(self):
+        # Fixed one-second windows of at most max_requests_per_second.
+        if self.config.max_requests_per_second <= 0:
+            return False
+        with self.lock:
+            now = time.monotonic()
+            if now - self.window_start >= 1.0:
+                self.window_start = now
+                self.window_count = 0
+            self.window_count += 1
+            return self.window_count > self.config.max_requests_per_second
+
+    def draw(self):
+        with self.lock:
+            return self.rng.random()
+
+    def get_latency_seconds(self):
+        with self.lock:
+            jitter = self.rng.uniform(-1, 1) * self.config.latency_jitter_ms
+        return max(self.config.latency_ms + jitter, 0.0) / 1000.0
+
+    def count(self, name):
+        with self.lock:
+            self.stats[name] += 1
+
+def get_page(config, query):
+    listing_type = compass.LISTING_TYPE_SALE if 2 in query.get("listingTypes", ()) else compass.LISTING_TYPE_RENTAL
+    location_id = query["locationIds"][0]
+    return synthetic.make_search_page(
+        listing_type,
+        config.listings_per_location,
+        int(query.get("start", 0)),
+        int(query.get("num", compass.SEARCH_PAGE_SIZE)),
+        seed="{}-{}".format(config.seed, location_id),
+    )
+
+class MockCompassHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, body, headers=()):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path.rstrip("/") == "/stats":
+            with self.server.lock:
+                self.send_json(200, dict(self.server.stats))
+        else:
+            self.send_json(404, {"error": "not found"})
+
+    def do_POST(self):
+        server = self.server
+        config = server.config
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        server.count("requests")
+        time.sleep(server.get_latency_seconds())
+
+        if server.is_throttled():
+            server.count("throttled")
+            self.send_json(429, {"error": "too many requests"}, [("Retry-After", str(config.retry_after_seconds))])
+            return
+        if server.draw() < config.error_rate:
+            server.count("errors")
+            self.send_json(503, {"error": "service unavailable"})
+            return
+        try:
+            query = json.loads(body)["rawLolSearchQuery"]
+            page = get_page(config, query)
+        except (ValueError, KeyError, IndexError, TypeError):
+            server.count("bad_requests")
+            self.send_json(400, {"error": "bad request"})
+            return
+
+        if server.draw() < config.truncate_rate:
+            # A 200 that promises the whole body but drops the connection
+            # halfway through it.
+            server.count("truncated")
+            data = json.dumps(page).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data[:len(data) // 2])
+            self.wfile.flush()
+            self.close_connection = True
+            self.connection.shutdown(socket.SHUT_RDWR)
+            return
+        with server.lock:
+            server.stats["pages"] += 1
+            server.stats["listings"] += len(page["lolResults"]["data"])
+        self.send_json(200, page)
+
+def start_in_background(config=DEFAULT_CONFIG, host="127.0.0.1", port=0):
+    # Starts a server on a daemon thread (on a free port by default) and
+    # returns it; call shutdown() when done.
+    server = MockCompassServer((host, port), config)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def main(argv):
+    import argparse
+    parser = argparse.ArgumentParser(description="Serve synthetic Compass search pages locally")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--listings-per-location", type=int, default=DEFAULT_CONFIG.listings_per_location)
+    parser.add_argument("--latency-ms", type=float, default=DEFAULT_CONFIG.latency_ms)
+    parser.add_argument("--latency-jitter-ms", type=float, default=DEFAULT_CONFIG.latency_jitter_ms)
+    parser.add_argument("--error-rate", type=float, default=DEFAULT_CONFIG.error_rate,
+                        help="Fraction of requests answered with a 503")
+    parser.add_argument("--truncate-rate", type=float, default=DEFAULT_CONFIG.truncate_rate,
+                        help="Fraction of pages whose connection drops halfway through the body")
+    parser.add_argument("--max-requests-per-second", type=float, default=DEFAULT_CONFIG.max_requests_per_second,
+                        help="Answer requests beyond this rate with a 429 (0 for no limit)")
+    parser.add_argument("--retry-after-seconds", type=int, default=DEFAULT_CONFIG.retry_after_seconds)
+    parser.add_argument("--seed", type=int, default=DEFAULT_CONFIG.seed)
+
+    parsed = parser.parse_args(argv[1:])
+    config = MockConfig(**{field: getattr(parsed, field) for field in MockConfig._fields})
+    server = MockCompassServer((parsed.host, parsed.port), config)
+    print("Serving synthetic Compass pages on {}".format(server.base_url), file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
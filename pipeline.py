@@ -0,0 +1,495 @@
+#!/usr/bin/env python
+
+import collections
+import concurrent.futures
+import csv
+import datetime
+import os
+import queue
+import sys
+import threading
+import time
+
+import compass
+import metrics
+import rentregress
+
+# The daily pull as one process: rentals and sales are scraped concurrently,
+# the rent model trains as soon as the rentals are in, and sales listings are
+# scored in batches as they arrive instead of after everything is on disk.
+# With --markets, each market's pull runs in its own process.
+
+Stage = collections.namedtuple("Stage", ("fn", "dependencies"))
+
+class StageFailed(Exception):
+    def __init__(self, stage, error):
+        super().__init__("Pipeline stage {} failed: {!r}".format(stage, error))
+        self.stage = stage
+        self.error = error
+
+class StageCancelled(Exception):
+    pass
+
+class Pipeline(object):
+    # Runs named stages as a dependency graph on a thread pool. A stage starts
+    # as soon as every stage it depends on has finished, and is called with
+    # their results as keyword arguments. If a stage raises, cancelled is set
+    # so running stages can stop early, no further stages start, and run
+    # raises StageFailed for the first failure once the rest have stopped.
+    def __init__(self):
+        self.stages = collections.OrderedDict()
+        self.cancelled = threading.Event()
+
+    def add_stage(self, name, fn, dependencies=()):
+        # Dependencies must already have been added, which rules out cycles.
+        unknown = [dependency for dependency in dependencies if dependency not in self.stages]
+        if unknown:
+            raise ValueError("Stage {} depends on unknown stages: {}".format(name, ", ".join(unknown)))
+        self.stages[name] = Stage(fn, tuple(dependencies))
+
+    def run_stage(self, name, fn, kwargs):
+        with metrics.registry.stage(name):
+            return fn(**kwargs)
+
+    def run(self):
+        results = {}
+        running = {}
+        pending = collections.OrderedDict(self.stages)
+        failure = None
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(len(self.stages), 1)) as executor:
+            while pending or running:
+                if failure is None:
+                    for name, stage in list(pending.items()):
+                        if all(dependency in results for dependency in stage.dependencies):
+                            del pending[name]
+                            kwargs = {dependency: results[dependency] for dependency in stage.dependencies}
+                            running[executor.submit(self.run_stage, name, stage.fn, kwargs)] = name
+                if not running:
+                    break
+                done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    try:
+                        results[name] = future.result()
+                    except Exception as e:
+                        if failure is None:
+                            failure = StageFailed(name, e)
+                            self.cancelled.set()
+        if failure is not None:
+            raise failure from failure.error
+        return results
+
+# Enough for sales to keep scraping while the rent model trains.
+STREAM_QUEUE_SIZE = 20 * rentregress.SCORE_BATCH_SIZE
+
+class ListingStream(object):
+    # Hands listings from a producing stage to a consuming one as they are
+    # scraped. The producer calls close() only on success, so a consumer
+    # never mistakes a failed scrape for a complete one; it instead stops
+    # with StageCancelled once the pipeline is cancelled.
+
+    # At most maxsize listings wait in the queue, so a producer that gets
+    # ahead of scoring blocks instead of holding the whole scrape in memory.
+    END = object()
+
+    def __init__(self, cancelled, maxsize=STREAM_QUEUE_SIZE, poll_seconds=0.1):
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.cancelled = cancelled
+        self.poll_seconds = poll_seconds
+
+    def put(self, listing):
+        while True:
+            if self.cancelled.is_set():
+                raise StageCancelled()
+            try:
+                self.queue.put(listing, timeout=self.poll_seconds)
+                return
+            except queue.Full:
+                pass
+
+    def close(self):
+        self.put(self.END)
+
+    def iter_batches(self, batch_size, poll_seconds=0.1):
+        # Batches of up to batch_size listings. A partial batch is yielded
+        # whenever the producer falls behind, so results are not held back
+        # waiting for a full batch.
+        batch = []
+        while True:
+            try:
+                listing = self.queue.get(timeout=poll_seconds if not batch else 0)
+            except queue.Empty:
+                if batch:
+                    yield batch
+                    batch = []
+                elif self.cancelled.is_set():
+                    raise StageCancelled()
+                continue
+            if listing is self.END:
+                break
+            batch.append(listing)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+PipelineConfig = collections.namedtuple(
+    "PipelineConfig",
+    (
+        "rentals_path",
+        "sales_path",
+        "output_path",
+        "locations",
+        "store",
+        "incremental",
+        "active_days",
+        "full_crawl_days",
+        "model_dir",
+        "hyperparameters_path",
+        "min_amenity_count",
+        "batch_size",
+        "target_irr_pct",
+        "comp_count",
+        "dcf_assumptions",
+        "client_kwargs",
+    ),
+)
+
+def scrape(config, listing_type, cancelled, on_listing=None):
+    # Scrapes listing_type into its output file and returns the listings the
+    # rest of the pipeline should see: everything scraped or, when
+    # incremental, every listing in the store seen in the last active_days,
+    # as a compass.ListingBatch. Listings streamed to on_listing are left for
+    # the consumer to record; otherwise they are recorded as they arrive, a
+    # chunk at a time, since the batch does not keep the original records.
+    # Incremental scrapes record each page as it is fetched and stream its
+    # listings from the consuming thread, deduplicated like query_compass
+    # output, then stream the rest of the active listings once paging stops.
+    path = config.rentals_path if listing_type == compass.LISTING_TYPE_RENTAL else config.sales_path
+    store = config.store
+    scraped = compass.ListingBatch()
+    unrecorded = []
+    def on_result(listing):
+        if cancelled.is_set():
+            raise StageCancelled()
+        scraped.append(listing)
+        if on_listing is not None:
+            on_listing(listing)
+        elif store is not None:
+            unrecorded.append(listing)
+            if len(unrecorded) >= compass.LISTING_BATCH_SIZE:
+                store.record_listings(listing_type, unrecorded)
+                del unrecorded[:]
+        return listing
+
+    full_crawl = config.incremental and store.is_full_crawl_due(listing_type, config.full_crawl_days)
+    streamed = compass.SeenSet()
+    streamed_permalinks = set()
+    def record_page(listings):
+        # Runs on a worker thread with concurrency > 1.
+        return store.record_listings(listing_type, listings) == 0 and not full_crawl
+
+    client = compass.CompassClient(
+        stop_paging=record_page if config.incremental else None,
+        seen=streamed if config.incremental else None,
+        **config.client_kwargs
+    )
+    fmt = compass.get_listing_format(path)
+    with client, open(path, "w" if fmt == "csv" else "wb") as outfile:
+        if config.incremental:
+            # Paging records each page in the store before its listings
+            # come back here.
+            for listing in client.query_compass(listing_type, config.locations):
+                if cancelled.is_set():
+                    raise StageCancelled()
+                if on_listing is not None:
+                    streamed_permalinks.add(listing.permalink)
+                    on_listing(listing)
+            if full_crawl:
+                store.record_full_crawl(listing_type)
+            seen_since = datetime.date.today() - datetime.timedelta(days=config.active_days)
+            active = compass.ListingBatch()
+            def stream_active(listing):
+                # Listings streamed from a page are active as recorded; the
+                # rest are streamed now unless they duplicate one.
+                if listing.permalink in streamed_permalinks:
+                    return True
+                if streamed.add_all(compass.get_listing_keys(listing_type, listing)):
+                    on_listing(listing)
+                    return True
+                return False
+            # Pages are recorded in whatever order worker threads fetch them,
+            # so the store's order would decide which duplicate is kept.
+            active_listings = sorted(
+                store.iter_listings(listing_type, seen_since.isoformat()), key=lambda listing: listing.permalink)
+            if on_listing is None:
+                active_listings = compass.skip_duplicate_listings(listing_type, active_listings)
+            else:
+                active_listings = (listing for listing in active_listings if stream_active(listing))
+            compass.write_listings(
+                (active.append(listing) or listing for listing in active_listings),
+                outfile,
+                fmt,
+            )
+            return active
+        compass.write_listings(
+            (on_result(listing) for listing in client.query_compass(listing_type, config.locations)), outfile, fmt)
+    if unrecorded:
+        store.record_listings(listing_type, unrecorded)
+    return scraped
+
+def build_daily_pipeline(config):
+    pipeline = Pipeline()
+    cancelled = pipeline.cancelled
+    stream = ListingStream(cancelled)
+
+    def scrape_sales():
+        sales = scrape(config, compass.LISTING_TYPE_SALE, cancelled, stream.put)
+        stream.close()
+        return sales
+
+    def train(rentals):
+        vocabulary = rentregress.select_amenity_vocabulary(rentals.get_amenity_counts(), config.min_amenity_count)
+        return rentregress.train(
+            rentals.to_df(amenities=False),
+            vocabulary,
+            hyperparameters=rentregress.load_hyperparameters(config.hyperparameters_path),
+            model_dir=config.model_dir,
+            comp_count=config.comp_count,
+            amenity_matrix=rentals.get_amenity_matrix(vocabulary),
+        )
+
+    def score(model):
+        # Incremental scrapes record pages themselves.
+        return rentregress.append_frames_csv(
+            rentregress.score_batches(
+                stream.iter_batches(config.batch_size),
+                model,
+                config.store,
+                config.target_irr_pct,
+                record=config.store is not None and not config.incremental,
+                dcf_assumptions=config.dcf_assumptions,
+            ),
+            config.output_path,
+        )
+
+    pipeline.add_stage("rentals", lambda: scrape(config, compass.LISTING_TYPE_RENTAL, cancelled))
+    pipeline.add_stage("sales", scrape_sales)
+    pipeline.add_stage("model", train, dependencies=("rentals",))
+    pipeline.add_stage("score", score, dependencies=("model",))
+    return pipeline
+
+def get_hyperparameters_path(options, model_dir):
+    # --hyperparameters, else the tuned hyperparameters saved in model_dir
+    # or, for a market's model directory, in --model-dir for every market.
+    if options.hyperparameters or not model_dir:
+        return options.hyperparameters
+    path = os.path.join(model_dir, "hyperparameters.json")
+    shared_path = os.path.join(options.model_dir, "hyperparameters.json")
+    return path if os.path.exists(path) or not os.path.exists(shared_path) else shared_path
+
+def get_config(options, market, output_dir, model_dir, store, requests_per_second):
+    return PipelineConfig(
+        rentals_path=os.path.join(output_dir, "compass-rentals-{}.csv".format(options.date)),
+        sales_path=os.path.join(output_dir, "compass-sales-{}.csv".format(options.date)),
+        output_path=os.path.join(output_dir, "compass-sales-with-rents-{}.csv".format(options.date)),
+        locations=compass.MARKETS[market],
+        store=store,
+        incremental=options.incremental,
+        active_days=options.active_days,
+        full_crawl_days=options.full_crawl_days,
+        model_dir=model_dir,
+        hyperparameters_path=get_hyperparameters_path(options, model_dir),
+        min_amenity_count=options.min_amenity_count,
+        batch_size=options.batch_size,
+        target_irr_pct=options.target_irr,
+        comp_count=options.comp_count,
+        dcf_assumptions=rentregress.MARKET_DCF_ASSUMPTIONS.get(market),
+        client_kwargs=dict(
+            concurrency=options.concurrency,
+            rate_limiter=compass.HostRateLimiter(requests_per_second) if requests_per_second > 0 else None,
+            base_url=options.base_url,
+        ),
+    )
+
+def get_market_path(path, market):
+    # path with the market name before its extension, e.g. listings-austin.db.
+    root, ext = os.path.splitext(path)
+    return "{}-{}{}".format(root, market, ext)
+
+class MarketFailed(Exception):
+    pass
+
+def run_market(options, market, worker_count):
+    # Runs in a worker process: the daily pull for one market, with its own
+    # output subdirectory, store and rent models. Markets share the Compass
+    # host, so each gets an equal share of its request rate. Returns the
+    # scored sales path, row count, wall time and the metrics recorded.
+    metrics.registry.reset()
+    if options.profile_dir:
+        metrics.registry.enable_profiling(os.path.join(options.profile_dir, market))
+    started = time.perf_counter()
+    output_dir = os.path.join(options.output_dir, market)
+    os.makedirs(output_dir, exist_ok=True)
+    store = None
+    if options.store:
+        import listingstore
+        store = listingstore.ListingStore(get_market_path(options.store, market))
+    config = get_config(
+        options,
+        market,
+        output_dir,
+        os.path.join(options.model_dir, market) if options.model_dir else None,
+        store,
+        options.requests_per_second / worker_count,
+    )
+    try:
+        results = build_daily_pipeline(config).run()
+    except StageFailed as e:
+        # StageFailed doesn't survive pickling back to the parent.
+        raise MarketFailed("{}: {}".format(market, e)) from None
+    finally:
+        if store is not None:
+            store.close()
+    return config.output_path, results["score"], time.perf_counter() - started, metrics.registry.to_json()
+
+def combine_market_outputs(output_paths, path):
+    # Concatenates each market's scored sales into path with a market
+    # column, re-indexed continuously. Returns the row count.
+    row_count = 0
+    with open(path, "w", newline="") as outfile:
+        writer = csv.writer(outfile)
+        for market, market_path in output_paths:
+            with open(market_path, newline="") as infile:
+                reader = csv.reader(infile)
+                header = next(reader, None)
+                if header is None:
+                    continue
+                if row_count == 0:
+                    writer.writerow(header[:1] + ["market"] + header[1:])
+                for row in reader:
+                    writer.writerow([row_count, market] + row[1:])
+                    row_count += 1
+    return row_count
+
+def run_markets(options):
+    # Runs every market in options.markets on a process pool and combines
+    # their scored sales. Each market's metrics are merged into this
+    # process's with a market label, along with market_seconds.
+    worker_count = min(len(options.markets), options.market_workers or os.cpu_count() or 1)
+    output_paths = {}
+    failed = []
+    with concurrent.futures.ProcessPoolExecutor(max_workers=worker_count) as executor:
+        futures = {executor.submit(run_market, options, market, worker_count): market for market in options.markets}
+        for future in concurrent.futures.as_completed(futures):
+            market = futures[future]
+            try:
+                output_path, row_count, seconds, snapshot = future.result()
+            except MarketFailed as e:
+                print(e, file=sys.stderr)
+                failed.append(market)
+                continue
+            except Exception as e:
+                # Anything else from setting up the market, or a worker
+                # process that died, fails just that market too.
+                print("{}: {!r}".format(market, e), file=sys.stderr)
+                failed.append(market)
+                continue
+            metrics.registry.merge_json(snapshot, market=market)
+            metrics.registry.set_gauge("market_seconds", seconds, market=market)
+            output_paths[market] = output_path
+            print("{}: scored {} sales in {:.1f}s".format(market, row_count, seconds), file=sys.stderr)
+    output_path = os.path.join(options.output_dir, "compass-sales-with-rents-{}.csv".format(options.date))
+    row_count = combine_market_outputs(
+        [(market, output_paths[market]) for market in options.markets if market in output_paths], output_path)
+    return output_path, row_count, failed
+
+def main(argv):
+    import argparse
+    parser = argparse.ArgumentParser(description="Scrape, train and score the daily pull in one process")
+    parser.add_argument("--date", default=datetime.date.today().isoformat(),
+                        help="Date used in output file names")
+    parser.add_argument("--output-dir", default=".")
+    parser.add_argument("--long-island", action="store_true")
+    parser.add_argument("--austin", action="store_true")
+    parser.add_argument("--markets", type=lambda s: s.split(","),
+                        help="Comma-separated compass.MARKETS to pull in parallel, one process each, with "
+                             "per-market output subdirectories, stores and model directories; their scored "
+                             "sales are combined in --output-dir")
+    parser.add_argument("--market-workers", type=int,
+                        help="Processes for --markets (default: one per market, up to one per core)")
+    parser.add_argument("--base-url", default=compass.COMPASS_BASE_URL)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--requests-per-second", type=float, default=4.0)
+    parser.add_argument("--store", help="SQLite listing store")
+    parser.add_argument("--incremental", action="store_true",
+                        help="Stop paging at the first unchanged page and use every listing in --store "
+                             "seen in the last --active-days")
+    parser.add_argument("--active-days", type=int, default=14)
+    parser.add_argument("--full-crawl-days", type=int, default=7,
+                        help="With --incremental, page through everything anyway when the last full crawl "
+                             "is this many days old (must be less than --active-days)")
+    parser.add_argument("--model-dir", help="Directory of saved rent models")
+    parser.add_argument("--hyperparameters",
+                        help="JSON rent model hyperparameters, as saved by rentregress.py --tune "
+                             "(default: hyperparameters.json in each model directory, falling back to "
+                             "--model-dir's for --markets)")
+    parser.add_argument("--min-amenity-count", type=int, default=rentregress.MIN_LEARNED_AMENITY_COUNT,
+                        help="Rental listings an amenity must appear on to become a rent model feature")
+    parser.add_argument("--batch-size", type=int, default=rentregress.SCORE_BATCH_SIZE,
+                        help="Sales listings scored at a time")
+    parser.add_argument("--target-irr", type=float, default=rentregress.TARGET_IRR_PCT)
+    parser.add_argument("--comp-count", type=int, default=0,
+                        help="Add features of each listing's nearest N rental comps to the rent model")
+    parser.add_argument("--metrics", help="Write run metrics to this file (.prom for Prometheus, else JSON)")
+    parser.add_argument("--profile-dir", help="Write cProfile stats for each stage to this directory")
+
+    parsed = parser.parse_args(argv[1:])
+    if parsed.incremental and not parsed.store:
+        parser.error("--incremental requires --store")
+    if parsed.incremental and parsed.full_crawl_days >= parsed.active_days:
+        parser.error("--full-crawl-days must be less than --active-days")
+    if parsed.markets:
+        if parsed.long_island or parsed.austin:
+            parser.error("--markets can't be combined with --long-island or --austin")
+        unknown = [market for market in parsed.markets if market not in compass.MARKETS]
+        if unknown:
+            parser.error("Unknown markets: {} (choose from {})".format(", ".join(unknown), ", ".join(compass.MARKETS)))
+        started = time.perf_counter()
+        try:
+            output_path, row_count, failed = run_markets(parsed)
+        finally:
+            metrics.registry.set_gauge("pipeline_seconds", time.perf_counter() - started)
+            if parsed.metrics:
+                metrics.registry.write(parsed.metrics)
+        print("Daily pull complete. Data available in {}. Generated {} records.".format(output_path, row_count))
+        return 1 if failed else 0
+
+    if parsed.profile_dir:
+        metrics.registry.enable_profiling(parsed.profile_dir)
+    store = None
+    if parsed.store:
+        import listingstore
+        store = listingstore.ListingStore(parsed.store)
+
+    market = "long-island" if parsed.long_island else "austin" if parsed.austin else "bk"
+    config = get_config(parsed, market, parsed.output_dir, parsed.model_dir, store, parsed.requests_per_second)
+    started = time.perf_counter()
+    try:
+        results = build_daily_pipeline(config).run()
+    except StageFailed as e:
+        print(e, file=sys.stderr)
+        return 1
+    finally:
+        metrics.registry.set_gauge("pipeline_seconds", time.perf_counter() - started)
+        if store is not None:
+            store.close()
+        if parsed.metrics:
+            metrics.registry.write(parsed.metrics)
+    print("Daily pull complete. Data available in {}. Generated {} records.".format(
+        config.output_path, results["score"]))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
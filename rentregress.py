@@ -2,17 +2,32 @@
 
 import sys
 
+import collections
+import concurrent.futures
+import csv
+import datetime
+import glob
+import hashlib
+import inspect
+import itertools
 import json
+import os
+import random
+import time
 from matplotlib import pyplot
 import numpy as np
 import pandas as pd
+import scipy.sparse
 from sklearn.metrics import explained_variance_score, mean_squared_error, median_absolute_error
-from sklearn.model_selection import train_test_split
+from sklearn.model_selection import KFold, train_test_split
 from sklearn.preprocessing import LabelEncoder, LabelBinarizer
+import xgboost
 from xgboost.sklearn import XGBRegressor
 
 import compass
+import comps
 import dcf
+import metrics
 
 
 MAX_PRICE_DOLLARS = 15000
@@ -27,6 +42,7 @@ FEATURE_COLUMNS = [
     "unit_type",
     "parking_spaces",
     "amenity",
+    "comp_",
 ]
 
 COMMON_AMENITIES = (
@@ -59,16 +75,61 @@ def label_encode(df, feature):
     col_names = [feature + "_" + cls for cls in enc.classes_]
     return out_df.rename(columns=dict(enumerate(col_names)))
 
-def add_amenities(df):
-    amenities_set = df["amenities"].map(lambda x: set(json.loads(x)) if isinstance(x, str) else set())
-    return pd.DataFrame(
-        dict(
-            ("amenity_" + amenity, amenities_set.map(lambda x: float(amenity in x)))
-            for amenity in COMMON_AMENITIES
-        )
+MIN_LEARNED_AMENITY_COUNT = 20
+
+def to_amenity_list(amenities):
+    # amenities is a JSON string when read from CSV and a list (or array)
+    # when read from Parquet / Arrow.
+    if isinstance(amenities, str):
+        amenities = json.loads(amenities)
+    return amenities if amenities is not None and not isinstance(amenities, float) else ()
+
+def learn_amenity_vocabulary(df, min_count=MIN_LEARNED_AMENITY_COUNT):
+    # Every amenity appearing on at least min_count listings, most common first.
+    return select_amenity_vocabulary(
+        collections.Counter(amenity for amenities in df["amenities"] for amenity in set(to_amenity_list(amenities))),
+        min_count,
+    )
+
+def select_amenity_vocabulary(counts, min_count=MIN_LEARNED_AMENITY_COUNT):
+    # learn_amenity_vocabulary from {amenity: listing count}, such as
+    # compass.ListingBatch.get_amenity_counts returns.
+    return tuple(sorted(
+        (amenity for amenity, count in counts.items() if count >= min_count),
+        key=lambda amenity: (-counts[amenity], amenity),
+    ))
+
+def encode_amenities(df, vocabulary=COMMON_AMENITIES):
+    # Multi-hot CSR matrix of listings x vocabulary, built in a single pass
+    # over the amenities column.
+    positions = {amenity: i for i, amenity in enumerate(vocabulary)}
+    indptr = [0]
+    indices = []
+    for amenities in df["amenities"]:
+        indices.extend(sorted({positions[a] for a in to_amenity_list(amenities) if a in positions}))
+        indptr.append(len(indices))
+    return scipy.sparse.csr_matrix(
+        (np.ones(len(indices), dtype=np.uint8), indices, indptr),
+        shape=(len(indptr) - 1, len(vocabulary)),
+    )
+
+def add_amenities(df, vocabulary=COMMON_AMENITIES, amenity_matrix=None):
+    # Sparse columns; get_model_matrix hands them to XGBoost without
+    # densifying them.
+    return pd.DataFrame.sparse.from_spmatrix(
+        encode_amenities(df, vocabulary) if amenity_matrix is None else amenity_matrix,
+        index=df.index,
+        columns=["amenity_" + amenity for amenity in vocabulary],
     )
 
-def clean_features(df):
+def add_comp_features(df, rental_index):
+    return pd.DataFrame(rental_index.get_comp_features(df), index=df.index)
+
+def clean_features(df, amenity_vocabulary=COMMON_AMENITIES, rental_index=None, amenity_matrix=None):
+    # With a comps.RentalIndex, adds features of each listing's nearest
+    # rental comps (never including the listing itself). An amenity_matrix
+    # over amenity_vocabulary, such as compass.ListingBatch.get_amenity_matrix
+    # returns, is used instead of parsing the amenities column.
     #categorical_cols = ["neighborhood", "unit_type"]
     categorical_cols = []
     drop_cols = ["neighborhood", "unit_type"]
@@ -76,9 +137,39 @@ def clean_features(df):
         label_encode(df, col)
         for col in categorical_cols
     ]
-    out = pd.concat([df, *cols, add_amenities(df)], axis=1).drop(columns=categorical_cols + drop_cols)
+    if rental_index is not None:
+        cols.append(add_comp_features(df, rental_index))
+    out = pd.concat([df, *cols, add_amenities(df, amenity_vocabulary, amenity_matrix)], axis=1).drop(columns=categorical_cols + drop_cols)
     return out
 
+def get_model_matrix(features):
+    # features (from clean_features) as a CSR matrix for XGBoost, which
+    # densifies the sparse columns of a DataFrame. XGBoost treats entries
+    # missing from a sparse matrix as missing values, so dense columns keep
+    # every value but nan, zeros included, while sparse (amenity) columns
+    # only store their ones: an absent amenity is missing, as
+    # get_feature_matrix also encodes it.
+    is_sparse = np.array([isinstance(dtype, pd.SparseDtype) for dtype in features.dtypes], dtype=bool)
+    dense = features.loc[:, ~is_sparse].to_numpy(dtype=np.float32)
+    present = ~np.isnan(dense)
+    dense_matrix = scipy.sparse.csr_matrix(
+        (dense[present], np.nonzero(present)[1], np.concatenate(([0], np.cumsum(np.sum(present, axis=1))))),
+        shape=dense.shape,
+    )
+    matrix = scipy.sparse.hstack(
+        (dense_matrix, features.loc[:, is_sparse].sparse.to_coo().astype(np.float32)) if is_sparse.any() else (dense_matrix,),
+        format="csr",
+    )
+    if is_sparse.any() and not np.all(np.diff(is_sparse.astype(int)) >= 0):
+        # Back to the DataFrame's column order.
+        matrix = matrix[:, np.argsort(np.concatenate((np.flatnonzero(~is_sparse), np.flatnonzero(is_sparse))))]
+    return matrix
+
+def predict_rents(reg, matrix):
+    # reg's predictions for a get_model_matrix (or dense get_feature_matrix)
+    # matrix, which carries no feature names of its own.
+    return reg.get_booster().predict(xgboost.DMatrix(matrix, feature_names=get_model_feature_columns(reg)))
+
 def compute_model_metrics(targets, predicted_targets):
     return {
         "explained variance": explained_variance_score(targets, predicted_targets),
@@ -98,85 +189,715 @@ def select_feature_columns(df):
     return [col for col in df.columns if is_feature_col(col)]
 
 
-def train(raw_df):
+# Bump when featurization or training changes in a way that invalidates
+# previously saved models.
+MODEL_VERSION = 2
+DEFAULT_HYPERPARAMETERS = {
+    #"eta": 0.1,
+    "max_depth": 2,
+    "colsample_bytree": 0.25,
+}
+WARM_START_ROUNDS = 25
+# Past this many trees in total, warm starts train from scratch instead.
+MAX_WARM_START_MODEL_ROUNDS = 500
+# Share of rentals held out to measure the model. Listings are assigned by
+# permalink, so each stays on the same side of the split from run to run
+# and a warm-started model is never tested on rows its base model saw.
+TEST_PERCENT = 10
+
+def get_test_rows(permalinks):
+    hashes = pd.util.hash_pandas_object(pd.Series(np.asarray(permalinks, dtype=object)), index=False).to_numpy()
+    return hashes % 100 < TEST_PERCENT
+
+def get_training_set(raw_df, amenity_vocabulary=COMMON_AMENITIES, rental_index=None, amenity_matrix=None):
     #df = raw_df[raw_df["neighborhood"].isin(set([loc["name"] for loc in compass.BK_LOCATIONS]))]
     df = raw_df
-    df = clean_features(df)
+    df = clean_features(df, amenity_vocabulary, rental_index, amenity_matrix)
     df = df[df["price_dollars"] < MAX_PRICE_DOLLARS]
     df = df[df["address"] != "117 Underhill Avenue"]
            
     features = df[select_feature_columns(df)]
     targets = df["price_dollars"]
-    features_train, features_test, targets_train, targets_test = train_test_split(features, targets, test_size=0.10)
+    return features, targets
 
-    reg = XGBRegressor(
-        #eta=0.1,
-        max_depth=2,
-        colsample_bytree=0.25,
+def fingerprint_training_set(features, targets, hyperparameters):
+    digest = hashlib.sha256()
+    digest.update(json.dumps([MODEL_VERSION, list(features.columns), hyperparameters], sort_keys=True).encode("utf-8"))
+    digest.update(pd.util.hash_pandas_object(features, index=False).to_numpy().tobytes())
+    digest.update(pd.util.hash_pandas_object(targets, index=False).to_numpy().tobytes())
+    return digest.hexdigest()[:24]
+
+def get_rental_index(raw_df, comp_count):
+    # Comps are drawn from the same rentals the model trains on.
+    if not comp_count:
+        return None
+    return comps.RentalIndex.from_listings_df(raw_df[raw_df["price_dollars"] < MAX_PRICE_DOLLARS], comp_count)
+
+def get_model_rental_index(reg):
+    return getattr(reg, "rental_index", None)
+
+def save_model(model_dir, reg, metadata):
+    path = os.path.join(model_dir, metadata["fingerprint"])
+    os.makedirs(path, exist_ok=True)
+    reg.save_model(os.path.join(path, "model.json"))
+    rental_index = get_model_rental_index(reg)
+    if rental_index is not None:
+        np.savez(os.path.join(path, "comps.npz"), **rental_index.to_arrays())
+    with open(os.path.join(path, "metadata.json"), "w") as outfile:
+        json.dump(metadata, outfile, indent=2, default=float)
+
+def load_model(model_dir, fingerprint):
+    # Returns (regressor, metadata), or None if no model was saved under
+    # fingerprint.
+    path = os.path.join(model_dir, fingerprint)
+    try:
+        with open(os.path.join(path, "metadata.json")) as infile:
+            metadata = json.load(infile)
+    except FileNotFoundError:
+        return None
+    reg = XGBRegressor()
+    reg.load_model(os.path.join(path, "model.json"))
+    reg.fingerprint = metadata["fingerprint"]
+    comps_path = os.path.join(path, "comps.npz")
+    if os.path.exists(comps_path):
+        with np.load(comps_path, allow_pickle=False) as arrays:
+            reg.rental_index = comps.RentalIndex.from_arrays(arrays)
+    return reg, metadata
+
+def load_latest_model(model_dir):
+    # The most recently saved model of the current MODEL_VERSION.
+    paths = sorted(
+        glob.glob(os.path.join(model_dir, "*", "metadata.json")),
+        key=os.path.getmtime,
+        reverse=True,
+    )
+    for path in paths:
+        with open(path) as infile:
+            if json.load(infile).get("model_version", 1) == MODEL_VERSION:
+                return load_model(model_dir, os.path.basename(os.path.dirname(path)))
+    return None
+
+def get_score_fingerprint(reg, dcf_assumptions=None):
+    # Identifies what stored scores were computed with: the rent model (as
+    # set by train and load_model) and the DCF assumptions.
+    key = [getattr(reg, "fingerprint", None), dict(DCF_ASSUMPTIONS, **(dcf_assumptions or {}))]
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode("utf-8")).hexdigest()[:24]
+
+def get_model_feature_columns(reg):
+    return reg.get_booster().feature_names
+
+def get_model_amenity_vocabulary(reg):
+    return tuple(
+        col[len("amenity_"):] for col in get_model_feature_columns(reg) if col.startswith("amenity_")
     )
-    reg.fit(features_train, targets_train)
 
-    predicted_train_targets = reg.predict(features_train)
+def train(
+        raw_df,
+        amenity_vocabulary=COMMON_AMENITIES,
+        hyperparameters=None,
+        model_dir=None,
+        warm_start=False,
+        comp_count=0,
+        amenity_matrix=None):
+    # With model_dir, the fitted model, its feature columns and metrics are
+    # saved under a fingerprint of the training set and hyperparameters, and
+    # reloaded instead of retraining when the fingerprint matches. With
+    # warm_start, a new fingerprint continues boosting from the latest saved
+    # model (if its features match and it has room for WARM_START_ROUNDS more
+    # under MAX_WARM_START_MODEL_ROUNDS) rather than starting from scratch. With
+    # comp_count, the model also uses features of the comp_count nearest
+    # rentals and keeps the comps.RentalIndex as reg.rental_index. An
+    # amenity_matrix over amenity_vocabulary replaces parsing raw_df's
+    # amenities, as for clean_features.
+    hyperparameters = dict(DEFAULT_HYPERPARAMETERS if hyperparameters is None else hyperparameters)
+    with metrics.registry.stage("featurize_rentals"):
+        rental_index = get_rental_index(raw_df, comp_count)
+        features, targets = get_training_set(raw_df, amenity_vocabulary, rental_index, amenity_matrix)
+    fingerprint = fingerprint_training_set(features, targets, hyperparameters)
+    if model_dir is not None:
+        cached = load_model(model_dir, fingerprint)
+        if cached is not None:
+            reg, metadata = cached
+            print("Loaded rent model {} trained {}".format(fingerprint, metadata["trained_at"]))
+            print("Training metrics:")
+            print(metadata["training_metrics"])
+            print("Test metrics:")
+            print(metadata["test_metrics"])
+            return reg
+
+    matrix = get_model_matrix(features)
+    test_rows = get_test_rows(raw_df.loc[features.index, "permalink"])
+    features_train, features_test = matrix[~test_rows], matrix[test_rows]
+    targets_train, targets_test = targets[~test_rows], targets[test_rows]
+
+    base_model = None
+    if warm_start and model_dir is not None:
+        latest = load_latest_model(model_dir)
+        if latest is not None and get_model_feature_columns(latest[0]) == list(features.columns):
+            base_rounds = latest[0].get_booster().num_boosted_rounds()
+            if base_rounds + WARM_START_ROUNDS > MAX_WARM_START_MODEL_ROUNDS:
+                print("Training rent model from scratch: {} already has {} rounds".format(
+                    latest[1]["fingerprint"], base_rounds))
+            else:
+                # Named like the DataFrame it was trained on, which the
+                # matrix it continues on is not; names are set again after
+                # fitting.
+                base_model = latest[0].get_booster().copy()
+                base_model.feature_names = None
+                print("Warm-starting rent model from {}".format(latest[1]["fingerprint"]))
+
+    reg = XGBRegressor(**dict(
+        hyperparameters,
+        **({"n_estimators": WARM_START_ROUNDS} if base_model is not None else {})
+    ))
+    with metrics.registry.stage("fit"):
+        reg.fit(features_train, targets_train, xgb_model=base_model)
+    reg.get_booster().feature_names = list(features.columns)
+    reg.rental_index = rental_index
+    reg.fingerprint = fingerprint
+    metrics.registry.increment("rent_model_training_rows_total", features_train.shape[0])
+
+    predicted_train_targets = predict_rents(reg, features_train)
+    training_metrics = compute_model_metrics(targets_train, predicted_train_targets)
     print("Training metrics:")
-    print(compute_model_metrics(targets_train, predicted_train_targets))
+    print(training_metrics)
 
-    predicted_test_targets = reg.predict(features_test)
+    predicted_test_targets = predict_rents(reg, features_test)
+    test_metrics = compute_model_metrics(targets_test, predicted_test_targets)
     print("Test metrics:")
-    print(compute_model_metrics(targets_test, predicted_test_targets))
-    
+    print(test_metrics)
+
+    if model_dir is not None:
+        save_model(model_dir, reg, {
+            "fingerprint": fingerprint,
+            "model_version": MODEL_VERSION,
+            "trained_at": datetime.datetime.now().isoformat(timespec="seconds"),
+            "hyperparameters": hyperparameters,
+            "feature_columns": list(features.columns),
+            "training_rows": len(features),
+            "training_metrics": training_metrics,
+            "test_metrics": test_metrics,
+        })
     return reg
 
+HYPERPARAMETER_GRID = {
+    "max_depth": [2, 3, 4, 6],
+    "colsample_bytree": [0.25, 0.5, 0.8],
+    "learning_rate": [0.05, 0.1, 0.3],
+    "min_child_weight": [1, 5],
+    "subsample": [0.8, 1.0],
+}
+MAX_TUNING_ROUNDS = 2000
+EARLY_STOPPING_ROUNDS = 25
+# xgboost before 1.6 (Pipfile.lock pins 1.5.0) only takes early stopping in
+# fit(); 2.0 and later only take it in the constructor.
+EARLY_STOPPING_IN_FIT = "early_stopping_rounds" in inspect.signature(XGBRegressor.fit).parameters
+
+def iter_hyperparameter_configs(grid=HYPERPARAMETER_GRID, sample_count=None, seed=0):
+    # Every combination in grid, or sample_count of them drawn at random.
+    names = sorted(grid)
+    configs = [dict(zip(names, values)) for values in itertools.product(*(grid[name] for name in names))]
+    if sample_count is not None and sample_count < len(configs):
+        configs = random.Random(seed).sample(configs, sample_count)
+    return configs
+
+_tuning_set = None
+
+def _set_tuning_set(features, targets):
+    global _tuning_set
+    _tuning_set = (features, targets)
+
+def _fit_tuning_fold(hyperparameters, train_index, test_index, seed):
+    # Runs in a worker process. Early stopping uses a slice of the training
+    # fold, so the held-out fold is only used for scoring.
+    features, targets = _tuning_set
+    start = time.time()
+    cpu_start = time.process_time()
+    features_fit, features_stop, targets_fit, targets_stop = train_test_split(
+        features[train_index], targets.iloc[train_index], test_size=0.10, random_state=seed,
+    )
+    early_stopping = {"early_stopping_rounds": EARLY_STOPPING_ROUNDS}
+    reg = XGBRegressor(
+        **hyperparameters,
+        **({} if EARLY_STOPPING_IN_FIT else early_stopping),
+        n_estimators=MAX_TUNING_ROUNDS,
+        tree_method="hist",
+        n_jobs=1,
+    )
+    reg.fit(
+        features_fit, targets_fit,
+        eval_set=[(features_stop, targets_stop)],
+        verbose=False,
+        **(early_stopping if EARLY_STOPPING_IN_FIT else {}),
+    )
+    predicted_targets = reg.predict(features[test_index])
+    return predicted_targets, reg.best_iteration + 1, start, time.time(), time.process_time() - cpu_start
+
+def tune(raw_df, amenity_vocabulary=COMMON_AMENITIES, configs=None, fold_count=5, workers=None, seed=0, comp_count=0):
+    # k-fold cross-validation of each hyperparameter config, with every
+    # (config, fold) fit spread over a process pool. Returns one result per
+    # config with its out-of-fold compute_model_metrics, the number of
+    # boosting rounds early stopping settled on, the wall-clock time from its
+    # first fold starting to its last finishing (folds of several configs run
+    # at once) and the CPU time of its fold fits, best (lowest RMS error)
+    # first.
+    features, targets = get_training_set(raw_df, amenity_vocabulary, get_rental_index(raw_df, comp_count))
+    configs = iter_hyperparameter_configs() if configs is None else configs
+    folds = list(KFold(n_splits=fold_count, shuffle=True, random_state=seed).split(features))
+    started = time.perf_counter()
+
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=_set_tuning_set,
+            initargs=(get_model_matrix(features), targets)) as executor:
+        fold_fits = [
+            [executor.submit(_fit_tuning_fold, config, train_index, test_index, seed) for train_index, test_index in folds]
+            for config in configs
+        ]
+        results = []
+        for config, fits in zip(configs, fold_fits):
+            predicted_targets = np.empty(len(targets))
+            rounds = []
+            fold_starts = []
+            fold_ends = []
+            cpu_seconds = 0.0
+            for (_, test_index), fit in zip(folds, fits):
+                fold_predicted_targets, fold_rounds, fold_start, fold_end, fold_cpu_seconds = fit.result()
+                predicted_targets[test_index] = fold_predicted_targets
+                rounds.append(fold_rounds)
+                fold_starts.append(fold_start)
+                fold_ends.append(fold_end)
+                cpu_seconds += fold_cpu_seconds
+            result = {
+                "hyperparameters": dict(config, n_estimators=int(np.mean(rounds)), tree_method="hist"),
+                "metrics": compute_model_metrics(targets, predicted_targets),
+                "wall_time_seconds": max(fold_ends) - min(fold_starts),
+                "cpu_seconds": cpu_seconds,
+            }
+            print(json.dumps(result, default=float))
+            results.append(result)
+    wall_seconds = time.perf_counter() - started
+    metrics.registry.set_gauge("tune_wall_seconds", wall_seconds)
+    print("Tuned {} configs x {} folds in {:.1f}s wall clock, {:.1f}s CPU".format(
+        len(configs), fold_count, wall_seconds, sum(result["cpu_seconds"] for result in results)))
+    return sorted(results, key=lambda result: result["metrics"]["RMS error"])
+
+def load_hyperparameters(path):
+    if path is None or not os.path.exists(path):
+        return None
+    with open(path) as infile:
+        return json.load(infile)
+
+def save_hyperparameters(path, hyperparameters):
+    with open(path, "w") as outfile:
+        json.dump(hyperparameters, outfile, indent=2, sort_keys=True)
+
 def zero_if_nan(f):
     return 0 if np.isnan(f) else f
 
-def get_irr(row):
-    # permalink,address,neighborhood,latitude,longitude,price_dollars,original_price_dollars,sq_ft,beds,baths,year_opened,building_id,building_units,monthly_sales_charges,monthly_sales_charges_incl_taxes,unit_type,first_listed,parking_spaces,amenities
+def get_capital_reserve(df):
     # =if(K6014>=2010,200,if(K6014>=2000,300,400))*if(G6014>=2000000,1.5,1)*if(I6014<=2,1,2)
-    year_built = row["year_opened"]
-    capital_reserve = (
-        (200 if year_built >= 2010 else 300 if year_built >= 2000 else 400) *
-        (1.5 if row["price_dollars"] >= 2000000 else 1) *
-        (2 if row["beds"] >= 2 else 1)
+    # The price term is left to the DCF (see DCF_ASSUMPTIONS), so that it
+    # follows the purchase price when a listing is repriced.
+    year_built = np.asarray(df["year_opened"], dtype=np.float64)
+    return (
+        np.where(year_built >= 2010, 200, np.where(year_built >= 2000, 300, 400)) *
+        np.where(np.asarray(df["beds"], dtype=np.float64) >= 2, 2, 1)
     )
-    try:
-        return dcf.get_unlevered_returns(
-            purchase_price_dollars=1575000,
-            sq_ft=row["sq_ft"],
-            closing_costs_pct=0.04,
-            initial_downtime_months=3,
-            interim_downtime_months=1,
-            lease_length_months=36,
-            annual_rent_growth_pct=0.02,
-            annual_expense_growth_pct=0.02,
-            monthly_rent_dollars=row["predicted_rent"],
-            monthly_utilities_rent_pct=0.025,
-            monthly_tax_dollars=zero_if_nan(row["monthly_sales_charges_incl_taxes"]) - zero_if_nan(row["monthly_sales_charges"]),
-            monthly_common_charges_dollars=zero_if_nan(row["monthly_sales_charges"]),
-            monthly_homeowners_insurance_dollars=100,
-            monthly_capital_reserve_dollars=capital_reserve,
-            hold_period_months=60,
-            exit_cap_pct=0.035,
-            exit_sq_ft_price_ceiling_dollars=3000,
-            exit_costs_pct=0.08,
-        ).irr_pct
-    except Exception as error:
-        import pdb; pdb.set_trace()
-        raise
-    
-
-def regress(sales_df, reg):
-    clean_df = clean_features(sales_df)
-    df = clean_df[select_feature_columns(clean_df)]
-    sales_df["predicted_rent"] = reg.predict(df)
-    sales_df["irr"] = np.array([get_irr(r) for _, r in sales_df.iterrows()])
 
+def zero_nans(values):
+    values = np.asarray(values, dtype=np.float64)
+    return np.where(np.isnan(values), 0.0, values)
+
+# get_unlevered_returns arguments that are the same for every listing.
+DCF_ASSUMPTIONS = dict(
+    closing_costs_pct=0.04,
+    initial_downtime_months=3,
+    interim_downtime_months=1,
+    lease_length_months=36,
+    annual_rent_growth_pct=0.02,
+    annual_expense_growth_pct=0.02,
+    monthly_utilities_rent_pct=0.025,
+    monthly_homeowners_insurance_dollars=100,
+    capital_reserve_price_threshold_dollars=2000000,
+    capital_reserve_price_multiple=1.5,
+    hold_period_months=60,
+    exit_cap_pct=0.035,
+    exit_sq_ft_price_ceiling_dollars=3000,
+    exit_costs_pct=0.08,
+)
+
+# Overrides of DCF_ASSUMPTIONS for each of compass.MARKETS.
+MARKET_DCF_ASSUMPTIONS = {
+    "bk": {},
+    "long-island": dict(
+        monthly_homeowners_insurance_dollars=150,
+        exit_cap_pct=0.045,
+        exit_sq_ft_price_ceiling_dollars=1000,
+    ),
+    "austin": dict(
+        closing_costs_pct=0.02,
+        annual_rent_growth_pct=0.03,
+        monthly_homeowners_insurance_dollars=200,
+        exit_cap_pct=0.05,
+        exit_sq_ft_price_ceiling_dollars=600,
+    ),
+}
+
+def get_dcf_kwargs(df, dcf_assumptions=None):
+    # df is a DataFrame of listings or any mapping of column name to array.
+    # dcf_assumptions overrides any of DCF_ASSUMPTIONS.
+    # permalink,address,neighborhood,latitude,longitude,price_dollars,original_price_dollars,sq_ft,beds,baths,year_opened,building_id,building_units,monthly_sales_charges,monthly_sales_charges_incl_taxes,unit_type,first_listed,parking_spaces,amenities
+    sales_charges = zero_nans(df["monthly_sales_charges"])
+    sales_charges_incl_taxes = zero_nans(df["monthly_sales_charges_incl_taxes"])
+    return dict(
+        DCF_ASSUMPTIONS,
+        **(dcf_assumptions or {}),
+        purchase_price_dollars=np.asarray(df["price_dollars"], dtype=np.float64),
+        sq_ft=np.asarray(df["sq_ft"], dtype=np.float64),
+        monthly_rent_dollars=np.asarray(df["predicted_rent"], dtype=np.float64),
+        monthly_tax_dollars=sales_charges_incl_taxes - sales_charges,
+        monthly_common_charges_dollars=sales_charges,
+        monthly_capital_reserve_dollars=get_capital_reserve(df),
+    )
+
+def get_irrs(df, dcf_assumptions=None):
+    # dcf.IrrSolution of each listing's annualized IRR and IRR count.
+    ret = dcf.get_unlevered_returns_batch(**get_dcf_kwargs(df, dcf_assumptions))
+    return dcf.IrrSolution(rate=ret.irr_pct, root_count=ret.irr_root_count)
+
+TARGET_IRR_PCT = 0.08
+
+def get_max_purchase_prices(df, target_irr_pct=TARGET_IRR_PCT, dcf_assumptions=None):
+    return dcf.get_max_purchase_prices_batch(target_irr_pct, **get_dcf_kwargs(df, dcf_assumptions))
+
+def get_feature_matrix(columns, reg):
+    # clean_features(df)[get_model_feature_columns(reg)] as a dense float32
+    # array, for a mapping of column name to array of CompassListing
+    # fields. Without a DataFrame in the way, this is much cheaper for the
+    # handful of listings scored per request by scoreserver.
+    feature_columns = get_model_feature_columns(reg)
+    row_count = len(columns["permalink"])
+    rental_index = get_model_rental_index(reg)
+    comp_features = rental_index.get_comp_features(columns) if rental_index is not None else {}
+    amenity_sets = [set(to_amenity_list(amenities)) for amenities in columns["amenities"]]
+    matrix = np.empty((row_count, len(feature_columns)), dtype=np.float32)
+    for i, col in enumerate(feature_columns):
+        if col in comp_features:
+            matrix[:, i] = comp_features[col]
+        elif col.startswith("amenity_"):
+            # Absent amenities are missing, as in get_model_matrix.
+            amenity = col[len("amenity_"):]
+            matrix[:, i] = [1.0 if amenity in amenities else np.nan for amenities in amenity_sets]
+        else:
+            matrix[:, i] = np.asarray(columns[col], dtype=np.float64)
+    return matrix
+
+def regress(sales_df, reg, store=None, amenity_vocabulary=None, amenity_matrix=None, dcf_assumptions=None):
+    # With a listingstore.ListingStore, rows whose listing is unchanged since
+    # it was last scored by the same model and dcf_assumptions reuse the
+    # stored predicted rent, IRR and IRR count, and rows whose only change is
+    # a new price reuse the stored predicted rent and are just repriced. An
+    # amenity_matrix must have a row per row of sales_df and a column per
+    # entry of amenity_vocabulary. dcf_assumptions is as for get_dcf_kwargs.
+    stored_scores = {}
+    repriced_rents = {}
+    if store is not None:
+        store.set_score_fingerprint(get_score_fingerprint(reg, dcf_assumptions))
+        stored_scores = store.get_current_scores(sales_df["permalink"])
+    to_score = ~sales_df["permalink"].isin(stored_scores.keys()).to_numpy()
+    if store is not None and to_score.any():
+        repriced_rents = store.get_repriced_rents(sales_df.loc[to_score, "permalink"])
+    sales_df["predicted_rent"] = np.nan
+    sales_df["irr"] = np.nan
+    sales_df["irr_root_count"] = np.nan
+    metrics.registry.increment("sales_score_reused_total", int(np.sum(~to_score)))
+    if not to_score.all():
+        scores = np.array(
+            [stored_scores[permalink] for permalink in sales_df.loc[~to_score, "permalink"]],
+            dtype=np.float64,
+        )
+        sales_df.loc[~to_score, "predicted_rent"] = scores[:, 0]
+        sales_df.loc[~to_score, "irr"] = scores[:, 1]
+        sales_df.loc[~to_score, "irr_root_count"] = scores[:, 2]
+    if not to_score.any():
+        return
+
+    score_df = sales_df[to_score].reset_index(drop=True)
+    repriced = score_df["permalink"].isin(repriced_rents.keys()).to_numpy()
+    metrics.registry.increment("sales_repriced_total", int(np.sum(repriced)))
+    score_df.loc[repriced, "predicted_rent"] = [repriced_rents[permalink] for permalink in score_df.loc[repriced, "permalink"]]
+    if not repriced.all():
+        # Features are built to match whatever the model was trained on,
+        # which may be a model loaded from disk.
+        if amenity_vocabulary is None:
+            amenity_vocabulary = get_model_amenity_vocabulary(reg)
+        predict_df = score_df[~repriced].reset_index(drop=True)
+        with metrics.registry.stage("featurize_sales"):
+            clean_df = clean_features(
+                predict_df,
+                amenity_vocabulary,
+                get_model_rental_index(reg),
+                amenity_matrix[to_score][~repriced] if amenity_matrix is not None else None,
+            )
+            df = clean_df[get_model_feature_columns(reg)]
+        with metrics.registry.stage("predict"):
+            score_df.loc[~repriced, "predicted_rent"] = predict_rents(reg, get_model_matrix(df))
+    with metrics.registry.stage("dcf"):
+        score_df["irr"], score_df["irr_root_count"] = get_irrs(score_df, dcf_assumptions)
+    metrics.registry.increment("sales_scored_total", len(score_df))
+    sales_df.loc[to_score, "predicted_rent"] = score_df["predicted_rent"].to_numpy()
+    sales_df.loc[to_score, "irr"] = score_df["irr"].to_numpy()
+    sales_df.loc[to_score, "irr_root_count"] = score_df["irr_root_count"].to_numpy()
+    if store is not None:
+        store.put_scores(score_df["permalink"], score_df["predicted_rent"], score_df["irr"], score_df["irr_root_count"])
+
+
+SCORE_BATCH_SIZE = 500
+
+def iter_batches(iterable, batch_size):
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, batch_size))
+        if not batch:
+            return
+        yield batch
+
+def score_batches(batches, reg, store=None, target_irr_pct=TARGET_IRR_PCT, record=False, dcf_assumptions=None):
+    # Scores batches of CompassListings as they arrive, yielding each as a
+    # scored DataFrame indexed continuously across batches. The feature
+    # schema is fixed up front from the model, so every batch is featurized
+    # on its own and memory is bounded by the batch size. With record=True
+    # each batch is recorded in store first, so that scores of listings
+    # scraped on the fly are stored too.
+    started = time.perf_counter()
+    amenity_vocabulary = get_model_amenity_vocabulary(reg)
+    row_count = 0
+    for batch in batches:
+        if record:
+            store.record_listings(compass.LISTING_TYPE_SALE, batch)
+        listing_batch = compass.ListingBatch(batch)
+        sales_df = listing_batch.to_df()
+        regress(
+            sales_df,
+            reg,
+            store,
+            amenity_vocabulary,
+            listing_batch.get_amenity_matrix(amenity_vocabulary),
+            dcf_assumptions,
+        )
+        sales_df["max_purchase_price_dollars"] = get_max_purchase_prices(sales_df, target_irr_pct, dcf_assumptions)
+        sales_df.index += row_count
+        if row_count == 0:
+            metrics.registry.set_gauge("scoring_first_batch_seconds", time.perf_counter() - started)
+        row_count += len(sales_df)
+        yield sales_df
+
+def score_listings(listings, reg, batch_size=SCORE_BATCH_SIZE, store=None, target_irr_pct=TARGET_IRR_PCT, record=False):
+    # Streaming regress over any iterable of CompassListings, such as
+    # compass.query_compass, batch_size listings at a time.
+    return score_batches(iter_batches(listings, batch_size), reg, store, target_irr_pct, record)
+
+def tee_listings_csv(listings, outfile):
+    # Passes listings through while also writing them to outfile as CSV.
+    writer = csv.writer(outfile)
+    writer.writerow(compass.CompassListing._fields)
+    for listing in listings:
+        writer.writerow(listing)
+        yield listing
+
+def append_frames_csv(frames, path):
+    # Writes each frame to a CSV as soon as it arrives; returns the row count.
+    row_count = 0
+    with open(path, "w") as outfile:
+        for df in frames:
+            df.to_csv(outfile, header=row_count == 0)
+            outfile.flush()
+            row_count += len(df)
+    return row_count
+
+def write_frame(df, path):
+    # Output format follows the file extension, as for listing files.
+    fmt = compass.get_listing_format(path)
+    if fmt == "parquet":
+        df.to_parquet(path)
+    elif fmt == "arrow":
+        df.reset_index(drop=True).to_feather(path)
+    else:
+        df.to_csv(path)
+
+def get_sensitivity(sales_df, scenario_grid=dcf.SENSITIVITY_GRID):
+    # IRR, MOIC and profit of every scored sale under every scenario, one row
+    # per (permalink, scenario).
+    sensitivity_df = dcf.get_sensitivity_returns(get_dcf_kwargs(sales_df), scenario_grid)
+    sensitivity_df.insert(0, "permalink", sales_df["permalink"].to_numpy()[sensitivity_df["listing"]])
+    return sensitivity_df.drop(columns=["listing"])
+
+def add_simulated_returns(sales_df, path_count, seed=0, workers=1):
+    # Adds Monte Carlo IRR percentiles and loss probability columns for every
+    # scored sale, drawing the uncertain DCF inputs from
+    # dcf.SIMULATION_DISTRIBUTIONS.
+    simulated_df = dcf.simulate_returns(
+        get_dcf_kwargs(sales_df),
+        path_count=path_count,
+        seed=seed,
+        workers=workers,
+    )
+    for column in simulated_df.columns.drop("listing"):
+        sales_df[column] = simulated_df[column].to_numpy()
+
+def parse_floats(s):
+    return [float(x) for x in s.split(",")]
 
 def main(argv):
-    rentals_df = pd.read_csv(argv[1])
-    sales_df = pd.read_csv(argv[2])
-    reg = train(rentals_df)
-    regress(sales_df, reg)
-    sales_df.to_csv(argv[3])
+    import argparse
+    parser = argparse.ArgumentParser(description="Model rents and estimate the IRR of sale listings")
+    parser.add_argument("rentals_csv", nargs="?",
+                        help="Rental listings (.csv, .parquet or .arrow); not needed with --score-only")
+    parser.add_argument("sales_csv", help="Sale listings (.csv, .parquet or .arrow); "
+                                          "with --scrape-sales, where to write the scraped sales as CSV")
+    parser.add_argument("output_csv", help="Scored sales; the extension picks the format")
+    parser.add_argument("--store", help="Listing store; only new or changed sales are re-scored")
+    parser.add_argument("--learn-amenities", action="store_true",
+                        help="Learn the amenity vocabulary from the rentals instead of COMMON_AMENITIES")
+    parser.add_argument("--min-amenity-count", type=int, default=MIN_LEARNED_AMENITY_COUNT)
+    parser.add_argument("--model-dir", help="Directory of saved rent models, keyed by training-set fingerprint")
+    parser.add_argument("--warm-start", action="store_true",
+                        help="Continue boosting from the latest saved model when the rentals have changed")
+    parser.add_argument("--score-only", action="store_true",
+                        help="Skip training and score with the latest model in --model-dir")
+    parser.add_argument("--hyperparameters",
+                        help="JSON rent model hyperparameters (default: hyperparameters.json in --model-dir)")
+    parser.add_argument("--comp-count", type=int, default=0,
+                        help="Add features of each listing's nearest N rental comps to the rent model")
+    parser.add_argument("--tune", action="store_true",
+                        help="Cross-validate HYPERPARAMETER_GRID on the rentals and save the best config "
+                             "to --hyperparameters before training")
+    parser.add_argument("--tune-folds", type=int, default=5)
+    parser.add_argument("--tune-samples", type=int, help="Random search over this many configs instead of the full grid")
+    parser.add_argument("--tune-workers", type=int, help="Worker processes (default: one per core)")
+    parser.add_argument("--sensitivity-output",
+                        help="Also write IRR/MOIC/profit for every sale x scenario to this file (.parquet recommended)")
+    parser.add_argument("--exit-cap-pcts", type=parse_floats, default=dcf.SENSITIVITY_GRID["exit_cap_pct"])
+    parser.add_argument("--rent-growth-pcts", type=parse_floats, default=dcf.SENSITIVITY_GRID["annual_rent_growth_pct"])
+    parser.add_argument("--hold-periods", type=lambda s: [int(x) for x in s.split(",")],
+                        default=dcf.SENSITIVITY_GRID["hold_period_months"])
+    parser.add_argument("--target-irr", type=float, default=TARGET_IRR_PCT,
+                        help="Annualized IRR used for the max_purchase_price_dollars column")
+    parser.add_argument("--simulation-paths", type=int, default=0,
+                        help="Add Monte Carlo IRR percentiles over this many paths per sale")
+    parser.add_argument("--simulation-seed", type=int, default=0)
+    parser.add_argument("--simulation-workers", type=int, default=1)
+    parser.add_argument("--scrape-sales", action="store_true",
+                        help="Scrape sales from Compass and score them in batches as they arrive "
+                             "instead of reading sales_csv; output_csv must be a CSV")
+    parser.add_argument("--base-url", default=compass.COMPASS_BASE_URL)
+    parser.add_argument("--concurrency", type=int, default=1)
+    parser.add_argument("--batch-size", type=int, default=SCORE_BATCH_SIZE,
+                        help="Sales scored at a time with --scrape-sales")
+    parser.add_argument("--metrics", help="Write run metrics to this file (.prom for Prometheus, else JSON)")
+    parser.add_argument("--profile-dir", help="Write cProfile stats for each stage to this directory")
+
+    parsed = parser.parse_args(argv[1:])
+    if parsed.profile_dir:
+        metrics.registry.enable_profiling(parsed.profile_dir)
+    if parsed.score_only and not parsed.model_dir:
+        parser.error("--score-only requires --model-dir")
+    if not parsed.score_only and parsed.rentals_csv is None:
+        parser.error("rentals_csv is required unless --score-only")
+    hyperparameters_path = parsed.hyperparameters or (
+        os.path.join(parsed.model_dir, "hyperparameters.json") if parsed.model_dir else None
+    )
+    if parsed.tune and hyperparameters_path is None:
+        parser.error("--tune requires --hyperparameters or --model-dir")
+    if parsed.scrape_sales and (parsed.sensitivity_output or parsed.simulation_paths > 0):
+        parser.error("--sensitivity-output and --simulation-paths need every sale and can't be used with --scrape-sales")
+    if parsed.scrape_sales and compass.get_listing_format(parsed.output_csv) != "csv":
+        parser.error("--scrape-sales writes output_csv incrementally, which requires a .csv file")
+    if parsed.score_only:
+        latest = load_latest_model(parsed.model_dir)
+        if latest is None:
+            parser.error("No saved rent model in {}".format(parsed.model_dir))
+        reg = latest[0]
+    else:
+        with metrics.registry.stage("load"):
+            rentals_df = compass.read_listings_df(parsed.rentals_csv)
+        amenity_vocabulary = (
+            learn_amenity_vocabulary(rentals_df, parsed.min_amenity_count) if parsed.learn_amenities else
+            COMMON_AMENITIES
+        )
+        if parsed.tune:
+            with metrics.registry.stage("tune"):
+                results = tune(
+                    rentals_df,
+                    amenity_vocabulary,
+                    configs=iter_hyperparameter_configs(sample_count=parsed.tune_samples),
+                    fold_count=parsed.tune_folds,
+                    workers=parsed.tune_workers,
+                    comp_count=parsed.comp_count,
+                )
+            if parsed.model_dir:
+                os.makedirs(parsed.model_dir, exist_ok=True)
+            save_hyperparameters(hyperparameters_path, results[0]["hyperparameters"])
+            print("Best hyperparameters: {}".format(results[0]["hyperparameters"]))
+        with metrics.registry.stage("train"):
+            reg = train(
+                rentals_df,
+                amenity_vocabulary,
+                hyperparameters=load_hyperparameters(hyperparameters_path),
+                model_dir=parsed.model_dir,
+                warm_start=parsed.warm_start,
+                comp_count=parsed.comp_count,
+            )
+    store = None
+    if parsed.store:
+        import listingstore
+        store = listingstore.ListingStore(parsed.store)
+    if parsed.scrape_sales:
+        client = compass.CompassClient(concurrency=parsed.concurrency, base_url=parsed.base_url)
+        with client, open(parsed.sales_csv, "w") as sales_file, metrics.registry.stage("score"):
+            append_frames_csv(
+                score_listings(
+                    tee_listings_csv(client.query_compass(compass.LISTING_TYPE_SALE, compass.BK_LOCATIONS), sales_file),
+                    reg,
+                    parsed.batch_size,
+                    store,
+                    parsed.target_irr,
+                    record=store is not None,
+                ),
+                parsed.output_csv,
+            )
+        if store is not None:
+            store.close()
+        if parsed.metrics:
+            metrics.registry.write(parsed.metrics)
+        return 0
+
+    with metrics.registry.stage("load"):
+        sales_df = compass.read_listings_df(parsed.sales_csv)
+    with metrics.registry.stage("score"):
+        regress(sales_df, reg, store)
+    if store is not None:
+        store.close()
+    with metrics.registry.stage("max_purchase_price"):
+        sales_df["max_purchase_price_dollars"] = get_max_purchase_prices(sales_df, parsed.target_irr)
+    if parsed.simulation_paths > 0:
+        with metrics.registry.stage("simulation"):
+            add_simulated_returns(sales_df, parsed.simulation_paths, parsed.simulation_seed, parsed.simulation_workers)
+    with metrics.registry.stage("write"):
+        write_frame(sales_df, parsed.output_csv)
+    if parsed.sensitivity_output:
+        with metrics.registry.stage("sensitivity"):
+            write_frame(
+                get_sensitivity(sales_df, {
+                    "exit_cap_pct": parsed.exit_cap_pcts,
+                    "annual_rent_growth_pct": parsed.rent_growth_pcts,
+                    "hold_period_months": parsed.hold_periods,
+                }),
+                parsed.sensitivity_output,
+            )
+    if parsed.metrics:
+        metrics.registry.write(parsed.metrics)
     return 0
 
 if __name__ == "__main__":
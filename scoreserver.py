@@ -0,0 +1,263 @@
+#!/usr/bin/env python
+
+import http.server
+import json
+import math
+import os
+import sys
+import threading
+import time
+
+import numpy as np
+
+import compass
+import dcf
+import metrics
+import rentregress
+
+# Scores sale listings on request with a rent model loaded once at startup,
+# so an ad hoc IRR lookup costs milliseconds rather than a rentregress.py run.
+# POST /score takes a JSON object with one of
+#
+#   {"listing": {...}}     a CompassListing as an object (missing fields are null)
+#   {"listings": [...]}
+#   {"permalink": "..."}   a sale listing already in --store
+#   {"permalinks": [...]}
+#
+# and returns {"results": [...], "missing": [...]}: the predicted rent,
+# UnleveredReturn fields and max purchase price of each listing, and any
+# permalinks not found in the store. GET /health describes the loaded model
+# and GET /metrics returns the run metrics in Prometheus format.
+#
+#   ./scoreserver.py --model-dir rent-models --store listings.db &
+#   curl -s localhost:8100/score -d '{"permalink": "..."}'
+
+def to_json_number(value):
+    # JSON has no nan or infinity.
+    value = float(value)
+    return value if math.isfinite(value) else None
+
+def parse_amenities(amenities):
+    # amenities as the JSON list a scraped listing carries, from either that
+    # JSON or a list of strings.
+    if amenities is None:
+        return None
+    if isinstance(amenities, str):
+        try:
+            amenities = json.loads(amenities)
+        except ValueError:
+            raise ValueError("amenities is not valid JSON: {!r}".format(amenities)) from None
+    if not isinstance(amenities, list) or not all(isinstance(amenity, str) for amenity in amenities):
+        raise ValueError("amenities must be a list of strings")
+    return json.dumps(amenities)
+
+def parse_listing(fields):
+    if not isinstance(fields, dict):
+        raise ValueError("Expected each listing as a JSON object")
+    unknown = set(fields) - set(compass.CompassListing._fields)
+    if unknown:
+        raise ValueError("Unknown listing fields: {}".format(", ".join(sorted(unknown))))
+    listing = compass.CompassListing(**{field: fields.get(field) for field in compass.CompassListing._fields})
+    return listing._replace(
+        amenities=parse_amenities(listing.amenities),
+        **{
+            field: float(getattr(listing, field))
+            for field in compass.NUMERIC_LISTING_FIELDS if getattr(listing, field) is not None
+        }
+    )
+
+def get_listing_columns(listings):
+    # Listings as a mapping of field to array, with numeric fields as float
+    # (nan where missing) like compass.listings_to_df.
+    columns = dict(zip(compass.CompassListing._fields, (list(values) for values in zip(*listings))))
+    for field in compass.NUMERIC_LISTING_FIELDS:
+        columns[field] = np.asarray(columns[field], dtype=np.float64)
+    return columns
+
+class Scorer(object):
+    # The loaded model and everything derived from it that scoring needs.
+    # Listings are featurized straight into arrays rather than through a
+    # DataFrame, which for a single listing is most of the cost of scoring.
+    # Scoring is serialized, since the model is not promised to be safe to
+    # call from several threads at once.
+    def __init__(self, reg, metadata=None, store=None, target_irr_pct=rentregress.TARGET_IRR_PCT, market=None):
+        self.reg = reg
+        self.metadata = metadata or {}
+        self.store = store
+        self.target_irr_pct = target_irr_pct
+        self.market = market
+        self.dcf_assumptions = rentregress.MARKET_DCF_ASSUMPTIONS.get(market)
+        self.lock = threading.Lock()
+
+    def score(self, listings):
+        # One result dict per listing, in order.
+        if not listings:
+            return []
+        columns = get_listing_columns(listings)
+        with self.lock:
+            columns["predicted_rent"] = rentregress.predict_rents(self.reg, rentregress.get_feature_matrix(columns, self.reg))
+            start = time.perf_counter()
+            decomposition = dcf.decompose_cash_flows_batch(**rentregress.get_dcf_kwargs(columns, self.dcf_assumptions))
+            returns = dcf.get_decomposed_returns_batch(decomposition, start)
+            max_purchase_prices = dcf.get_decomposed_max_purchase_prices_batch(self.target_irr_pct, decomposition)
+        metrics.registry.increment("scoreserver_listings_scored_total", len(listings))
+        return [
+            dict(
+                permalink=listing.permalink,
+                predicted_rent=to_json_number(columns["predicted_rent"][i]),
+                max_purchase_price_dollars=to_json_number(max_purchase_prices[i]),
+                **{
+                    field: int(values[i]) if field == "irr_root_count" else to_json_number(values[i])
+                    for field, values in zip(returns._fields, returns)
+                }
+            )
+            for i, listing in enumerate(listings)
+        ]
+
+    def get_listings(self, request):
+        # (listings, missing permalinks) named by a /score request body.
+        if not isinstance(request, dict):
+            raise ValueError("Expected a JSON object")
+        if "listing" in request or "listings" in request:
+            fields = [request["listing"]] if "listing" in request else request["listings"]
+            return [parse_listing(f) for f in fields], []
+        if "permalink" in request or "permalinks" in request:
+            if self.store is None:
+                raise ValueError("Scoring by permalink requires --store")
+            permalinks = [request["permalink"]] if "permalink" in request else request["permalinks"]
+            found = self.store.get_listings(permalinks)
+            return (
+                [found[permalink] for permalink in permalinks if permalink in found],
+                [permalink for permalink in permalinks if permalink not in found],
+            )
+        raise ValueError("Expected one of listing, listings, permalink or permalinks")
+
+    def describe(self):
+        return {
+            "fingerprint": self.metadata.get("fingerprint"),
+            "trained_at": self.metadata.get("trained_at"),
+            "feature_columns": len(rentregress.get_model_feature_columns(self.reg)),
+            "comps": rentregress.get_model_rental_index(self.reg) is not None,
+            "store": self.store is not None,
+            "target_irr_pct": self.target_irr_pct,
+            "market": self.market,
+        }
+
+class ScoreServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, scorer):
+        super().__init__(address, ScoreHandler)
+        self.scorer = scorer
+
+class ScoreHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_body(self, status, data, content_type):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_json(self, status, body):
+        self.send_body(status, json.dumps(body).encode("utf-8"), "application/json")
+
+    def do_GET(self):
+        path = self.path.rstrip("/")
+        if path == "/health":
+            self.send_json(200, self.server.scorer.describe())
+        elif path == "/metrics":
+            self.send_body(200, metrics.registry.to_prometheus().encode("utf-8"), "text/plain; version=0.0.4")
+        else:
+            self.send_json(404, {"error": "not found"})
+
+    def do_POST(self):
+        start = time.perf_counter()
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if self.path.rstrip("/") != "/score":
+            self.send_json(404, {"error": "not found"})
+            return
+        try:
+            listings, missing = self.server.scorer.get_listings(json.loads(body))
+        except (ValueError, KeyError, TypeError) as e:
+            metrics.registry.increment("scoreserver_requests_total", status=400)
+            self.send_json(400, {"error": str(e)})
+            return
+        try:
+            results = self.server.scorer.score(listings)
+        except Exception as e:
+            # Whatever got past parsing is the server's fault, but the client
+            # still gets a JSON answer rather than a dropped connection.
+            metrics.registry.increment("scoreserver_requests_total", status=500)
+            self.send_json(500, {"error": "Scoring failed: {!r}".format(e)})
+            return
+        self.send_json(200, {"results": results, "missing": missing})
+        metrics.registry.increment("scoreserver_requests_total", status=200)
+        metrics.registry.observe("scoreserver_request_seconds", time.perf_counter() - start)
+
+def start_in_background(scorer, host="127.0.0.1", port=0):
+    # Starts a server on a daemon thread (on a free port by default) and
+    # returns it; call shutdown() when done.
+    server = ScoreServer((host, port), scorer)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def main(argv):
+    import argparse
+    parser = argparse.ArgumentParser(description="Serve rent and IRR estimates for sale listings over HTTP")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8100)
+    parser.add_argument("--model-dir", help="Score with the latest saved rent model in this directory")
+    parser.add_argument("--rentals", help="Train a rent model on these rentals at startup instead "
+                                          "(saved to --model-dir if given)")
+    parser.add_argument("--comp-count", type=int, default=0,
+                        help="With --rentals, add features of each listing's nearest N rental comps")
+    parser.add_argument("--store", help="Listing store, to score listings by permalink")
+    parser.add_argument("--target-irr", type=float, default=rentregress.TARGET_IRR_PCT)
+    parser.add_argument("--market", choices=list(rentregress.MARKET_DCF_ASSUMPTIONS),
+                        help="Score with this market's DCF assumptions (default: the base assumptions)")
+
+    parsed = parser.parse_args(argv[1:])
+    if not parsed.model_dir and not parsed.rentals:
+        parser.error("One of --model-dir or --rentals is required")
+    if parsed.rentals:
+        reg = rentregress.train(
+            compass.read_listings_df(parsed.rentals),
+            hyperparameters=rentregress.load_hyperparameters(
+                os.path.join(parsed.model_dir, "hyperparameters.json") if parsed.model_dir else None),
+            model_dir=parsed.model_dir,
+            comp_count=parsed.comp_count,
+        )
+        metadata = None
+    else:
+        latest = rentregress.load_latest_model(parsed.model_dir)
+        if latest is None:
+            parser.error("No saved rent model in {}".format(parsed.model_dir))
+        reg, metadata = latest
+    store = None
+    if parsed.store:
+        import listingstore
+        store = listingstore.ListingStore(parsed.store)
+
+    scorer = Scorer(reg, metadata, store, parsed.target_irr, parsed.market)
+    # The first prediction pays for lazy initialization in XGBoost and
+    # pandas; pay it before taking requests.
+    scorer.score([compass.CompassListing(**{field: None for field in compass.CompassListing._fields})])
+    server = ScoreServer((parsed.host, parsed.port), scorer)
+    print("Scoring sale listings on http://{}:{}".format(*server.server_address[:2]), file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if store is not None:
+            store.close()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+
+import json
+import random
+import sys
+
+import compass
+
+# Deterministic synthetic Compass data for benchmarks and local testing.
+# Listings are shaped exactly like the "listing" entries of a Compass search
+# response, so they go through the same extract_listings_from_response path
+# as real scrapes.
+
+NEIGHBORHOODS = (
+    ("DUMBO", 40.7033, -73.9881, 1.35),
+    ("Brooklyn Heights", 40.6960, -73.9933, 1.3),
+    ("Cobble Hill", 40.6865, -73.9962, 1.2),
+    ("Carroll Gardens", 40.6795, -73.9992, 1.15),
+    ("Boerum Hill", 40.6848, -73.9844, 1.1),
+    ("Park Slope", 40.6710, -73.9814, 1.1),
+    ("Fort Greene", 40.6920, -73.9742, 1.05),
+    ("Prospect Heights", 40.6775, -73.9692, 1.0),
+    ("Clinton Hill", 40.6896, -73.9661, 0.95),
+    ("Gowanus", 40.6733, -73.9903, 0.9),
+)
+PROPERTY_TYPES = (
+    (["Condo"], 0.45),
+    (["Co-op"], 0.3),
+    (["Townhouse"], 0.1),
+    (["Condop"], 0.05),
+    (["Multi Family"], 0.1),
+)
+AMENITIES = (
+    "Elevator",
+    "Laundry in Building",
+    "Dishwasher",
+    "Full-Time Doorman",
+    "Gym",
+    "Concierge",
+    "Washer / Dryer in Unit",
+    "Common Roof Deck",
+    "Bike Room",
+    "High Ceilings",
+    "Garage",
+    "Voice Intercom",
+    "Hardwood Floors",
+    "Common Outdoor Space",
+    "Pet Friendly",
+    "Doorman",
+    "Walk Up",
+    "Roof Deck",
+    "Private Outdoor Space",
+    "Oversized Windows",
+    "Storage Space",
+    "Central Air",
+    "Fireplace",
+    "Den",
+)
+BUILDINGS_PER_NEIGHBORHOOD = 200
+# Roughly what a rent of one dollar a month sells for.
+SALE_PRICE_RENT_MULTIPLE = 12 / 0.04
+
+def make_listing(listing_type, index, seed=0):
+    # The listing dict for listing number index; the same (listing_type,
+    # index, seed) always gives the same listing.
+    rng = random.Random("{}:{}:{}".format(seed, listing_type, index))
+    neighborhood, latitude, longitude, premium = rng.choice(NEIGHBORHOODS)
+    property_types, weights = zip(*PROPERTY_TYPES)
+    property_type = rng.choices(property_types, weights)[0]
+    beds = rng.choices((0, 1, 2, 3, 4), (0.15, 0.35, 0.3, 0.15, 0.05))[0]
+    baths = max(1, beds - rng.choice((0, 0, 1))) + rng.choice((0, 0, 0.5))
+    sq_ft = int(rng.gauss(450 + 350 * beds, 120))
+    building_number = rng.randrange(BUILDINGS_PER_NEIGHBORHOOD)
+    building_year = 1890 + (building_number * 7919) % 135
+    amenities = [amenity for amenity in AMENITIES if rng.random() < 0.3]
+
+    rent = (
+        premium * (1200 + 2.6 * sq_ft + 150 * baths + 80 * len(amenities)) *
+        (1.15 if building_year >= 2010 else 1.0) *
+        rng.lognormvariate(0, 0.08)
+    )
+    is_sale = listing_type == compass.LISTING_TYPE_SALE
+    price = round(rent * SALE_PRICE_RENT_MULTIPLE * rng.lognormvariate(0, 0.1), -3) if is_sale else round(rent, -1)
+    listing = {
+        "canonicalPageLink": "/listing/synthetic-{}-{}-{}/".format(listing_type, seed, index),
+        "price": {
+            "lastKnown": price,
+            "listed": price if rng.random() < 0.8 else round(price * 1.05, -1),
+        },
+        "location": {
+            "prettyAddress": "{} Synthetic St #{}".format(building_number, rng.randrange(1, 40)),
+            "neighborhood": neighborhood,
+            "latitude": latitude + rng.uniform(-0.004, 0.004),
+            "longitude": longitude + rng.uniform(-0.004, 0.004),
+        },
+        "buildingInfo": {
+            "id": "{}-{}".format(neighborhood, building_number),
+            "buildingYearOpened": building_year,
+            "buildingUnits": 4 + (building_number * 31) % 300,
+        },
+        "detailedInfo": {
+            "propertyType": {"masterType": {"GLOBAL": property_type}},
+            "amenities": amenities,
+        },
+        "events": [{"timestamp": 1609459200000 + rng.randrange(365) * 86400000}],
+    }
+    if rng.random() < 0.97:
+        listing["size"] = {"squareFeet": sq_ft, "bedrooms": beds, "totalBathrooms": baths}
+    if rng.random() < 0.1:
+        listing["detailedInfo"]["totalParkingSpaces"] = 1
+    if is_sale:
+        common_charges = round(0.6 * sq_ft * rng.uniform(0.8, 1.2))
+        listing["price"]["monthlySalesCharges"] = common_charges
+        listing["price"]["monthlySalesChargesInclTaxes"] = common_charges + round(price * 0.0012)
+    return listing
+
+def make_search_page(listing_type, total_count, start, page_size=compass.SEARCH_PAGE_SIZE, seed=0):
+    # The response JSON for the search page of page_size listings starting at
+    # start out of total_count.
+    return {
+        "lolResults": {
+            "totalItems": total_count,
+            "data": [
+                {"listing": make_listing(listing_type, index, seed)}
+                for index in range(start, min(start + page_size, total_count))
+            ],
+        },
+    }
+
+def iter_search_pages(listing_type, total_count, page_size=compass.SEARCH_PAGE_SIZE, seed=0):
+    for start in range(0, total_count, page_size):
+        yield make_search_page(listing_type, total_count, start, page_size, seed)
+
+def make_listings_df(listing_type, count, seed=0):
+    # A listings frame as compass.read_listings_df would return for a CSV
+    # scrape of count synthetic listings.
+    return compass.listings_to_df(
+        listing
+        for page in iter_search_pages(listing_type, count, seed=seed)
+        for listing in compass.extract_listings_from_response(page)
+    )
+
+def main(argv):
+    import argparse
+    parser = argparse.ArgumentParser(description="Write synthetic Compass listings")
+    parser.add_argument("count", type=int)
+    parser.add_argument("--sales", action="store_true")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--format", choices=compass.LISTING_FORMATS + ("json",), default="csv",
+                        help="json writes raw search response pages, one per line")
+    parser.add_argument("--output", default="-")
+
+    parsed = parser.parse_args(argv[1:])
+    listing_type = compass.LISTING_TYPE_SALE if parsed.sales else compass.LISTING_TYPE_RENTAL
+    pages = iter_search_pages(listing_type, parsed.count, seed=parsed.seed)
+    outfile = (
+        open(parsed.output, "w" if parsed.format in ("csv", "json") else "wb") if parsed.output != "-" else
+        sys.stdout if parsed.format in ("csv", "json") else
+        sys.stdout.buffer
+    )
+    with outfile:
+        if parsed.format == "json":
+            for page in pages:
+                outfile.write(json.dumps(page) + "\n")
+        else:
+            compass.write_listings(
+                (listing for page in pages for listing in compass.extract_listings_from_response(page)),
+                outfile,
+                parsed.format,
+            )
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
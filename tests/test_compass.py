@@ -0,0 +1,155 @@
+import io
+import os
+
+import numpy as np
+import pyarrow.feather
+
+import compass
+import synthetic
+
+def make_listings(count, listing_type=compass.LISTING_TYPE_SALE, seed=0):
+    return list(compass.extract_listings_from_response(
+        synthetic.make_search_page(listing_type, count, 0, page_size=count, seed=seed)))
+
+def test_response_cache_round_trip_and_ttl(tmp_path):
+    cache = compass.ResponseCache(str(tmp_path), ttl_seconds=60)
+    page = synthetic.make_search_page(compass.LISTING_TYPE_SALE, 3, 0)
+    assert cache.get(compass.LISTING_TYPE_SALE, 1, 0, 20) is None
+    cache.put(compass.LISTING_TYPE_SALE, 1, 0, 20, page)
+    assert cache.get(compass.LISTING_TYPE_SALE, 1, 0, 20) == page
+    assert cache.get(compass.LISTING_TYPE_RENTAL, 1, 0, 20) is None
+    # The same offset with another page size is another page.
+    assert cache.get(compass.LISTING_TYPE_SALE, 1, 0, 7) is None
+    path = cache.get_path(compass.LISTING_TYPE_SALE, 1, 0, 20)
+    os.utime(path, (0, 0))
+    assert cache.get(compass.LISTING_TYPE_SALE, 1, 0, 20) is None
+    assert cache.get(compass.LISTING_TYPE_SALE, 1, 0, 20, ignore_ttl=True) == page
+
+def test_response_cache_evicts_least_recently_used(tmp_path):
+    page = synthetic.make_search_page(compass.LISTING_TYPE_SALE, 20, 0)
+    cache = compass.ResponseCache(str(tmp_path))
+    cache.put(compass.LISTING_TYPE_SALE, 1, 0, 20, page)
+    entry_bytes = cache.total_bytes
+    cache.put(compass.LISTING_TYPE_SALE, 1, 20, 20, page)
+    os.utime(cache.get_path(compass.LISTING_TYPE_SALE, 1, 0, 20), (0, 0))
+    # Reopened, the cache starts from file mtimes.
+    cache = compass.ResponseCache(str(tmp_path), max_bytes=int(entry_bytes * 2.5))
+    assert list(cache.entry_sizes)[0] == cache.get_path(compass.LISTING_TYPE_SALE, 1, 0, 20)
+    assert cache.get(compass.LISTING_TYPE_SALE, 1, 0, 20) == page
+    cache.put(compass.LISTING_TYPE_SALE, 1, 40, 20, page)
+    assert cache.get(compass.LISTING_TYPE_SALE, 1, 20, 20) is None
+    assert cache.get(compass.LISTING_TYPE_SALE, 1, 0, 20) == page
+    assert cache.get(compass.LISTING_TYPE_SALE, 1, 40, 20) == page
+    assert cache.total_bytes <= cache.max_bytes
+
+def test_seen_set_save_and_load(tmp_path):
+    path = str(tmp_path / "seen")
+    seen = compass.SeenSet(path, "2021-01-01")
+    assert seen.add_all(["a", "b"])
+    assert not seen.add_all(["c", "a"])
+    assert seen.add_all(["c"])
+    seen.save()
+    loaded = compass.SeenSet(path, "2021-01-01")
+    assert len(loaded) == len(seen)
+    assert not loaded.add_all(["b"])
+    # Another run sees everything again.
+    assert len(compass.SeenSet(path, "2021-01-02")) == 0
+
+def test_skip_duplicate_listings_by_permalink_and_unit():
+    first, second = make_listings(2)
+    same_unit = second._replace(permalink="/listing/relisted/")
+    seen = compass.SeenSet()
+    listings = [first, second, first, same_unit]
+    assert list(compass.skip_duplicate_listings(compass.LISTING_TYPE_SALE, listings, seen)) == [first, second]
+    # Keys are per listing type.
+    assert list(compass.skip_duplicate_listings(compass.LISTING_TYPE_RENTAL, [first], seen)) == [first]
+
+def test_listing_batch_round_trip():
+    listings = make_listings(50)
+    listings[3] = listings[3]._replace(sq_ft=None, neighborhood=None, amenities='["Gym", "Gym", "Doorman"]')
+    batch = compass.ListingBatch(listings[:20])
+    for listing in listings[20:]:
+        batch.append(listing)
+    assert len(batch) == 50
+    # Amenities come back without duplicates.
+    expected = listings[:3] + [listings[3]._replace(amenities='["Gym", "Doorman"]')] + listings[4:]
+    assert list(batch.iter_listings()) == expected
+
+    df = batch.to_df()
+    np.testing.assert_array_equal(df["price_dollars"], [listing.price_dollars for listing in listings])
+    assert np.isnan(df["sq_ft"][3])
+    assert df["neighborhood"].isna()[3]
+
+    vocabulary = ["Doorman", "Gym", "Not an amenity"]
+    matrix = batch.get_amenity_matrix(vocabulary).toarray()
+    assert matrix.shape == (50, 3)
+    np.testing.assert_array_equal(matrix[3], [1, 1, 0])
+    assert not matrix[:, 2].any()
+
+class FakePagesClient(compass.CompassClient):
+    # Serves synthetic pages, with fewer listings than requested for starts
+    # in short_pages and no listings for starts in empty_pages.
+    def __init__(self, total_counts, short_pages=(), empty_pages=(), **kwargs):
+        super().__init__(**kwargs)
+        self.total_counts = total_counts
+        self.short_pages = dict(short_pages)
+        self.empty_pages = set(empty_pages)
+        self.requests = []
+
+    def fetch_search_page(self, bk_location, listing_type, start, stride):
+        self.requests.append((bk_location["id"], start, stride))
+        total_count = self.total_counts[bk_location["id"]]
+        if start in self.empty_pages:
+            return {"lolResults": {"totalItems": total_count, "data": []}}
+        page_size = self.short_pages.get(start, stride)
+        return synthetic.make_search_page(listing_type, total_count, start, page_size, seed=bk_location["id"])
+
+def query_fake_pages(concurrency, **kwargs):
+    locations = [{"id": i, "name": str(i)} for i in range(3)]
+    with FakePagesClient(concurrency=concurrency, **kwargs) as client:
+        return list(client.query_compass(compass.LISTING_TYPE_SALE, locations)), client.requests
+
+def test_concurrent_pages_match_sequential():
+    for kwargs in (
+            dict(total_counts=[95, 0, 41]),
+            # A short page moves every following offset and stride.
+            dict(total_counts=[95, 0, 41], short_pages={20: 7}),
+            # An empty page ends the location before totalItems.
+            dict(total_counts=[95, 60, 41], empty_pages={40})):
+        sequential, sequential_requests = query_fake_pages(1, **kwargs)
+        concurrent, concurrent_requests = query_fake_pages(4, **kwargs)
+        assert concurrent == sequential
+        assert set(sequential_requests) <= set(concurrent_requests)
+
+def test_retry_delay_falls_back_to_backoff_on_bad_retry_after():
+    client = compass.CompassClient(backoff_seconds=1.0, max_backoff_seconds=60.0)
+    assert client.get_retry_delay_seconds(0, "7") == 7.0
+    assert client.get_retry_delay_seconds(0, "600") == 60.0
+    assert client.get_retry_delay_seconds(0, "Thu, 01 Jan 1970 00:00:00 GMT") == 0.0
+    for retry_after in ("garbage", "Thu, 99 Foo 1970"):
+        assert 0.0 <= client.get_retry_delay_seconds(2, retry_after) <= 4.0
+
+def test_truncated_pages_are_retried():
+    import mockcompass
+    server = mockcompass.start_in_background(mockcompass.DEFAULT_CONFIG._replace(
+        listings_per_location=100, truncate_rate=0.5))
+    try:
+        location = compass.BK_LOCATIONS[0]
+        with compass.CompassClient(base_url=server.base_url, backoff_seconds=0.0, max_retries=20) as client:
+            listings = list(client.query_bk_location(location, compass.LISTING_TYPE_SALE))
+    finally:
+        server.shutdown()
+        server.server_close()
+    assert len(listings) == 100
+    assert server.stats["truncated"] > 0
+
+def test_arrow_listings_accept_missing_values_as_nan():
+    listing = make_listings(1)[0]._replace(year_opened=float("nan"), parking_spaces="", building_id=float("nan"))
+    outfile = io.BytesIO()
+    compass.write_listings([listing], outfile, "arrow")
+    outfile.seek(0)
+    table = pyarrow.feather.read_table(outfile)
+    row = table.to_pylist()[0]
+    assert row["year_opened"] is None
+    assert row["parking_spaces"] is None
+    assert row["building_id"] is None
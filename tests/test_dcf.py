@@ -0,0 +1,187 @@
+import numpy as np
+import numpy_financial as npf
+
+import dcf
+
+def test_irr_batch_matches_npf_irr():
+    rng = np.random.default_rng(6)
+    cash_flows = np.column_stack([-rng.uniform(1e5, 1e6, 100), rng.uniform(0, 2e4, (100, 60))])
+    solution = dcf.irr_batch(cash_flows)
+    expected = np.array([npf.irr(row) for row in cash_flows])
+    np.testing.assert_allclose(solution.rate, expected, rtol=1e-9)
+    # One sign change each, so one root each.
+    np.testing.assert_array_equal(solution.root_count, 1)
+
+def test_irr_batch_flags_missing_and_ambiguous_irrs():
+    solution = dcf.irr_batch([
+        [-100.0, 0.0, 121.0],
+        # Never changes sign.
+        [100.0, 10.0, 10.0],
+        # Roots at 10% and 20%; the one closest to zero is returned.
+        [-100.0, 230.0, -132.0],
+    ])
+    np.testing.assert_allclose(solution.rate, [0.1, np.nan, 0.1], rtol=1e-12)
+    np.testing.assert_array_equal(solution.root_count, [1, 0, 2])
+
+def make_dcf_kwargs(count, seed=0):
+    # get_unlevered_returns arguments over count varied listings.
+    rng = np.random.default_rng(seed)
+    return dict(
+        purchase_price_dollars=rng.uniform(4e5, 3e6, count),
+        sq_ft=np.where(rng.random(count) < 0.1, np.nan, rng.uniform(400, 3000, count)),
+        closing_costs_pct=0.04,
+        initial_downtime_months=rng.integers(0, 6, count),
+        interim_downtime_months=rng.integers(0, 3, count),
+        lease_length_months=rng.choice([12, 24, 36], count),
+        annual_rent_growth_pct=rng.choice([0.0, 0.02, 0.03], count),
+        annual_expense_growth_pct=0.02,
+        monthly_rent_dollars=rng.uniform(2000, 9000, count),
+        monthly_utilities_rent_pct=0.025,
+        monthly_tax_dollars=rng.uniform(0, 1500, count),
+        monthly_common_charges_dollars=rng.uniform(0, 2000, count),
+        monthly_homeowners_insurance_dollars=100,
+        monthly_capital_reserve_dollars=rng.choice([200, 300, 600], count),
+        hold_period_months=rng.choice([36, 60, 84], count),
+        exit_cap_pct=rng.choice([0.03, 0.035, 0.05], count),
+        exit_sq_ft_price_ceiling_dollars=3000,
+        exit_costs_pct=0.08,
+        exit_purchase_price_ceiling_multiple=rng.choice([np.inf, 1.2, 1.5], count),
+        capital_reserve_price_threshold_dollars=rng.choice([np.inf, 1e6, 2e6], count),
+        capital_reserve_price_multiple=1.5,
+    )
+
+def get_line_item_held_cash_flows(kwargs):
+    # The full line-item schedule, cut off after each listing's exit month.
+    lines, gross_sales_price, hold_period_months = dcf.get_unlevered_cash_flows_batch(**kwargs)
+    cash_flows = lines["unlevered_cash_flow"]
+    months = np.arange(cash_flows.shape[1])
+    return np.where(months <= hold_period_months[:, np.newaxis], cash_flows, 0.0), gross_sales_price, hold_period_months
+
+def test_held_cash_flows_match_line_items():
+    kwargs = make_dcf_kwargs(500)
+    held_cash_flows, gross_sales_price, hold_period_months = dcf.get_held_cash_flows_batch(**kwargs)
+    expected_cash_flows, expected_gross_sales_price, expected_hold_period_months = get_line_item_held_cash_flows(kwargs)
+    np.testing.assert_array_equal(hold_period_months, expected_hold_period_months)
+    np.testing.assert_allclose(gross_sales_price, expected_gross_sales_price, rtol=1e-12)
+    width = held_cash_flows.shape[1]
+    np.testing.assert_allclose(held_cash_flows, expected_cash_flows[:, :width], rtol=1e-12, atol=1e-6)
+    assert not np.any(expected_cash_flows[:, width:])
+
+def test_batch_returns_match_line_item_returns():
+    kwargs = make_dcf_kwargs(200, seed=1)
+    ret = dcf.get_unlevered_returns_batch(**kwargs)
+    expected_cash_flows, expected_gross_sales_price, hold_period_months = get_line_item_held_cash_flows(kwargs)
+    expected_irr = np.array([
+        (1.0 + npf.irr(cash_flows[:hold + 1]))**12 - 1
+        for cash_flows, hold in zip(expected_cash_flows, hold_period_months)
+    ])
+    np.testing.assert_allclose(ret.irr_pct, expected_irr, rtol=1e-8, atol=1e-10)
+    np.testing.assert_allclose(ret.gross_sale_price_dollars, expected_gross_sales_price, rtol=1e-12)
+    np.testing.assert_allclose(ret.profit_dollars, expected_cash_flows.sum(axis=1), rtol=1e-10)
+    np.testing.assert_allclose(ret.equity_dollars, -np.minimum(expected_cash_flows, 0).sum(axis=1), rtol=1e-12)
+
+# Output of the original scalar get_unlevered_returns, before the batch
+# engines replaced it: base arguments and overrides, then irr_pct,
+# gross_sale_price_dollars, moic_pct, equity_dollars, profit_dollars and
+# gross_sale_price_sq_ft_dollars. It had no interim vacancy, so it matches
+# interim_downtime_months=0.
+BASELINE_DCF_KWARGS = dict(
+    purchase_price_dollars=1575000,
+    sq_ft=1758,
+    closing_costs_pct=0.04,
+    initial_downtime_months=3,
+    interim_downtime_months=1,
+    lease_length_months=36,
+    annual_rent_growth_pct=0.02,
+    annual_expense_growth_pct=0.02,
+    monthly_rent_dollars=10000,
+    monthly_utilities_rent_pct=0.025,
+    monthly_tax_dollars=1000,
+    monthly_common_charges_dollars=500,
+    monthly_homeowners_insurance_dollars=100,
+    monthly_capital_reserve_dollars=500,
+    hold_period_months=60,
+    exit_cap_pct=0.035,
+    exit_sq_ft_price_ceiling_dollars=1200,
+    exit_costs_pct=0.08,
+)
+BASELINE_RETURNS = [
+    ({}, (0.08809665655840337, 2109600.0, 1.4613896871417165, 1645050.0, 759009.1048324807, 1200.0)),
+    (
+        dict(hold_period_months=36, exit_cap_pct=0.05, exit_sq_ft_price_ceiling_dollars=3000),
+        (0.104870160392043, 2079182.3860799999, 1.3245559444354886, 1645050.0, 533910.7563936005, 1182.697603003413),
+    ),
+    (
+        dict(initial_downtime_months=6, monthly_rent_dollars=9000, hold_period_months=84, lease_length_months=12, interim_downtime_months=2),
+        (0.06950061566346877, 2109600.0, 1.515745377140304, 1651950.0, 851985.5757669252, 1200.0),
+    ),
+]
+
+def test_returns_match_baseline_scalar_engine():
+    overrides = [dict(case, interim_downtime_months=0) for case, _ in BASELINE_RETURNS]
+    batch_kwargs = {
+        name: np.array([dict(BASELINE_DCF_KWARGS, **case)[name] for case in overrides], dtype=float)
+        for name in BASELINE_DCF_KWARGS
+    }
+    ret = dcf.get_unlevered_returns_batch(**batch_kwargs)
+    for i, (case, (_, expected)) in enumerate(zip(overrides, BASELINE_RETURNS)):
+        scalar = dcf.get_unlevered_returns(**dict(BASELINE_DCF_KWARGS, **case))
+        for field, value in zip(dcf.UnleveredReturn._fields, expected):
+            np.testing.assert_allclose(getattr(scalar, field), value, rtol=1e-10)
+            np.testing.assert_allclose(getattr(ret, field)[i], value, rtol=1e-10)
+
+def test_interim_vacancy_lowers_baseline_irr():
+    ret = dcf.get_unlevered_returns(**BASELINE_DCF_KWARGS)
+    np.testing.assert_allclose(ret.irr_pct, 0.08696, atol=1e-5)
+    assert ret.irr_pct < BASELINE_RETURNS[0][1][0]
+
+def test_interim_vacancy_between_leases():
+    kwargs = dict(make_dcf_kwargs(1), initial_downtime_months=2, interim_downtime_months=1, lease_length_months=12)
+    lines, _, _ = dcf.get_unlevered_cash_flows_batch(**kwargs)
+    vacant = np.flatnonzero(lines["vacancy"][0])
+    np.testing.assert_array_equal(vacant[:5], [0, 1, 14, 27, 40])
+
+def test_scalar_returns_match_batch():
+    kwargs = make_dcf_kwargs(20, seed=2)
+    ret = dcf.get_unlevered_returns_batch(**kwargs)
+    for i in range(20):
+        scalar = dcf.get_unlevered_returns(**{name: value[i] if np.ndim(value) else value for name, value in kwargs.items()})
+        for field in dcf.UnleveredReturn._fields:
+            np.testing.assert_allclose(getattr(scalar, field), getattr(ret, field)[i], rtol=1e-9, equal_nan=True)
+
+def test_max_purchase_prices_reach_target_irr():
+    # Including listings whose exit ceiling and capital reserve depend on
+    # the price.
+    kwargs = make_dcf_kwargs(300, seed=3)
+    target_irr_pct = 0.06
+    max_purchase_prices = dcf.get_max_purchase_prices_batch(target_irr_pct, **kwargs)
+    priced = np.flatnonzero(~np.isnan(max_purchase_prices))
+    assert len(priced) > 200
+    priced_kwargs = dcf.take_listings(kwargs, priced)
+    ret = dcf.get_unlevered_returns_batch(**dict(priced_kwargs, purchase_price_dollars=max_purchase_prices[priced]))
+    # At least the target (it jumps past it where the reserve steps up) and
+    # below it for a little more.
+    assert np.all(ret.irr_pct >= target_irr_pct - 1e-8)
+    assert np.mean(np.abs(ret.irr_pct - target_irr_pct) < 1e-5) > 0.95
+    over = dcf.get_unlevered_returns_batch(**dict(priced_kwargs, purchase_price_dollars=max_purchase_prices[priced] + 2.0))
+    assert np.all(over.irr_pct < target_irr_pct)
+
+def test_max_purchase_prices_ignore_reserve_multiple_without_threshold():
+    # With no threshold the reserve never changes, however low the multiple.
+    kwargs = dict(
+        make_dcf_kwargs(50, seed=5),
+        exit_purchase_price_ceiling_multiple=np.inf,
+        capital_reserve_price_threshold_dollars=np.inf,
+    )
+    expected = dcf.get_max_purchase_prices_batch(0.06, **dict(kwargs, capital_reserve_price_multiple=1.0))
+    max_purchase_prices = dcf.get_max_purchase_prices_batch(0.06, **dict(kwargs, capital_reserve_price_multiple=0.5))
+    assert np.sum(~np.isnan(expected)) > 30
+    np.testing.assert_allclose(max_purchase_prices, expected, rtol=1e-12)
+
+def test_reprice_follows_price_dependent_inputs():
+    kwargs = make_dcf_kwargs(200, seed=4)
+    cut_prices = kwargs["purchase_price_dollars"] * 0.8
+    repriced = dcf.reprice_batch(dcf.decompose_cash_flows_batch(**kwargs), purchase_price_dollars=cut_prices)
+    expected = dcf.get_unlevered_returns_batch(**dict(kwargs, purchase_price_dollars=cut_prices))
+    np.testing.assert_allclose(repriced.irr_pct, expected.irr_pct, rtol=1e-12)
+    np.testing.assert_allclose(repriced.gross_sale_price_dollars, expected.gross_sale_price_dollars, rtol=1e-12)
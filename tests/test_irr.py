@@ -0,0 +1,40 @@
+import numpy as np
+import numpy_financial as npf
+
+import dcf
+
+def test_irr_batch_matches_npf_irr():
+    rng = np.random.default_rng(0)
+    cash_flows = np.column_stack((-rng.uniform(5e5, 2e6, 300), rng.uniform(-2e3, 2e4, (300, 60))))
+    cash_flows[:, -1] += rng.uniform(3e5, 3e6, 300)
+    solution = dcf.irr_batch(cash_flows)
+    expected = np.array([npf.irr(row) for row in cash_flows])
+    np.testing.assert_allclose(solution.rate, expected, rtol=1e-8, atol=1e-12)
+    assert np.all(solution.root_count == 1)
+
+def test_irr_batch_without_root_is_nan():
+    # Every cash flow positive: NPV never crosses zero.
+    solution = dcf.irr_batch([[100.0, 50.0, 25.0], [-100.0, 110.0, 0.0]])
+    assert np.isnan(solution.rate[0])
+    assert solution.root_count[0] == 0
+    np.testing.assert_allclose(solution.rate[1], 0.1)
+    assert solution.root_count[1] == 1
+
+def test_irr_batch_multiple_roots_picks_closest_to_zero():
+    # (1 + r) in {1.1, 1.2}: roots at 10% and 20%.
+    cash_flows = np.array([[-100.0, 230.0, -132.0]])
+    solution = dcf.irr_batch(cash_flows)
+    assert solution.root_count[0] == 2
+    np.testing.assert_allclose(solution.rate[0], 0.1)
+    np.testing.assert_allclose(solution.rate[0], npf.irr(cash_flows[0]))
+
+def test_irrs_by_hold_period_keep_root_counts():
+    cash_flows = np.array([
+        [-100.0, 230.0, -132.0, 0.0],
+        [100.0, 50.0, 25.0, 0.0],
+        [-100.0, 0.0, 0.0, 121.0],
+    ])
+    solution = dcf.get_irrs_by_hold_period(cash_flows, np.array([2, 2, 3]))
+    np.testing.assert_array_equal(solution.root_count, [2, 0, 1])
+    np.testing.assert_allclose(solution.rate[[0, 2]], [1.1**12 - 1, 1.21**4 - 1])
+    assert np.isnan(solution.rate[1])
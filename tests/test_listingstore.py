@@ -0,0 +1,68 @@
+import compass
+import listingstore
+import synthetic
+
+def make_listings(count, seed=0):
+    return list(compass.extract_listings_from_response(
+        synthetic.make_search_page(compass.LISTING_TYPE_SALE, count, 0, page_size=count, seed=seed)))
+
+def test_record_listings_counts_new_and_changed():
+    listings = make_listings(5)
+    with listingstore.ListingStore(":memory:") as store:
+        assert store.record_listings(compass.LISTING_TYPE_SALE, listings, "2021-01-01") == 5
+        assert store.record_listings(compass.LISTING_TYPE_SALE, listings, "2021-01-02") == 0
+        changed = listings[0]._replace(price_dollars=listings[0].price_dollars - 10000)
+        assert store.record_listings(compass.LISTING_TYPE_SALE, [changed] + listings[1:], "2021-01-03") == 1
+        assert store.get_listings([changed.permalink]) == {changed.permalink: changed}
+        assert store.get_price_history(changed.permalink) == [
+            ("2021-01-01", listings[0].price_dollars),
+            ("2021-01-03", changed.price_dollars),
+        ]
+        assert list(store.iter_listings(compass.LISTING_TYPE_SALE, "2021-01-03")) == [changed] + listings[1:]
+        assert list(store.iter_listings(compass.LISTING_TYPE_RENTAL)) == []
+
+def test_scores_are_dropped_when_listing_changes():
+    listings = make_listings(2)
+    permalinks = [listing.permalink for listing in listings]
+    with listingstore.ListingStore(":memory:") as store:
+        store.record_listings(compass.LISTING_TYPE_SALE, listings)
+        store.put_scores(permalinks, [3000.0, 4000.0], [0.05, float("nan")], [1, 0])
+        scores = store.get_current_scores()
+        assert scores[permalinks[0]] == (3000.0, 0.05, 1)
+        assert scores[permalinks[1]][2] == 0
+        changed = listings[1]._replace(sq_ft=(listings[1].sq_ft or 0) + 100)
+        store.record_listings(compass.LISTING_TYPE_SALE, [changed])
+        assert list(store.get_current_scores(permalinks)) == [permalinks[0]]
+        assert store.get_repriced_rents(permalinks) == {}
+
+def test_price_cut_keeps_predicted_rent():
+    listings = make_listings(2)
+    permalinks = [listing.permalink for listing in listings]
+    with listingstore.ListingStore(":memory:") as store:
+        store.record_listings(compass.LISTING_TYPE_SALE, listings)
+        store.put_scores(permalinks, [3000.0, 4000.0], [0.05, 0.06], [1, 1])
+        cut = listings[0]._replace(price_dollars=listings[0].price_dollars - 10000)
+        store.record_listings(compass.LISTING_TYPE_SALE, [cut, listings[1]])
+        assert list(store.get_current_scores(permalinks)) == [permalinks[1]]
+        assert store.get_repriced_rents(permalinks) == {permalinks[0]: 3000.0}
+        store.put_scores([cut.permalink], [3000.0], [0.055], [1])
+        assert store.get_repriced_rents() == {}
+
+def test_full_crawl_is_due_every_full_crawl_days():
+    with listingstore.ListingStore(":memory:") as store:
+        assert store.is_full_crawl_due(compass.LISTING_TYPE_SALE, 7, "2021-01-01")
+        store.record_full_crawl(compass.LISTING_TYPE_SALE, "2021-01-01")
+        assert not store.is_full_crawl_due(compass.LISTING_TYPE_SALE, 7, "2021-01-07")
+        assert store.is_full_crawl_due(compass.LISTING_TYPE_SALE, 7, "2021-01-08")
+        assert store.is_full_crawl_due(compass.LISTING_TYPE_RENTAL, 7, "2021-01-07")
+
+def test_scores_are_dropped_when_fingerprint_changes():
+    listings = make_listings(1)
+    with listingstore.ListingStore(":memory:") as store:
+        store.record_listings(compass.LISTING_TYPE_SALE, listings)
+        store.set_score_fingerprint("model-a")
+        store.put_scores([listings[0].permalink], [3000.0], [0.05], [1])
+        store.set_score_fingerprint("model-a")
+        assert len(store.get_current_scores()) == 1
+        store.set_score_fingerprint("model-b")
+        assert store.get_current_scores() == {}
@@ -0,0 +1,64 @@
+import threading
+
+import pytest
+
+import compass
+import listingstore
+import pipeline
+
+def test_listing_stream_blocks_producer_until_consumed():
+    cancelled = threading.Event()
+    stream = pipeline.ListingStream(cancelled, maxsize=2, poll_seconds=0.01)
+    produced = []
+    def produce():
+        for i in range(10):
+            stream.put(i)
+            produced.append(i)
+        stream.close()
+    producer = threading.Thread(target=produce)
+    producer.start()
+    producer.join(0.2)
+    assert producer.is_alive() and len(produced) <= 3
+    assert [listing for batch in stream.iter_batches(3) for listing in batch] == list(range(10))
+    producer.join()
+
+def test_listing_stream_put_stops_when_cancelled():
+    cancelled = threading.Event()
+    stream = pipeline.ListingStream(cancelled, maxsize=1, poll_seconds=0.01)
+    stream.put(0)
+    cancelled.set()
+    with pytest.raises(pipeline.StageCancelled):
+        stream.put(1)
+
+def scrape_incrementally(server, tmp_path, concurrency):
+    # Listings streamed by two incremental scrapes into a fresh store, the
+    # second stopping at each location's first unchanged page.
+    config = pipeline.PipelineConfig(
+        **dict.fromkeys(pipeline.PipelineConfig._fields),
+    )._replace(
+        sales_path=str(tmp_path / "sales-{}.csv".format(concurrency)),
+        locations=compass.BK_LOCATIONS,
+        store=listingstore.ListingStore(str(tmp_path / "listings-{}.db".format(concurrency))),
+        incremental=True,
+        active_days=7,
+        full_crawl_days=7,
+        client_kwargs=dict(concurrency=concurrency, base_url=server.base_url),
+    )
+    with config.store:
+        runs = []
+        for _ in range(2):
+            streamed = []
+            pipeline.scrape(config, compass.LISTING_TYPE_SALE, threading.Event(), streamed.append)
+            runs.append(streamed)
+    return runs
+
+def test_incremental_scrape_streams_the_same_listings_at_any_concurrency(tmp_path):
+    import mockcompass
+    server = mockcompass.start_in_background(mockcompass.DEFAULT_CONFIG._replace(listings_per_location=60))
+    try:
+        sequential = scrape_incrementally(server, tmp_path, 1)
+        concurrent = scrape_incrementally(server, tmp_path, 4)
+    finally:
+        server.shutdown()
+        server.server_close()
+    assert concurrent == sequential
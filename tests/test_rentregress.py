@@ -0,0 +1,35 @@
+import numpy as np
+import pandas as pd
+import scipy.sparse
+
+import rentregress
+
+def test_model_matrix_keeps_zeros_and_stores_only_present_amenities():
+    amenities = pd.DataFrame.sparse.from_spmatrix(
+        scipy.sparse.csr_matrix(np.array([[1, 0], [0, 0], [0, 1]], dtype=np.uint8)),
+        columns=["amenity_Gym", "amenity_Doorman"],
+    )
+    features = pd.concat([
+        amenities[["amenity_Gym"]],
+        pd.DataFrame({"beds": [0.0, 2.0, np.nan], "sq_ft": [500.0, np.nan, 0.0]}),
+        amenities[["amenity_Doorman"]],
+    ], axis=1)
+    matrix = rentregress.get_model_matrix(features)
+    assert scipy.sparse.isspmatrix_csr(matrix)
+    assert matrix.shape == (3, 4)
+    # Zeros in dense columns are stored explicitly; nan and absent
+    # amenities are not stored at all.
+    coo = matrix.tocoo()
+    explicit = {(i, j): value for i, j, value in zip(coo.row, coo.col, coo.data)}
+    assert explicit == {
+        (0, 0): 1.0, (0, 1): 0.0, (0, 2): 500.0,
+        (1, 1): 2.0,
+        (2, 2): 0.0, (2, 3): 1.0,
+    }
+
+def test_test_rows_depend_only_on_permalink():
+    permalinks = ["/listing/{}/".format(i) for i in range(5000)]
+    test_rows = rentregress.get_test_rows(permalinks)
+    assert 0.08 < np.mean(test_rows) < 0.12
+    np.testing.assert_array_equal(rentregress.get_test_rows(permalinks[::-1]), test_rows[::-1])
+    np.testing.assert_array_equal(rentregress.get_test_rows(permalinks[100:]), test_rows[100:])
@@ -0,0 +1,17 @@
+import json
+
+import pytest
+
+import scoreserver
+
+def test_parse_listing_normalizes_amenities():
+    listing = scoreserver.parse_listing({"permalink": "x", "price_dollars": "900000", "amenities": ["Gym"]})
+    assert listing.price_dollars == 900000.0
+    assert json.loads(listing.amenities) == ["Gym"]
+    assert scoreserver.parse_listing({"amenities": '["Gym"]'}).amenities == listing.amenities
+    assert scoreserver.parse_listing({"permalink": "x"}).amenities is None
+
+@pytest.mark.parametrize("amenities", ["{bad", '{"Gym": 1}', [1], "Gym"])
+def test_parse_listing_rejects_bad_amenities(amenities):
+    with pytest.raises(ValueError):
+        scoreserver.parse_listing({"permalink": "x", "amenities": amenities})